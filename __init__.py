@@ -5,7 +5,21 @@ Python-based HLA:peptide binding prediction cache and IEDB-tool wrapper
 
 """
 
-from .cache import hlaPredCache, RandCache
+from .cache import hlaPredCache, hlaStoreCache, hlaConcurrentCache, hlaCacheClient, RandCache, loadSnapshot, loadShards, loadParquet, attachShared, detachShared
+from .store import ArrayStore
+from .encoding import encodePeptides, decodePeptides, PeptideIndex
+from .sqlstore import SqliteStore
+from .lrustore import LRUStore
+from .shards import ShardedStore
+from .slicestore import SliceStore
+from .methodstore import MethodStore
+from .corestore import CoreStore, coreOffsets
+from .concurrentstore import ConcurrentStore
+from .versionstore import VersionedStore
+from .fingerprint import predictorFingerprint
+from .remotestore import RemoteStore
+from .server import CacheServer
+from .lookupstats import LookupStats
 from .helpers import *
 from . import predict
 from .iedb_src import predict_binding as iedb_predict
@@ -13,6 +27,31 @@ from .new_iedb_predict import *
 
 __all__ = ['predict',
            'hlaPredCache',
+           'hlaStoreCache',
+           'hlaConcurrentCache',
+           'hlaCacheClient',
+           'ArrayStore',
+           'encodePeptides',
+           'decodePeptides',
+           'PeptideIndex',
+           'SqliteStore',
+           'LRUStore',
+           'ShardedStore',
+           'SliceStore',
+           'MethodStore',
+           'CoreStore',
+           'coreOffsets',
+           'ConcurrentStore',
+           'VersionedStore',
+           'predictorFingerprint',
+           'RemoteStore',
+           'CacheServer',
+           'LookupStats',
+           'loadSnapshot',
+           'loadShards',
+           'loadParquet',
+           'attachShared',
+           'detachShared',
            'iedb_predict',
            'convertHLAAsterisk',
             'isvalidmer',
@@ -1,40 +1,73 @@
+import os
 import re
-from functools import partial
+import copyreg
 import itertools
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from scipy import stats
 
 from .helpers import *
 from .predict import *
+from .store import ArrayStore
+from .snapshot import writeSnapshot, readSnapshot
+from .shards import ShardedStore, writeShards
+from .journal import PredictionJournal, compactJournal
+from .slicestore import SliceStore
+from .methodstore import MethodStore
+from .corestore import CoreStore
+from .versionstore import VersionedStore
+from .concurrentstore import ConcurrentStore
+from .sharedstore import publishStore, attachStore, detachStore
+from .remotestore import RemoteStore
+from .encoding import encodePeptides, hashPairs
+from .lookupstats import LookupStats
+from .loader import readPredictionChunks, readPredictionFiles
+from .parquetio import writeParquet, readParquet, readParquetChunks
+from .merge import POLICIES, storeBatches, itemBatches, mergeMask, maxError
+
+def _planBatches(hlas, peptides, missing):
+    """Group the missing pairs of an [len(hlas), len(peptides)] boolean matrix into
+    rectangular batches (see hlaPredCache.planPredictions())"""
+    lengths = np.array([len(m) for m in peptides])
+    batches = []
+    for k in np.unique(lengths):
+        cols = np.nonzero(lengths == k)[0]
+        sub = missing[:, cols]
+        rows = np.nonzero(sub.any(axis=1))[0]
+        if rows.shape[0] == 0:
+            continue
+        """Group alleles by their (bit-packed) pattern of missing peptides"""
+        patterns, inv = np.unique(np.packbits(sub[rows], axis=1), axis=0, return_inverse=True)
+        for g in range(patterns.shape[0]):
+            groupRows = rows[inv.ravel() == g]
+            batches.append(([hlas[i] for i in groupRows],
+                            [peptides[j] for j in cols[sub[groupRows[0]]]]))
+    nInvocations = int(np.sum([len(h) for h, p in batches]))
+    nPairs = int(missing.sum())
+    return batches, nInvocations, nPairs
 
 class hlaPredCache(dict):
     """Load 8,9,10,11-mer binding affinities into a big dictionary
     ba[(hla,peptide)]=9.1
 
     TODO:
-     (1) Improve handling of class I and class II epitopes (and core info)
+     (1) Improve handling of class I and class II epitopes
+         (binding cores are only kept by an hlaStoreCache with a CoreStore)
      (2) Integrate better with the prediction requester above"""
-    def __init__(self, baseFn=None, kmers=[8, 9, 10, 11], warn=True, oldFile=False, useRand=False, newFile=False):
+    def __init__(self, baseFn=None, kmers=[8, 9, 10, 11], warn=True, oldFile=False, useRand=False, newFile=False, chunkSize=2**18, cpus=1):
         dict.__init__(self)
         self.repAsteriskPattern = re.compile(r'\*')
+        self.journal = None
+        self.lookupStats = None
+        self.missQueue = None
 
         if oldFile:
-            columnNames = ['method', 'hla', 'peptide', 'ic50']
-            readCSVFunc = partial(pd.read_csv, names=columnNames, header=None)
+            fmt = 'old'
         elif newFile:
-            columnNames = ['method', 'hla', 'peptide', 'ic50']
-            def _readfunc(fn):
-                tmp = pd.read_csv(fn, usecols=['peptide', 'allele', 'prediction_method_name', 'pred'])
-                tmp = tmp.rename({'prediction_method_name':'method', 'allele':'hla', 'pred':'ic50'}, axis=1)
-                tmp.loc[:, 'hla'] = tmp.hla.str.slice(4, None)
-                tmp.loc[:, 'hla'] = tmp.hla.map(partial(re.compile(r':').sub, ''))
-                return tmp
-            readCSVFunc = _readfunc
+            fmt = 'new'
         else:
-            columnNames = ['method', 'hla', 'peptide', 'core', 'ic50']
-            readCSVFunc = partial(pd.read_csv, names=columnNames, skiprows=1)
-        
+            fmt = 'default'
 
         if not baseFn is None:
             self.name = baseFn.split('.')[0]
@@ -42,16 +75,10 @@ class hlaPredCache(dict):
             fileList = ['%s.%d.out' % (baseFn, k) for k in kmers]
             self.fileList = fileList
 
-            for fn in fileList:
-                predDf = readCSVFunc(fn)
-                if kmers == [15] and oldFile:
-                    predDf['core'] = predDf.ic50.map(lambda s: s.split("'")[1])
-                    predDf['ic50'] = predDf.ic50.map(lambda s: s[1:].split(",")[0])
-                    predDf['ic50'] = predDf.ic50.map(float64)
-
-                # predDf['hla'] = predDf.hla.map(partial(re.sub, self.repAsteriskPattern, '_'))
-                predDf['hla'] = predDf.hla.map(partial(self.repAsteriskPattern.sub, '_'))
-                self.update({(h, p):v for h, p, v in zip(predDf['hla'], predDf['peptide'], predDf['ic50'])})
+            """Parse and insert one chunk at a time so the whole file is never held as a DataFrame
+            (with cpus > 1 the files are parsed in parallel processes)"""
+            for chunk in readPredictionFiles(fileList, fmt=fmt, chunkSize=chunkSize, cpus=cpus, cores=self._keepsCores()):
+                self._update(*chunk)
         else:
             self.predictionMethod = ''
             self.name = ''
@@ -76,11 +103,12 @@ class hlaPredCache(dict):
         Does not warn for invalid peptides, returns nan"""
         
         if self.useRand or useRand:
-            hla, pep = key
-            key = (hla, self.uPep[self.transMat[self.uPep.index(pep), self.uHLA.index(hla)]])
+            key = self._permuteKey(key)
         try:
             """First, try to get the prediction the fastest way possible"""
             val = dict.__getitem__(self, key)
+            if not self.lookupStats is None and not (self.useRand or useRand):
+                self.lookupStats.record(key[0], key[1], 'hits')
         except KeyError:
             hla, peptide = key
             hla = re.sub(self.repAsteriskPattern, '_', hla)
@@ -91,63 +119,336 @@ class hlaPredCache(dict):
                     """Only want to warn about missing predictions, not invalid peptides"""
                     #print 'Invalid peptide %s, returning nan' % (peptide)
                 val = np.nan
+                kind = 'invalid'
             else:
                 try:
                     val = dict.__getitem__(self, (hla, peptide))
+                    kind = 'hits'
                 except KeyError:
                     if self.warn:
                         print('HLA prediction not found (%s,%s), returning nan' % (hla, peptide))
                     val = np.nan
+                    kind = 'misses'
+                    if not self.missQueue is None and not (self.useRand or useRand):
+                        self.missQueue[(hla, peptide)] = None
+            if not self.lookupStats is None and not (self.useRand or useRand):
+                """Permuted lookups are not counted (as in hlaStoreCache)"""
+                self.lookupStats.record(hla, peptide, kind, fallback=(kind == 'hits'))
         return val
+    def getMany(self, hlas, peptides, cross=False):
+        """Look up many predictions in one pass.
+
+        Parameters
+        ----------
+        hlas : list
+            HLA alleles in the format A*0201 or A_0201
+        peptides : list
+            Peptides paired with hlas (or crossed with them, see cross)
+        cross : bool
+            If False, hlas and peptides are paired sequences of equal length.
+            If True, look up every (hla, peptide) combination.
+
+        Returns
+        -------
+        ic50 : ndarray float
+            Log-IC50 with nan for missing predictions and invalid peptides.
+            Shape [len(hlas), len(peptides)] if cross, otherwise [len(hlas)]
+        missing : ndarray bool
+            True for each pair without a prediction (same shape as ic50)"""
+        if cross:
+            shape = (len(hlas), len(peptides))
+        else:
+            if not len(hlas) == len(peptides):
+                raise ValueError('hlas and peptides must have the same length (or use cross=True)')
+            shape = (len(hlas),)
+        if self.useRand:
+            if cross:
+                pairHLAs, pairPeptides = [h for h in hlas for p in peptides], [p for h in hlas for p in peptides]
+            else:
+                pairHLAs, pairPeptides = hlas, peptides
+            ic50 = self._lookupMany(pairHLAs, self._permutePeptides(pairHLAs, pairPeptides), cross=False)
+        else:
+            ic50 = self._lookupMany(hlas, peptides, cross)
+        missing = np.isnan(ic50)
+        if not self.lookupStats is None and not self.useRand:
+            self.lookupStats.recordMany([self.repAsteriskPattern.sub('_', h) for h in hlas], list(peptides),
+                                        missing.reshape(shape), ['*' in h for h in hlas], cross)
+        if not self.missQueue is None and missing.any() and not self.useRand:
+            pairs = itertools.product(hlas, peptides) if cross else zip(hlas, peptides)
+            self.missQueue.update(((self.repAsteriskPattern.sub('_', h), p), None) for (h, p), m in zip(pairs, missing) if m and isvalidmer(p))
+        if self.warn and missing.any():
+            self._warnMissing(hlas, peptides, missing.reshape(shape), cross)
+        return ic50.reshape(shape), missing.reshape(shape)
+    def _lookupMany(self, hlas, peptides, cross):
+        """Flat float array of predictions for paired (or crossed) hlas and peptides"""
+        norm = {h:re.sub(self.repAsteriskPattern, '_', h) for h in set(hlas)}
+        get = dict.get
+        def _get(h, p):
+            val = get(self, (h, p))
+            if val is None:
+                val = get(self, (norm[h], p), np.nan)
+            return val
+        if cross:
+            pairs = itertools.product(hlas, peptides)
+            n = len(hlas) * len(peptides)
+        else:
+            pairs = zip(hlas, peptides)
+            n = len(hlas)
+        return np.fromiter((_get(h, p) for h, p in pairs), dtype=float, count=n)
+    def _warnMissing(self, hlas, peptides, missing, cross):
+        """Print one line summarizing missing predictions (not counting invalid peptides)"""
+        valid = np.array([isvalidmer(p) for p in peptides], dtype=bool)
+        if cross:
+            valid = np.tile(valid, (len(hlas), 1))
+        nMissing = (missing & valid).sum()
+        if nMissing > 0:
+            print('%d of %d HLA predictions not found, returning nan' % (nMissing, missing.size))
     def getRand(self, key):
         return self.getItem(key, useRand = True)
-    def permutePeptides(self, seed = None):
-        if not seed is None:
-            np.random.seed(seed)
+    def trackLookups(self, maxMissLog=10**5):
+        """Start counting lookups (getItem() and getMany()) by allele and peptide length,
+        and logging missed (hla, peptide) pairs (see LookupStats).
+        Returns the LookupStats object, also available as self.lookupStats."""
+        self.lookupStats = LookupStats(maxMissLog=maxMissLog)
+        return self.lookupStats
+    def _buildRandIndex(self):
+        """Index the alleles and peptides in the cache for the permutation null"""
         uPep = list({k[1] for k in list(self.keys())})
         uHLA = list({k[0] for k in list(self.keys())})
-        self.transMat = np.zeros((len(uPep), len(uHLA)), dtype = int)
-        for i in np.arange(len(uHLA)):
-            self.transMat[:, i] = np.random.permutation(np.arange(len(uPep), dtype = int))
         self.uPep = uPep
         self.uHLA = uHLA
+        self.uPepArr = np.array(uPep, dtype=object)
+        self.pepRandIndex = {p:i for i, p in enumerate(uPep)}
+        self.hlaRandIndex = {h:i for i, h in enumerate(uHLA)}
+    def permutePeptides(self, seed = None):
+        """Draw a new permutation null: for each allele, every peptide in the cache
+        is mapped to a random (distinct) peptide, whose prediction is returned by getRand()
+        and by lookups with useRand"""
+        if not seed is None:
+            np.random.seed(seed)
+        self._buildRandIndex()
+        self.transMat = np.zeros((len(self.uPep), len(self.uHLA)), dtype = int)
+        for i in np.arange(len(self.uHLA)):
+            self.transMat[:, i] = np.random.permutation(np.arange(len(self.uPep), dtype = int))
+    def _permuteKey(self, key):
+        hla, pep = key
+        hla = self.repAsteriskPattern.sub('_', hla)
+        return (hla, self.uPep[self.transMat[self.pepRandIndex[pep], self.hlaRandIndex[hla]]])
+    def _permutePeptides(self, hlas, peptides):
+        """Permuted peptide for each of the paired hlas and peptides (None if not in the permutation)"""
+        pi = np.fromiter((self.pepRandIndex.get(p, -1) for p in peptides), dtype=np.int64, count=len(peptides))
+        hi = np.fromiter((self.hlaRandIndex.get(self.repAsteriskPattern.sub('_', h), -1) for h in hlas), dtype=np.int64, count=len(hlas))
+        ok = (pi >= 0) & (hi >= 0)
+        out = np.full(len(peptides), None, dtype=object)
+        out[ok] = self.uPepArr[self.transMat[pi[ok], hi[ok]]]
+        return out.tolist()
+    def _nullPeptides(self):
+        """Distinct peptides in the cache for permutationNulls(), collected again
+        whenever the cache has changed size since they were collected"""
+        if not getattr(self, '_nullPeptidesSize', None) == len(self):
+            self._nullPeptidesArr = np.array(sorted({k[1] for k in list(self.keys())}), dtype=object)
+            self._nullPeptidesSize = len(self)
+        return self._nullPeptidesArr
+    def permutationNulls(self, hlas, peptides, B=100, seed=None):
+        """Predictions under B independent permutation nulls, drawn and looked up in one batch.
+
+        In each null, every allele maps the (distinct) query peptides to distinct
+        random peptides from the cache, as permutePeptides() does, so a statistic can be
+        computed over all B nulls at once (e.g. along axis 0) instead of
+        re-permuting and looking up B times.
+
+        Parameters
+        ----------
+        hlas : list
+        peptides : list
+            Query peptides, crossed with hlas.
+        B : int
+            Number of permutations.
+        seed : int or None
+            Seed for np.random.default_rng
+
+        Returns
+        -------
+        ic50 : ndarray float [B, len(hlas), len(peptides)]"""
+        rng = np.random.default_rng(seed)
+        nullPeptides = self._nullPeptides()
+        hlas = list(hlas)
+        uPeptides, inv = np.unique(np.array(peptides, dtype=object), return_inverse=True)
+        nPep, k = nullPeptides.shape[0], uPeptides.shape[0]
+        if k > nPep:
+            raise ValueError('More distinct query peptides (%d) than peptides in the cache (%d)' % (k, nPep))
+        """Sample with replacement, then redraw the few rows that have a repeated peptide"""
+        ind = rng.integers(0, nPep, size=(B * len(hlas), k))
+        srt = np.sort(ind, axis=1)
+        for i in np.nonzero((srt[:, 1:] == srt[:, :-1]).any(axis=1))[0]:
+            ind[i] = rng.choice(nPep, size=k, replace=False)
+        permuted = nullPeptides[ind[:, inv.ravel()]].ravel().tolist()
+        hlaPairs = [h for b in range(B) for h in hlas for p in peptides]
+        ic50 = self._lookupMany(hlaPairs, permuted, cross=False)
+        return ic50.reshape((B, len(hlas), len(peptides)))
 
     def __setitem__(self, key, val):
-        dict.__setitem__(self, key, val)
+        """Journaled like addPredictionValues() (unpickling sets the items before the attributes)"""
+        if getattr(self, 'journal', None) is None:
+            dict.__setitem__(self, key, val)
+        else:
+            self._update([key[0]], [key[1]], [val])
+    def update(self, other=(), **kwargs):
+        """Add predictions from a dict or iterable of ((hla, peptide), value) items
+        (journaled as one batch, like addPredictionValues())"""
+        if self.journal is None:
+            dict.update(self, other, **kwargs)
+            return
+        if hasattr(other, 'items'):
+            other = other.items()
+        items = list(other) + list(kwargs.items())
+        if len(items) > 0:
+            keys, values = list(zip(*items))
+            self._update([k[0] for k in keys], [k[1] for k in keys], values)
+    def planPredictions(self, hlas, peptides, kmers=[8, 9, 10, 11, 12, 13, 14, 15]):
+        """Plan the predictor runs needed to fill in exactly the missing (hla, peptide) pairs.
+
+        Missing pairs are found in one batched lookup. Within each peptide length,
+        alleles that are missing the same set of peptides share one batch, so each batch
+        is a rectangle of alleles x peptides that contains only missing pairs, and every
+        allele is run at most once per peptide length (the predictor is invoked once
+        per allele in a batch, see iedbPredict()).
+        Invalid peptides and peptides with a length not in kmers are skipped.
+
+        Returns
+        -------
+        batches : list of (hlas, peptides) tuples
+            Pass each to iedbPredict()
+        nInvocations : int
+            Number of predictor invocations needed to run all batches.
+        nPairs : int
+            Number of missing (hla, peptide) predictions that will be computed."""
+        hlas = list(dict.fromkeys(hlas))
+        peptides = [m for m in dict.fromkeys(peptides) if isvalidmer(m) and len(m) in kmers]
+        if len(hlas) == 0 or len(peptides) == 0:
+            return [], 0, 0
+        missing = np.isnan(self._lookupMany(hlas, peptides, cross=True).reshape((len(hlas), len(peptides))))
+        return _planBatches(hlas, peptides, missing)
     def addPredictions(self, method, hlas, peptides, cpus=1, verbose=False):
         """Run all neccessary predictions and add results to the cache without updating existing predictions
-        Will batch peptides of each length.
+        Only the missing (hla, peptide) pairs are predicted, batched by peptide length (see planPredictions()).
         Will attempt to remove invalid peptides.
         Returns number of predictions added (counting only those that were new to the cache)"""
+        return self._runPlan(method, self.planPredictions(hlas, peptides), cpus=cpus, verbose=verbose)
+    def _runPlan(self, method, plan, cpus=1, verbose=False):
+        """Run the batches of a plan from planPredictions() and add the results to the cache"""
+        self._checkWritable()
         if self.predictionMethod == '':
             self.predictionMethod = method
         if not method == self.predictionMethod:
             print('METHOD does not match existing method name for this cache')
 
-        neededHLAs = set()
-        neededPeptides = set()
-        for h, pep in itertools.product(hlas, peptides):
-            if (h, pep) not in self:
-                neededHLAs.add(h)
-                neededPeptides.add(pep)
-
-        hlas = list(neededHLAs)
-        """Remove bad peptides"""
-        mers = [m for m in neededPeptides if isvalidmer(m)]
-
-        kmers = {k: [m for m in mers if len(m)==k] for k in [8, 9, 10, 11, 12, 13, 14, 15]}
-
-        for k in list(kmers.keys()):
-            nAdded = 0
-            if len(hlas) > 0 and len(kmers[k]) > 0:
-                resDf = iedbPredict(method, hlas, kmers[k], cpus=cpus, verbose=verbose)
-                self.update({(re.sub(self.repAsteriskPattern, '_', h), p):v for h, p, v in zip(resDf['hla'], resDf['peptide'], resDf['pred'])})
-                nAdded += resDf.shape[0]
+        batches, nInvocations, nPairs = plan
+        if verbose:
+            print('Predicting %d missing HLA:peptide pairs in %d batches (%d predictor invocations)' % (nPairs, len(batches), nInvocations))
+
+        """Tag the batches with the predictor build if the cache keeps fingerprints"""
+        fingerprint = iedbFingerprint(method) if self._keepsFingerprints() else None
+        nAdded = 0
+        for batchHLAs, batchPeptides in batches:
+            resDf = iedbPredict(method, batchHLAs, batchPeptides, cpus=cpus, verbose=verbose)
+            self._update([re.sub(self.repAsteriskPattern, '_', h) for h in resDf['hla']], resDf['peptide'], resDf['pred'],
+                         cores=resDf['core'] if 'core' in resDf else None, fingerprint=fingerprint)
+            nAdded += resDf.shape[0]
         return nAdded
+    def ensure(self, hlas, peptides, method=None, cpus=1, verbose=False):
+        """Preflight: predict any missing (hla, peptide) combinations before a pass over them
+        (e.g. rankEpitopes(), which substitutes 15 for missing predictions).
+        Uses the cache's predictionMethod unless method is given.
+        Returns the number of predictions added."""
+        return self.addPredictions(self._backfillMethod(method), hlas, peptides, cpus=cpus, verbose=verbose)
+    def deferMisses(self, enable=True):
+        """Start (or stop) queueing the (hla, peptide) pairs of lookups that miss,
+        so they can all be predicted in one batched backfill() after a pass"""
+        if enable:
+            if self.missQueue is None:
+                self.missQueue = OrderedDict()
+        else:
+            self.missQueue = None
+    def backfill(self, method=None, cpus=1, verbose=False):
+        """Predict the queued misses (see deferMisses()) that are still missing,
+        grouped into batches by allele and peptide length (see planPredictions()),
+        and clear the queue. Only the queued pairs are predicted.
+        Uses the cache's predictionMethod unless method is given.
+        Returns the number of predictions added."""
+        if self.missQueue is None or len(self.missQueue) == 0:
+            return 0
+        method = self._backfillMethod(method)
+        pairs = list(self.missQueue.keys())
+        hlas = list(dict.fromkeys([h for h, p in pairs]))
+        peptides = list(dict.fromkeys([p for h, p in pairs]))
+        hlaIndex = {h:i for i, h in enumerate(hlas)}
+        pepIndex = {p:j for j, p in enumerate(peptides)}
+        queued = np.zeros((len(hlas), len(peptides)), dtype=bool)
+        stillMissing = np.isnan(self._lookupMany([h for h, p in pairs], [p for h, p in pairs], cross=False))
+        for (h, p), m in zip(pairs, stillMissing):
+            queued[hlaIndex[h], pepIndex[p]] = m
+        nAdded = self._runPlan(method, _planBatches(hlas, peptides, queued), cpus=cpus, verbose=verbose)
+        self.missQueue.clear()
+        return nAdded
+    def _backfillMethod(self, method):
+        if method is None:
+            method = self.predictionMethod
+        if method == '':
+            raise ValueError('No prediction method: pass method or set predictionMethod')
+        return method
     def addPredictionValues(self, hlas, peptides, values):
         """Add predictions as hla, peptide and values without running any predictor
         (basically just a dict update)"""
-        self.update({(re.sub(self.repAsteriskPattern, '_', h), p):v for h, p, v in zip(hlas, peptides, values)})
+        self._update([re.sub(self.repAsteriskPattern, '_', h) for h in hlas], peptides, values)
+    def _update(self, hlas, peptides, values, cores=None, fingerprint=None):
+        """Store paired sequences of (already normalized) alleles, peptides and values,
+        first recording them as one batch in the journal (if one is open).
+        Binding cores and the predictor fingerprint are kept if the cache keeps them
+        (see _keepsCores() and _keepsFingerprints()), but are not journaled."""
+        if not self.journal is None:
+            hlas, peptides, values = list(hlas), list(peptides), list(values)
+            self.journal.append(hlas, peptides, values)
+        self._updateStore(hlas, peptides, values, cores, fingerprint)
+    def _checkWritable(self):
+        """Raise TypeError if predictions can't be added (the dict cache always takes them)"""
+        pass
+    def _keepsCores(self):
+        """The dict cache only stores values"""
+        return False
+    def _keepsFingerprints(self):
+        return False
+    def _updateStore(self, hlas, peptides, values, cores=None, fingerprint=None):
+        dict.update(self, {(h, p):v for h, p, v in zip(hlas, peptides, values)})
+    def openJournal(self, fn, sync=True):
+        """Replay the batches in journal fn into the cache, then append every
+        new batch of predictions (addPredictions, addPredictionValues, addFromFile,
+        update and item assignment) to it.
+
+        Persisting new predictions then costs one append per batch instead of
+        a full dumpToFile(), and a crash loses at most the batch being written.
+        Use compact() to merge the journal into a snapshot.
+
+        Returns the number of predictions replayed from the journal."""
+        self._checkWritable()
+        journal = PredictionJournal(fn, sync=sync)
+        nReplayed = 0
+        for hlas, peptides, values in journal.batches():
+            self._updateStore(hlas, peptides, values)
+            nReplayed += len(hlas)
+        self.journal = journal
+        return nReplayed
+    def closeJournal(self):
+        if not self.journal is None:
+            self.journal.close()
+            self.journal = None
+    def compact(self, snapshotFn, background=False):
+        """Merge the journal into the snapshot snapshotFn (see loadSnapshot()), leaving an empty journal.
+        The cache itself is not touched, so with background=True this runs in a thread
+        (which is returned) while the cache keeps serving and journaling predictions."""
+        if self.journal is None:
+            raise ValueError('No journal is open (see openJournal())')
+        return compactJournal(self.journal, snapshotFn, meta=dict(name=self.name, predictionMethod=self.predictionMethod), background=background)
     def dumpToFile(self, fn):
         with open(fn, 'w') as fh:
             for k, v in self.items():
@@ -155,27 +456,630 @@ class hlaPredCache(dict):
     def addFromFile(self, fn):
         """Add predictions from a file: hla,peptide,prediction
         Returns number of predictions added (all those in file w/o checking for duplicates)"""
-        predDf = pd.read_csv(fn, names = ['hla', 'peptide', 'pred'], header = None)
-        self.update({(h, p):v for h, p, v in zip(predDf['hla'], predDf['peptide'], predDf['pred'])})
-        return predDf.shape[0]
-    def slice(self, hlas, peptides):
+        nAdded = 0
+        for hlas, peptides, values in readPredictionChunks(fn, fmt='pairs'):
+            self._update(hlas, peptides, values)
+            nAdded += len(hlas)
+        return nAdded
+    def saveParquet(self, fn, rowGroupSize=2**20, hlasPerGroup=8):
+        """Write all predictions to a Parquet file (requires pyarrow) with dictionary-encoded
+        allele and peptide columns that can be read back, or filtered by allele and peptide
+        length while reading, with loadParquet() or addFromParquet() (see parquetio.py)"""
+        writeParquet(self._toArrayStore(), fn, meta=dict(name=self.name, predictionMethod=self.predictionMethod),
+                     rowGroupSize=rowGroupSize, hlasPerGroup=hlasPerGroup)
+    def addFromParquet(self, fn, hlas=None, lengths=None):
+        """Add predictions from a Parquet file written by saveParquet(), optionally only those
+        for some alleles and peptide lengths (row groups of other alleles and lengths are skipped).
+        Returns number of predictions added (counting only those that were new to the cache)"""
+        nBefore = len(self)
+        if not hlas is None:
+            hlas = [self.repAsteriskPattern.sub('_', h) for h in hlas]
+        for chunk in readParquetChunks(fn, hlas=hlas, lengths=lengths, fingerprints=self._keepsFingerprints()):
+            if self._keepsFingerprints():
+                hlaChunk, peptides, values, fingerprints = chunk
+                for f in dict.fromkeys(fingerprints):
+                    ind = np.nonzero(fingerprints == f)[0]
+                    self._update(hlaChunk[ind], peptides[ind], values[ind], fingerprint=f)
+            else:
+                self._update(*chunk)
+        return len(self) - nBefore
+    def merge(self, caches, policy='keep_existing', batchSize=2**16):
+        """Merge the predictions of other caches into this cache.
+
+        Each cache is streamed in batches (blocks of peptide rows for an ArrayStore)
+        that are compared with this cache and written in one lookup and one update each
+        (see merge.py), so merging never builds a copy of a cache.
+        Binding cores are not merged.
+
+        Parameters
+        ----------
+        caches : list of hlaPredCache
+        policy : str
+            How to resolve a conflict: a pair with different predictions in this cache
+            and a merged cache (equal up to quantization and float32 rounding is no conflict).
+            'keep_existing' keeps the prediction already in the cache (or of the first merged cache),
+            'overwrite' takes the prediction of the cache merged last (like dict.update),
+            'min' keeps the lowest prediction (the strongest predicted binding),
+            'error' raises a ValueError, after checking all caches and before merging any.
+        batchSize : int
+            Peptide rows (or items for a dict-based cache) per batch.
+
+        Returns
+        -------
+        nAdded : int
+            Number of predictions that were new to this cache.
+        nConflicts : int
+            Number of conflicts that were found."""
+        if not policy in POLICIES:
+            raise ValueError('policy must be one of %s (got %s)' % (', '.join(POLICIES), policy))
+        self._checkWritable()
+        caches = list(caches)
+        if policy == 'error':
+            nConflicts = self._countConflicts(caches, batchSize)
+            if nConflicts > 0:
+                raise ValueError('Found %d conflicting predictions, nothing was merged' % nConflicts)
+        nAdded, nConflicts = 0, 0
+        for ba in caches:
+            tolerance = maxError(self) + maxError(ba)
+            for batch in self._sourceBatches(ba, batchSize):
+                added, conflicts = self._mergeBatch(batch, policy, tolerance)
+                nAdded += added
+                nConflicts += conflicts
+        return nAdded, nConflicts
+    def _countConflicts(self, caches, batchSize):
+        """Number of pairs of the caches with a different prediction in this cache or an earlier cache"""
+        nConflicts = 0
+        for i, ba in enumerate(caches):
+            for batch in self._sourceBatches(ba, batchSize):
+                conflict = np.zeros(batch[4].shape[0], dtype=bool)
+                for other in [self] + caches[:i]:
+                    conflict |= mergeMask(other._lookupBatch(batch), batch[4], 'error', maxError(other) + maxError(ba))[1]
+                nConflicts += int(conflict.sum())
+        return nConflicts
+    def _sourceBatches(self, ba, batchSize):
+        """Coded batches of cache ba with alleles normalized to the key format (A_0201),
+        since a source such as a dict or a slice() can hold keys like A*0201"""
+        for batch in ba._mergeBatches(batchSize):
+            hlaNames = np.asarray([self.repAsteriskPattern.sub('_', h) for h in batch[0]], dtype=object)
+            yield (hlaNames,) + tuple(batch[1:])
+    def _mergeBatches(self, batchSize):
+        """Coded batches of all predictions (see merge.py)"""
+        return itemBatches(self.items(), batchSize)
+    def _lookupBatch(self, batch):
+        """Predictions for the pairs of a coded batch"""
+        hlaNames, hlaCodes, pepNames, pepCodes = batch[:4]
+        return self._lookupMany(list(hlaNames[hlaCodes]), list(pepNames[pepCodes]), cross=False)
+    def _mergeBatch(self, batch, policy, tolerance):
+        """Merge a coded batch, returns the number of new predictions and of conflicts"""
+        hlaNames, hlaCodes, pepNames, pepCodes, values, fpNames, fpCodes = batch
+        existing = self._lookupBatch(batch)
+        write, conflict = mergeMask(existing, values, policy, tolerance)
+        ind = np.nonzero(write)[0]
+        if self._keepsFingerprints() and not fpNames is None:
+            for code in np.unique(fpCodes[ind]):
+                sub = ind[fpCodes[ind] == code]
+                self._update(list(hlaNames[hlaCodes[sub]]), list(pepNames[pepCodes[sub]]), values[sub],
+                             fingerprint=fpNames[code] if code >= 0 else None)
+        elif ind.shape[0] > 0:
+            self._update(list(hlaNames[hlaCodes[ind]]), list(pepNames[pepCodes[ind]]), values[ind])
+        return int((write & np.isnan(existing)).sum()), int(conflict.sum())
+    def _toArrayStore(self, quantize=None):
+        """Return an ArrayStore with all the predictions in the cache"""
+        store = ArrayStore(quantize=bool(quantize))
+        items = list(self.items())
+        store.setMany([k[0] for k, v in items], [k[1] for k, v in items], [v for k, v in items])
+        return store
+    def saveSnapshot(self, fn, quantize=None):
+        """Write all predictions to a binary snapshot file that can be
+        memory-mapped by loadSnapshot() (values are stored as float32,
+        or as uint16 codes with quantize=True, see ArrayStore).
+        quantize=None keeps the representation of an ArrayStore-backed cache."""
+        writeSnapshot(self._toArrayStore(quantize), fn, meta=dict(name=self.name, predictionMethod=self.predictionMethod))
+    def saveShards(self, path, quantize=None):
+        """Write all predictions to a directory with one snapshot file per allele
+        that can be loaded allele by allele with loadShards() (see saveSnapshot() for quantize)"""
+        writeShards(self._toArrayStore(quantize), path, meta=dict(name=self.name, predictionMethod=self.predictionMethod))
+    def shareMemory(self, name=None, quantize=None):
+        """Publish all predictions to a multiprocessing.shared_memory block that workers
+        can attach to with attachShared(shm.name), see saveSnapshot() for quantize.
+
+        Returns the SharedMemory block: the calling process owns it and should call
+        shm.close() and shm.unlink() once the workers are done.
+        Workers that attach to a block published again by this cache detach from the older ones."""
+        return publishStore(self._toArrayStore(quantize), name=name, meta=dict(name=self.name, predictionMethod=self.predictionMethod),
+                            publisher='%d-%d' % (os.getpid(), id(self)))
+    def slice(self, hlas, peptides, view=False):
         """Return a new hlaPredCache() with a subset of the predictions,
-        identified by hlas and peptides"""
+        identified by hlas and peptides (all combinations are looked up in one batch,
+        missing ones are stored as nan and reported in one summary line if warn).
+        view=True (a zero-copy view) requires an hlaStoreCache."""
+        if view:
+            raise ValueError('slice(..., view=True) requires an hlaStoreCache')
+        hlas, peptides = list(hlas), list(peptides)
+        ic50, missing = self.getMany(hlas, peptides, cross=True)
         out = hlaPredCache(warn = self.warn)
-        out.update({(h, pep):self[(h, pep)] for h, pep in itertools.product(hlas, peptides)})
+        out.update(zip(itertools.product(hlas, peptides), ic50.ravel().tolist()))
         return out
 
+class hlaStoreCache(hlaPredCache):
+    """hlaPredCache with predictions held in a storage backend instead of in the dict itself.
+
+    The default backend is an ArrayStore (allele x peptide float32 matrix),
+    which uses a small fraction of the memory of the dict-based cache.
+    Lookups have the same semantics as hlaPredCache: * in the HLA is converted to _,
+    invalid peptides and missing predictions return nan (missing ones with a warning).
+
+    Values are stored as float32, so they match the loaded values to ~7 significant digits.
+
+    With a CoreStore (e.g. for class II 15-mers) the binding core of each prediction is
+    kept as well and can be looked up with getWithCore() and getManyWithCore().
+
+    With a VersionedStore each batch of predictions is tagged with the fingerprint of the
+    predictor build that made it (see predict.iedbFingerprint()), so lookups can be limited
+    to compatible builds (requireFingerprints()) and stale predictions deleted (invalidate())."""
+    def __init__(self, baseFn=None, kmers=[8, 9, 10, 11], warn=True, oldFile=False, useRand=False, newFile=False, store=None, chunkSize=2**18, cpus=1):
+        if store is None:
+            store = ArrayStore()
+        if isinstance(store, MethodStore) and store.method == '' and not baseFn is None:
+            """Load the files as predictions of the method named by their suffix (like predictionMethod)"""
+            store.method = baseFn.split('.')[-1]
+        self.store = store
+        hlaPredCache.__init__(self, baseFn=baseFn, kmers=kmers, warn=warn, oldFile=oldFile, useRand=useRand, newFile=newFile, chunkSize=chunkSize, cpus=cpus)
+        if isinstance(store, MethodStore) and not store.method == '':
+            self.predictionMethod = store.method
+    def getItem(self, key, useRand = False):
+        """Returns the requested prediction.
+        Warns for missing (hla,mer) keys before returning nan
+            (can be suppressed with self.warn = False)
+
+        Does not warn for invalid peptides, returns nan"""
+        if self.useRand or useRand:
+            key = self._permuteKey(key)
+        hla, peptide = key
+        hla = self.repAsteriskPattern.sub('_', hla)
+        val = self.store.get(hla, peptide)
+        if np.isnan(val) and self.warn and isvalidmer(peptide):
+            print('HLA prediction not found (%s,%s), returning nan' % (hla, peptide))
+        if not self.lookupStats is None and not (self.useRand or useRand):
+            if not np.isnan(val):
+                self.lookupStats.record(hla, peptide, 'hits', fallback=not hla == key[0])
+            else:
+                self.lookupStats.record(hla, peptide, 'misses' if isvalidmer(peptide) else 'invalid')
+        if not self.missQueue is None and np.isnan(val) and not (self.useRand or useRand) and isvalidmer(peptide):
+            self.missQueue[(hla, peptide)] = None
+        return val
+    def _lookupMany(self, hlas, peptides, cross):
+        if cross:
+            return self.store.getCross([self.repAsteriskPattern.sub('_', h) for h in hlas], peptides).ravel()
+        else:
+            norm = {h:self.repAsteriskPattern.sub('_', h) for h in set(hlas)}
+            return self.store.getMany([norm[h] for h in hlas], peptides)
+    def __setitem__(self, key, val):
+        self._update([self.repAsteriskPattern.sub('_', key[0])], [key[1]], [val])
+    def __reduce_ex__(self, protocol):
+        """Pickle the attributes (including the store, which pickles just its name if it is in
+        shared memory) instead of every prediction as a dict item"""
+        return copyreg.__newobj__, (type(self),), self.__dict__.copy()
+    def _checkWritable(self):
+        """A store attached to shared memory (see attachShared()) is read-only in every process"""
+        store = self.store.store if isinstance(self.store, MethodStore) else self.store
+        shm = getattr(store, 'sharedMemory', None)
+        if not shm is None:
+            raise TypeError('Cache is attached to shared memory block %s and read-only (use slice() for a writable copy)' % shm.name)
+    def _keepsCores(self):
+        return isinstance(self.store, CoreStore)
+    def _keepsFingerprints(self):
+        return isinstance(self.store, VersionedStore)
+    def _updateStore(self, hlas, peptides, values, cores=None, fingerprint=None):
+        self._checkWritable()
+        if self._keepsCores():
+            self.store.setMany(list(hlas), list(peptides), np.asarray(values, dtype=float), cores=cores)
+        elif self._keepsFingerprints():
+            self.store.setMany(list(hlas), list(peptides), np.asarray(values, dtype=float), fingerprint=fingerprint)
+        else:
+            self.store.setMany(list(hlas), list(peptides), np.asarray(values, dtype=float))
+    def getWithCore(self, key):
+        """Returns (prediction, binding core) for one (hla, peptide) key,
+        with the same semantics as getItem() and None for an unknown core (requires a CoreStore)"""
+        if not self._keepsCores():
+            raise ValueError('getWithCore() requires an hlaStoreCache backed by a CoreStore')
+        val = self.getItem(key)
+        return val, self.store.getCores([self.repAsteriskPattern.sub('_', key[0])], [key[1]])[0]
+    def getManyWithCore(self, hlas, peptides):
+        """Look up predictions and binding cores for paired sequences of hlas and peptides
+        in one pass (see getMany(), requires a CoreStore)
+
+        Returns
+        -------
+        ic50 : ndarray float
+            Log-IC50 with nan for missing predictions and invalid peptides.
+        cores : ndarray object
+            Binding core of each prediction (None if unknown)"""
+        if not self._keepsCores():
+            raise ValueError('getManyWithCore() requires an hlaStoreCache backed by a CoreStore')
+        ic50, missing = self.getMany(hlas, peptides)
+        norm = {h:self.repAsteriskPattern.sub('_', h) for h in set(hlas)}
+        return ic50, self.store.getCores([norm[h] for h in hlas], list(peptides))
+    def update(self, other=(), **kwargs):
+        """Add predictions from a dict or iterable of ((hla, peptide), value) items"""
+        if hasattr(other, 'items'):
+            other = other.items()
+        items = list(other) + list(kwargs.items())
+        if len(items) > 0:
+            keys, values = list(zip(*items))
+            self._update([self.repAsteriskPattern.sub('_', k[0]) for k in keys], [k[1] for k in keys], values)
+    def get(self, key, default=None):
+        val = self.store.get(self.repAsteriskPattern.sub('_', key[0]), key[1])
+        return default if np.isnan(val) else val
+    def __contains__(self, key):
+        return not np.isnan(self.store.get(self.repAsteriskPattern.sub('_', key[0]), key[1]))
+    def __len__(self):
+        return len(self.store)
+    def __iter__(self):
+        return self.keys()
+    def keys(self):
+        return (k for k, v in self.store.iterItems())
+    def values(self):
+        return (v for k, v in self.store.iterItems())
+    def items(self):
+        return self.store.iterItems()
+    def preload(self, hlas):
+        """Load predictions for these alleles now, for stores that load them lazily (e.g. ShardedStore)"""
+        if hasattr(self.store, 'preload'):
+            self.store.preload([self.repAsteriskPattern.sub('_', h) for h in hlas])
+    def _toArrayStore(self, quantize=None):
+        """With a MethodStore this is the shared store with all methods
+        (a VersionedStore is returned as is, so snapshots keep the fingerprints)"""
+        store = self.store.store if isinstance(self.store, MethodStore) else self.store
+        if isinstance(store, VersionedStore) and not store.accepted is None:
+            """Copy just the accepted predictions"""
+            return hlaPredCache._toArrayStore(self, quantize)
+        if isinstance(store, (ArrayStore, VersionedStore)) and (quantize is None or store.quantized == quantize):
+            return store
+        return hlaPredCache._toArrayStore(self, quantize)
+    def saveShards(self, path, quantize=None):
+        """Write all predictions to a directory with one snapshot file per allele
+        that can be loaded allele by allele with loadShards() (see saveSnapshot() for quantize).
+        With a MethodStore only the predictions of this cache's method are written."""
+        if isinstance(self.store, MethodStore):
+            store = hlaPredCache._toArrayStore(self, quantize)
+        else:
+            store = self._toArrayStore(quantize)
+        writeShards(store, path, meta=dict(name=self.name, predictionMethod=self.predictionMethod))
+    def requireFingerprints(self, fingerprints=None):
+        """Treat predictions made by other predictor builds than fingerprints (e.g. the
+        compatible versions, see predict.iedbFingerprint()) as missing, so that lookups
+        return nan for them and addPredictions(), ensure() and backfill() re-predict just
+        those pairs. fingerprints=None accepts all predictions again (requires a VersionedStore)"""
+        if not self._keepsFingerprints():
+            raise ValueError('requireFingerprints() requires an hlaStoreCache backed by a VersionedStore')
+        self.store.require(fingerprints)
+    def invalidate(self, fingerprints=None, keep=None):
+        """Delete the predictions made by the predictor builds in fingerprints, or by
+        builds not in keep (see VersionedStore.invalidate()). Returns the number deleted."""
+        if not self._keepsFingerprints():
+            raise ValueError('invalidate() requires an hlaStoreCache backed by a VersionedStore')
+        self._checkWritable()
+        return self.store.invalidate(fingerprints=fingerprints, keep=keep)
+    def saveParquet(self, fn, rowGroupSize=2**20, hlasPerGroup=8):
+        """Write all predictions to a Parquet file (see hlaPredCache.saveParquet()).
+        With a MethodStore only the predictions of this cache's method are written,
+        with a VersionedStore the fingerprint of each prediction is written as well."""
+        if isinstance(self.store, MethodStore):
+            store = hlaPredCache._toArrayStore(self)
+        else:
+            store = self._toArrayStore()
+        writeParquet(store, fn, meta=dict(name=self.name, predictionMethod=self.predictionMethod),
+                     rowGroupSize=rowGroupSize, hlasPerGroup=hlasPerGroup)
+    def addFromParquet(self, fn, hlas=None, lengths=None):
+        """Same as hlaPredCache.addFromParquet(). Unless a journal is open, predictions
+        are scattered into an ArrayStore or VersionedStore by their dictionary codes
+        (see parquetio.readParquet()) instead of being added pair by pair.
+        A CoreStore takes the pair path, which clears the cores of overwritten predictions."""
+        if not self.journal is None or not isinstance(self.store, (ArrayStore, VersionedStore)) or self._keepsCores():
+            return hlaPredCache.addFromParquet(self, fn, hlas=hlas, lengths=lengths)
+        self._checkWritable()
+        nBefore = len(self)
+        if not hlas is None:
+            hlas = [self.repAsteriskPattern.sub('_', h) for h in hlas]
+        readParquet(fn, store=self.store, hlas=hlas, lengths=lengths)
+        return len(self) - nBefore
+    def _arrayStore(self):
+        """True if the store can be merged into at the array level"""
+        return isinstance(self.store, (ArrayStore, VersionedStore))
+    def _mergeBatches(self, batchSize):
+        if self._arrayStore():
+            return storeBatches(self.store, batchSize)
+        return hlaPredCache._mergeBatches(self, batchSize)
+    def _lookupBatch(self, batch):
+        if not self._arrayStore():
+            return hlaPredCache._lookupBatch(self, batch)
+        hlaNames, hlaCodes, pepNames, pepCodes = batch[:4]
+        return self.store.gather(self.store.peptideIndices(list(pepNames))[pepCodes], self.store.hlaIndices(list(hlaNames))[hlaCodes])
+    def _mergeBatch(self, batch, policy, tolerance):
+        """Unless a journal is open, add the alleles and peptides of the batch to the
+        store and scatter the selected values by their indices"""
+        if not self.journal is None or not self._arrayStore():
+            return hlaPredCache._mergeBatch(self, batch, policy, tolerance)
+        hlaNames, hlaCodes, pepNames, pepCodes, values, fpNames, fpCodes = batch
+        cols = self.store.addHLAs(list(hlaNames))[hlaCodes]
+        rows = self.store.addPeptides(list(pepNames))[pepCodes]
+        existing = self.store.gather(rows, cols)
+        write, conflict = mergeMask(existing, values, policy, tolerance)
+        ind = np.nonzero(write)[0]
+        if self._keepsFingerprints():
+            codes = np.full(values.shape[0], -1) if fpNames is None else fpCodes
+            for code in np.unique(codes[ind]):
+                sub = ind[codes[ind] == code]
+                self.store.scatter(rows[sub], cols[sub], values[sub], fingerprint=fpNames[code] if code >= 0 else None)
+        else:
+            self.store.scatter(rows[ind], cols[ind], values[ind])
+            if self._keepsCores():
+                """Merged values have no binding core"""
+                self.store.scatterOffsets(rows[ind], cols[ind], np.full(ind.shape[0], -1))
+        return int((write & np.isnan(existing)).sum()), int(conflict.sum())
+    @property
+    def methods(self):
+        """Prediction methods in the cache (with a MethodStore, otherwise just predictionMethod)"""
+        if isinstance(self.store, MethodStore):
+            return self.store.methods
+        return [self.predictionMethod]
+    def _checkJournalMethod(self, method):
+        """Journal batches have no method (they are replayed into this cache's method),
+        so predictions of another method can't be journaled"""
+        if not self.journal is None:
+            raise ValueError('Cannot add %s predictions while a journal of %s predictions is open (see closeJournal())' % (method, self.store.method))
+    def forMethod(self, method):
+        """Return an hlaStoreCache of the predictions of another method, sharing the
+        allele and peptide indexes and values with this cache (requires a MethodStore).
+        It has no journal, lookup stats or miss queue of its own."""
+        if not isinstance(self.store, MethodStore):
+            raise ValueError('forMethod() requires an hlaStoreCache backed by a MethodStore')
+        out = hlaStoreCache(warn = self.warn, store = self.store.forMethod(method))
+        out.name = self.name
+        out.predictionMethod = method
+        return out
+    def loadMethod(self, method, baseFn, kmers=[8, 9, 10, 11], oldFile=False, newFile=False, chunkSize=2**18, cpus=1):
+        """Load the baseFn.k.out prediction files of another method into the shared store
+        and return the hlaStoreCache of that method (see forMethod())"""
+        self._checkJournalMethod(method)
+        out = self.forMethod(method)
+        fmt = 'old' if oldFile else ('new' if newFile else 'default')
+        fileList = ['%s.%d.out' % (baseFn, k) for k in kmers]
+        for hlas, peptides, values in readPredictionFiles(fileList, fmt=fmt, chunkSize=chunkSize, cpus=cpus):
+            out._update(hlas, peptides, values)
+        return out
+    def getMethods(self, hlas, peptides, methods=None, cross=False):
+        """Predictions of several methods (all methods in the store if None)
+        for paired (or crossed, see getMany()) hlas and peptides.
+
+        Returns
+        -------
+        ic50 : ndarray float
+            [len(methods), ...] with the shape of getMany() for each method"""
+        if not isinstance(self.store, MethodStore):
+            raise ValueError('getMethods() requires an hlaStoreCache backed by a MethodStore')
+        if methods is None:
+            methods = self.methods
+        if not cross and not len(hlas) == len(peptides):
+            raise ValueError('hlas and peptides must have the same length (or use cross=True)')
+        return self.store.getMethods(methods, [self.repAsteriskPattern.sub('_', h) for h in hlas], list(peptides), cross=cross)
+    def addPredictions(self, method, hlas, peptides, cpus=1, verbose=False):
+        """Same as hlaPredCache.addPredictions(), except that with a MethodStore
+        predictions of another method are added to that method instead of to this cache"""
+        if isinstance(self.store, MethodStore) and not method == self.store.method:
+            self._checkJournalMethod(method)
+            return self.forMethod(method).addPredictions(method, hlas, peptides, cpus=cpus, verbose=verbose)
+        return hlaPredCache.addPredictions(self, method, hlas, peptides, cpus=cpus, verbose=verbose)
+    def slice(self, hlas, peptides, view=False):
+        """Return a new hlaStoreCache() with a subset of the predictions,
+        identified by hlas and peptides.
+
+        The predictions are selected in one batched lookup (getCross) and
+        missing pairs are reported in one summary line (if warn).
+        With view=True the slice is a read-only SliceStore over this cache's
+        store instead of a copy, so nothing is copied and later updates are visible."""
+        hlas = [self.repAsteriskPattern.sub('_', h) for h in hlas]
+        peptides = list(peptides)
+        if view:
+            return hlaStoreCache(warn = self.warn, store = SliceStore(self.store, hlas, peptides))
+        ic50, missing = self.getMany(hlas, peptides, cross=True)
+        if self._keepsCores():
+            store = CoreStore(quantize=self.store.quantized, coreLength=self.store.coreLength)
+        else:
+            store = ArrayStore(quantize=getattr(self.store, 'quantized', False))
+        cols = store.addHLAs(hlas)
+        rows = store.addPeptides(peptides)
+        hi, pj = np.nonzero(~missing)
+        store.scatter(rows[pj], cols[hi], ic50[hi, pj])
+        if self._keepsCores():
+            store.scatterOffsets(rows[pj], cols[hi], self.store.getOffsets([hlas[i] for i in hi], [peptides[j] for j in pj]))
+        return hlaStoreCache(warn = self.warn, store = store)
+
+class hlaConcurrentCache(hlaStoreCache):
+    """hlaStoreCache that can be shared by the threads of a service, backed by a ConcurrentStore:
+    lookups (getItem, getMany) never lock and each batch of new predictions
+    (addPredictions, addPredictionValues, update) becomes visible to readers atomically.
+
+    Lookup counting (trackLookups) and deferred misses (deferMisses) are not thread-safe,
+    and threads that call addPredictions() for the same missing pairs at the same time may
+    both predict them (the results are the same). For random predictions use
+    RandCache(seed=...), which stores nothing (the dict-based RandCache stores predictions on read)."""
+    def __init__(self, baseFn=None, kmers=[8, 9, 10, 11], warn=True, oldFile=False, useRand=False, newFile=False, store=None, chunkSize=2**18, cpus=1):
+        if store is None:
+            store = ConcurrentStore()
+        hlaStoreCache.__init__(self, baseFn=baseFn, kmers=kmers, warn=warn, oldFile=oldFile, useRand=useRand, newFile=newFile,
+                               store=store, chunkSize=chunkSize, cpus=cpus)
+
+class hlaCacheClient(hlaStoreCache):
+    """hlaPredCache interface to the cache of a CacheServer process on the same node (see server.py),
+    so several pipelines can share one copy of the cache.
+
+    Each lookup or update is a request to the server: use getMany() (one request per batch)
+    rather than one getItem() per pair where possible. Predictions (addPredictions, ensure,
+    backfill) are planned here and run in the server, which merges the requests of all
+    its clients so that pairs requested by several clients are predicted once.
+
+    Parameters
+    ----------
+    address : str or tuple
+        Unix socket path or (host, port) of the server.
+    authkey : bytes
+        Key of the server (CacheServer.authkey)
+    warn : bool
+        Warn for missing predictions."""
+    def __init__(self, address, authkey, warn=True):
+        hlaStoreCache.__init__(self, warn=warn, store=RemoteStore(address, authkey=authkey))
+        info = self.store.info()
+        self.name = info['name']
+        self.predictionMethod = info['predictionMethod']
+    def _runPlan(self, method, plan, cpus=1, verbose=False):
+        """Send the batches of the plan to the server. Returns the number of pairs it predicted
+        (pairs predicted in the meantime for another client are not counted)"""
+        batches, nInvocations, nPairs = plan
+        if verbose:
+            print('Requesting %d missing HLA:peptide pairs in %d batches from the cache server' % (nPairs, len(batches)))
+        if len(batches) == 0:
+            return 0
+        return self.store.predict(method, batches)
+    def close(self):
+        self.store.close()
+
+def loadSnapshot(fn, mmap=True, warn=True):
+    """Load an hlaStoreCache from a snapshot written by saveSnapshot().
+
+    With mmap=True the file is memory-mapped: loading takes milliseconds regardless
+    of the size of the cache and pages are read from disk as predictions are accessed.
+    The cache can still be updated (copy-on-write), but changes are not written back to the file.
+
+    Parameters
+    ----------
+    fn : str
+        Snapshot filename.
+    mmap : bool
+        Memory-map the file instead of reading it into memory.
+    warn : bool
+        Warn for missing predictions.
+
+    Returns
+    -------
+    ba : hlaStoreCache"""
+    store, meta = readSnapshot(fn, mmap=mmap)
+    return _cacheFromStore(store, meta, warn)
+
+def _cacheFromStore(store, meta, warn):
+    """hlaStoreCache on a store read from a snapshot, with the name and method in meta"""
+    if len(store.hlas) > 0 and isinstance(store.hlas[0], tuple):
+        """Multi-method snapshot: open the view of the method that was saved (or the first one)"""
+        store = MethodStore(store)
+        method = meta.get('predictionMethod', '')
+        store.method = method if method in store.methods else store.methods[0]
+        meta['predictionMethod'] = store.method
+    ba = hlaStoreCache(warn=warn, store=store)
+    ba.name = meta.get('name', '')
+    ba.predictionMethod = meta.get('predictionMethod', '')
+    return ba
+
+def loadParquet(fn, hlas=None, lengths=None, warn=True):
+    """Load an hlaStoreCache from a Parquet file written by saveParquet() (requires pyarrow).
+
+    Only the row groups that can hold predictions for the requested alleles and
+    peptide lengths are read (see parquetio.py).
+
+    Parameters
+    ----------
+    fn : str
+        Parquet filename.
+    hlas : list or None
+        Only load predictions for these alleles.
+    lengths : list or None
+        Only load predictions for peptides of these lengths.
+    warn : bool
+        Warn for missing predictions.
+
+    Returns
+    -------
+    ba : hlaStoreCache (backed by a VersionedStore if the file has fingerprints)"""
+    if not hlas is None:
+        hlas = [h.replace('*', '_') for h in hlas]
+    store, meta = readParquet(fn, hlas=hlas, lengths=lengths)
+    return _cacheFromStore(store, meta, warn)
+
+def attachShared(name, warn=True):
+    """Attach to a cache published to shared memory with shareMemory() (e.g. in a pool worker).
+
+    The predictions are read in place from the shared block: attaching takes
+    milliseconds and all attached processes share one copy of the cache.
+    The cache is read-only (adding predictions raises TypeError in every process)
+    and is pickled as the block name, so it can also simply be passed to the workers
+    (see sharedstore.py).
+
+    Parameters
+    ----------
+    name : str
+        Name of the shared memory block (shm.name of the block returned by shareMemory())
+    warn : bool
+        Warn for missing predictions.
+
+    Returns
+    -------
+    ba : hlaStoreCache"""
+    store, meta = attachStore(name)
+    return _cacheFromStore(store, dict(meta), warn)
+
+def detachShared(name):
+    """Detach this process from a cache in shared memory attached with attachShared()
+    (see sharedstore.detachStore()): the block is unmapped once no cache uses it."""
+    return detachStore(name)
+
+def loadShards(path, mmap=True, warn=True):
+    """Open an hlaStoreCache on a shard directory written by saveShards().
+
+    Only the manifest is read: the predictions for each allele are loaded the
+    first time that allele is looked up, or with ba.preload(hlas).
+    New predictions are written to the directory with ba.store.save()
+
+    Parameters
+    ----------
+    path : str
+        Shard directory.
+    mmap : bool
+        Memory-map the shard files instead of reading them into memory.
+    warn : bool
+        Warn for missing predictions.
+
+    Returns
+    -------
+    ba : hlaStoreCache"""
+    store = ShardedStore(path, mmap=mmap)
+    ba = hlaStoreCache(warn=warn, store=store)
+    ba.name = store.meta.get('name', '')
+    ba.predictionMethod = store.meta.get('predictionMethod', '')
+    return ba
+
 class RandCache(dict):
     """Starts as an empty hlaPredCache.
     As predictions are requested, random predictions are added to the cache.
     The effect is that you have random consistent/repeatable predictions.
     
     Good for testing code without actual predictions and for generating null
-    distributions (i.e. "noisy predictor null")"""
+    distributions (i.e. "noisy predictor null")
 
-    def __init__(self):
+    With a seed the cache is stateless: each prediction is derived from a hash
+    of (hla, peptide, seed) instead of being drawn and stored, so nothing is stored,
+    batches are generated with a few numpy operations and every process
+    with the same seed gets the same predictions.
+    Both modes draw from the same distribution: |11 - Exponential(scale=1.5)|
+
+    Parameters
+    ----------
+    seed : int or None
+        Seed for the stateless, hash-based mode (None for the dict-based mode)"""
+
+    def __init__(self, seed=None):
         dict.__init__(self)
-        self.repAsteriskPattern = re.compile('\*')
+        self.repAsteriskPattern = re.compile(r'\*')
+        self.seed = seed
 
         self.predictionMethod = 'random'
         self.name = 'RandCache'
@@ -189,6 +1093,8 @@ class RandCache(dict):
         return self.getItem(key)
     def getItem(self, key, useRand = False):
         """Returns the requested prediction."""
+        if not self.seed is None:
+            return float(self._hashPredictions([key[0]], [key[1]])[0])
         try:
             """First, try to get the prediction"""
             val = dict.__getitem__(self, key)
@@ -204,8 +1110,39 @@ class RandCache(dict):
                     dict.__setitem__(self, (hla, peptide), self._generateNewPrediction())
                     val = dict.__getitem__(self, (hla, peptide))
         return val
-    def _generateNewPrediction(self):
-        return np.abs(11 - stats.expon.rvs(0, 1.5, size = 1))[0]
+    def _generateNewPrediction(self, size=None):
+        if size is None:
+            return np.abs(11 - stats.expon.rvs(0, 1.5, size = 1))[0]
+        return np.abs(11 - stats.expon.rvs(0, 1.5, size = size))
+    def _hashPredictions(self, hlas, peptides):
+        """Stateless predictions for paired hlas and peptides (nan for invalid peptides)"""
+        norm = {h:self.repAsteriskPattern.sub('_', h) for h in set(hlas)}
+        hlas = [norm[h] for h in hlas]
+        codes = encodePeptides(peptides)
+        """Top 53 bits of the hash as a uniform in [0, 1), through the inverse CDF of the exponential"""
+        u = (hashPairs(hlas, peptides, self.seed, codes=codes) >> np.uint64(11)).astype(float) * 2.**-53
+        out = np.abs(11 + 1.5 * np.log1p(-u))
+        """Encodable peptides are valid, only check the others"""
+        for i in np.nonzero(codes == 0)[0]:
+            if not isvalidmer(peptides[i]):
+                out[i] = np.nan
+        return out
+    def getMany(self, hlas, peptides, cross=False):
+        """Same as hlaPredCache.getMany(), generating random predictions as needed
+        (all new predictions of a batch are drawn at once)"""
+        if cross:
+            shape = (len(hlas), len(peptides))
+            hlas, peptides = [h for h in hlas for p in peptides], [p for h in hlas for p in peptides]
+        else:
+            shape = (len(hlas),)
+        if not self.seed is None:
+            ic50 = self._hashPredictions(hlas, peptides).reshape(shape)
+            return ic50, np.isnan(ic50)
+        keys = [(self.repAsteriskPattern.sub('_', h), p) for h, p in zip(hlas, peptides)]
+        new = list({k for k in keys if not k in self and isvalidmer(k[1])})
+        self.update(zip(new, self._generateNewPrediction(size = len(new)).tolist()))
+        ic50 = np.array([dict.get(self, k, np.nan) for k in keys], dtype=float).reshape(shape)
+        return ic50, np.isnan(ic50)
     def getRand(self, key):
         """Here to preserve the interface, but does nothing functionally different"""
         return self.getItem(key, useRand = False)
@@ -0,0 +1,130 @@
+import threading
+import numpy as np
+
+from .store import ArrayStore
+
+__all__ = ['ConcurrentStore']
+
+def _lookupSegments(segments, hlas, peptides):
+    """Paired lookups in a tuple of segments, newest first (nan if no segment has the pair)"""
+    out = np.full(len(hlas), np.nan)
+    todo = np.arange(len(hlas))
+    for seg in reversed(segments):
+        if todo.shape[0] == 0:
+            break
+        if todo.shape[0] == len(hlas):
+            vals = seg.getMany(hlas, peptides)
+        else:
+            vals = seg.getMany([hlas[i] for i in todo], [peptides[i] for i in todo])
+        found = ~np.isnan(vals)
+        out[todo[found]] = vals[found]
+        todo = todo[~found]
+    return out
+
+def _segmentItems(seg):
+    """All predictions of a segment as paired (hlas, peptides, values)"""
+    vals = seg.decode(seg.rowValues(np.arange(seg.nPeptides)))
+    r, c = np.nonzero(~np.isnan(vals))
+    return [seg.hlas[i] for i in c], seg.peptideAt(r), vals[r, c]
+
+class ConcurrentStore(object):
+    """Thread-safe store with lock-free reads and batched copy-on-write writes.
+
+    Predictions live in a tuple of immutable ArrayStore segments. Readers take a
+    reference to the current tuple (one atomic attribute read) and look pairs up in
+    the segments from newest to oldest, without any locking. Each write (setMany)
+    builds a new segment from its batch and publishes a new tuple under a lock, so a
+    reader sees either all or none of a batch and never a partially updated array.
+
+    To keep lookups to a few segments, the newest segments are merged (like the
+    levels of a log-structured merge tree) whenever a segment is at most mergeFactor
+    times larger than the one after it, so there are O(log n) segments and each
+    prediction is copied O(log n) times. Merges run in the writer and never block readers.
+
+    Implements the same store interface as ArrayStore, so it can back an hlaStoreCache
+    (see hlaConcurrentCache). nan values are not stored (a write can't delete a prediction).
+
+    Parameters
+    ----------
+    quantize : bool
+        Store values as uint16 codes instead of float32 (see ArrayStore).
+    mergeFactor : int
+        Merge the two newest segments while the older is at most mergeFactor times larger."""
+    def __init__(self, quantize=False, mergeFactor=2):
+        self.quantized = quantize
+        self.mergeFactor = mergeFactor
+        self.segments = ()
+        self.lock = threading.Lock()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def hlas(self):
+        return list(dict.fromkeys([h for seg in self.segments for h in seg.hlas]))
+
+    @property
+    def nbytes(self):
+        return int(np.sum([seg.nbytes + seg.pepIndex.nbytes for seg in self.segments]))
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        for seg in reversed(self.segments):
+            val = seg.get(hla, peptide)
+            if not np.isnan(val):
+                return val
+        return np.nan
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs)"""
+        return _lookupSegments(self.segments, list(hlas), list(peptides))
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        out = np.full((len(hlas), len(peptides)), np.nan)
+        for seg in reversed(self.segments):
+            todo = np.isnan(out)
+            if not todo.any():
+                break
+            vals = seg.getCross(hlas, peptides)
+            out[todo] = vals[todo]
+        return out
+
+    def setMany(self, hlas, peptides, values):
+        """Store predictions for paired sequences of alleles, peptides and values
+        as one atomic batch. Existing values are overwritten (like dict.update)"""
+        values = np.asarray(values, dtype=float)
+        keep = np.nonzero(~np.isnan(values))[0]
+        if keep.shape[0] == 0:
+            return
+        seg = ArrayStore(quantize=self.quantized)
+        seg.setMany([hlas[i] for i in keep], [peptides[i] for i in keep], values[keep])
+        uHLAs, uPeptides = _segmentItems(seg)[:2]
+        with self.lock:
+            segments = self.segments
+            self._count += int(np.isnan(_lookupSegments(segments, uHLAs, uPeptides)).sum())
+            self.segments = self._compact(segments + (seg,))
+
+    def _compact(self, segments):
+        """Merge the newest segments until each is more than mergeFactor times larger than the next"""
+        segments = list(segments)
+        while len(segments) > 1 and len(segments[-2]) <= self.mergeFactor * len(segments[-1]):
+            newer = segments.pop()
+            older = segments.pop()
+            merged = ArrayStore(quantize=self.quantized)
+            merged.setMany(*_segmentItems(older))
+            merged.setMany(*_segmentItems(newer))
+            segments.append(merged)
+        return tuple(segments)
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all stored predictions
+        (of the segments published when iteration started)"""
+        seen = set()
+        for seg in reversed(self.segments):
+            for k, v in seg.iterItems():
+                if not k in seen:
+                    seen.add(k)
+                    yield k, v
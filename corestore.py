@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+from .store import ArrayStore
+
+__all__ = ['CoreStore',
+           'coreOffsets']
+
+"""Offset marking a prediction without a (known) binding core"""
+NOCORE = -1
+
+def coreOffsets(peptides, cores, coreLength=9):
+    """Vectorized offset of each binding core in its peptide (e.g. 0-6 for the 9-mer core of a 15-mer).
+
+    Returns an int8 array with NOCORE (-1) where the core is missing (None/nan),
+    does not have coreLength residues or is not a substring of the peptide
+    (e.g. class I cores with insertions or deletions)."""
+    cores = np.asarray(cores, dtype=object)
+    cores = np.where(pd.isnull(cores), '', cores).astype(str)
+    peptides = np.asarray(peptides, dtype=object).astype(str)
+    if cores.shape[0] == 0:
+        return np.zeros(0, dtype=np.int8)
+    offsets = np.char.find(peptides, cores)
+    offsets[(np.char.str_len(cores) != coreLength) | (offsets > np.iinfo(np.int8).max)] = NOCORE
+    return offsets.astype(np.int8)
+
+class CoreStore(ArrayStore):
+    """ArrayStore for class II predictions (e.g. 15-mers from DRB alleles) that also keeps
+    the binding core of each prediction.
+
+    The core is stored as its int8 offset into the peptide (the core of peptide p
+    at offset o is p[o:o + coreLength]) in blocks parallel to the value blocks,
+    so it adds 1 byte per (hla, peptide) cell instead of a 9 character string.
+    Together with the table of long peptides in PeptideIndex (see encoding.py)
+    this makes class II panels about as compact as class I ones.
+
+    Values are set and looked up as in ArrayStore, cores with setMany(..., cores=cores),
+    getOffsets() and getCores(). Setting a value without a core clears its core.
+
+    Parameters
+    ----------
+    coreLength : int
+        Length of the binding core.
+    (see ArrayStore for the other parameters)"""
+    def __init__(self, blockSize=2**12, hlaCapacity=8, quantize=False, valueRange=(0., 16.), coreLength=9):
+        ArrayStore.__init__(self, blockSize=blockSize, hlaCapacity=hlaCapacity, quantize=quantize, valueRange=valueRange)
+        self.coreLength = coreLength
+        self.coreBlocks = []
+
+    @property
+    def nbytes(self):
+        """Bytes used by the value and core blocks (excludes the index dicts)"""
+        return ArrayStore.nbytes.fget(self) + int(np.sum([b.nbytes for b in self.coreBlocks]))
+
+    def setMany(self, hlas, peptides, values, cores=None):
+        """Store predictions for paired sequences of alleles, peptides, values and
+        binding cores (core strings, None/nan for unknown cores).
+        Existing values and cores are overwritten (like dict.update)"""
+        cols = self.addHLAs(hlas)
+        rows = self.addPeptides(peptides)
+        self.scatter(rows, cols, values)
+        if cores is None:
+            offsets = np.full(rows.shape[0], NOCORE, dtype=np.int8)
+        else:
+            offsets = coreOffsets(peptides, cores, self.coreLength)
+        self.scatterOffsets(rows, cols, offsets)
+
+    def scatterOffsets(self, rows, cols, offsets):
+        """Assign core offsets at paired row/column indices, which must already exist"""
+        offsets = np.asarray(offsets, dtype=np.int8)
+        for b, ind in self._byBlock(rows, np.arange(rows.shape[0])):
+            self.coreBlocks[b][rows[ind] - b * self.blockSize, cols[ind]] = offsets[ind]
+
+    def gatherOffsets(self, rows, cols):
+        """Return core offsets for paired row/column indices (NOCORE where either index is -1)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        out = np.full(rows.shape[0], NOCORE, dtype=np.int8)
+        ok = np.nonzero((rows >= 0) & (cols >= 0))[0]
+        for b, ind in self._byBlock(rows[ok], ok):
+            out[ind] = self.coreBlocks[b][rows[ind] - b * self.blockSize, cols[ind]]
+        return out
+
+    def getOffsets(self, hlas, peptides):
+        """Return core offsets for paired sequences of alleles and peptides (NOCORE if unknown)"""
+        return self.gatherOffsets(self.peptideIndices(peptides), self.hlaIndices(hlas))
+
+    def getCores(self, hlas, peptides):
+        """Return binding cores for paired sequences of alleles and peptides
+        as an object array of str (None if unknown)"""
+        L = self.coreLength
+        out = np.empty(len(peptides), dtype=object)
+        out[:] = [p[o:o + L] if o >= 0 else None for p, o in zip(peptides, self.getOffsets(hlas, peptides).tolist())]
+        return out
+
+    def rowOffsets(self, rows):
+        """Return a [len(rows), nHLA] matrix of core offsets for all alleles of the given peptide rows"""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((rows.shape[0], len(self.hlas)), dtype=np.int8)
+        for b, ind in self._byBlock(rows, np.arange(rows.shape[0])):
+            out[ind, :] = self.coreBlocks[b][rows[ind] - b * self.blockSize, :len(self.hlas)]
+        return out
+
+    def freeze(self, peptides, values, count=None, cores=None):
+        """Same as ArrayStore.freeze(), with an optional [nPeptides, nHLA] int8 matrix of core offsets"""
+        ArrayStore.freeze(self, peptides, values, count=count)
+        if cores is None:
+            self.coreBlocks = []
+            self._syncCores()
+        else:
+            self.coreBlocks = [cores[i:i + self.blockSize] for i in range(0, cores.shape[0], self.blockSize)]
+
+    def _syncCores(self):
+        """Give each value block a core block of the same shape"""
+        for i, b in enumerate(self.blocks):
+            if i == len(self.coreBlocks):
+                self.coreBlocks.append(np.full(b.shape, NOCORE, dtype=np.int8))
+            elif not self.coreBlocks[i].shape == b.shape:
+                c = self.coreBlocks[i]
+                tmp = np.full(b.shape, NOCORE, dtype=np.int8)
+                tmp[:c.shape[0], :c.shape[1]] = c
+                self.coreBlocks[i] = tmp
+
+    def _reserveColumns(self, nCols):
+        ArrayStore._reserveColumns(self, nCols)
+        self._syncCores()
+
+    def _reserveRows(self, nRows):
+        ArrayStore._reserveRows(self, nRows)
+        self._syncCores()
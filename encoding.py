@@ -0,0 +1,306 @@
+"""
+Compact integer encoding of peptides.
+
+Peptides of 1-12 residues from the 20 letter AALPHABET are packed into a uint64:
+the top 4 bits hold the length and each residue takes 5 bits (its index in AALPHABET),
+left-aligned below the length. Sorting codes therefore sorts peptides by length
+and then alphabetically (in AALPHABET order), and the length of each peptide
+is available as code >> 60.
+
+Code 0 is reserved for peptides that can't be encoded (longer than 12 residues
+or containing characters outside AALPHABET, e.g. X or -).
+
+Longer peptides over AALPHABET (e.g. class II 15-mers) don't fit in 64 bits:
+PeptideIndex keeps them in a sorted table of fixed-width bytes instead (see longPeptideMask())."""
+
+import hashlib
+import numpy as np
+
+from .helpers import AALPHABET
+
+__all__ = ['MAXLENGTH',
+           'encodePeptide',
+           'encodePeptides',
+           'decodePeptides',
+           'codeLengths',
+           'longPeptideMask',
+           'hashPairs',
+           'PeptideIndex']
+
+MAXLENGTH = 12
+_SHIFTS = np.array([5 * (MAXLENGTH - 1 - i) for i in range(MAXLENGTH)], dtype=np.uint64)
+_AAINDEX = {aa:i for i, aa in enumerate(AALPHABET)}
+_LOOKUP = np.full(256, 255, dtype=np.uint8)
+for i, aa in enumerate(AALPHABET):
+    _LOOKUP[ord(aa)] = i
+"""rowCodes below this are positions of long peptides (see PeptideIndex)"""
+_LONGLIMIT = np.uint64(1) << np.uint64(60)
+_LETTERS = np.frombuffer(AALPHABET.encode(), dtype=np.uint8)
+
+def encodePeptide(peptide):
+    """Return the uint64 code (as an int) for one peptide, 0 if it can't be encoded"""
+    L = len(peptide)
+    if L == 0 or L > MAXLENGTH:
+        return 0
+    code = 0
+    try:
+        for aa in peptide:
+            code = (code << 5) | _AAINDEX[aa]
+    except KeyError:
+        return 0
+    return (L << 60) | (code << (5 * (MAXLENGTH - L)))
+
+def encodePeptides(peptides):
+    """Vectorized encoding of a sequence of peptides (str or bytes) into a uint64 array
+    (0 for peptides that can't be encoded)"""
+    arr = np.asarray(peptides, dtype=bytes)
+    n = arr.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=np.uint64)
+    width = arr.dtype.itemsize
+    lengths = np.char.str_len(arr)
+    chars = arr.view(np.uint8).reshape((n, width))[:, :MAXLENGTH]
+    idx = _LOOKUP[chars]
+    inPeptide = np.arange(chars.shape[1])[None, :] < lengths[:, None]
+    valid = (lengths > 0) & (lengths <= MAXLENGTH) & ~((idx == 255) & inPeptide).any(axis=1)
+    idx = np.where(inPeptide, idx, 0).astype(np.uint64)
+    codes = (idx << _SHIFTS[None, :chars.shape[1]]).sum(axis=1, dtype=np.uint64)
+    codes |= lengths.astype(np.uint64) << np.uint64(60)
+    codes[~valid] = 0
+    return codes
+
+def codeLengths(codes):
+    """Peptide length of each code"""
+    return (np.asarray(codes, dtype=np.uint64) >> np.uint64(60)).astype(np.int64)
+
+def decodePeptides(codes):
+    """Vectorized decoding of uint64 codes into a fixed-width bytes array (b'' for code 0)"""
+    codes = np.asarray(codes, dtype=np.uint64)
+    n = codes.shape[0]
+    idx = ((codes[:, None] >> _SHIFTS[None, :]) & np.uint64(31)).astype(np.intp)
+    chars = _LETTERS[np.minimum(idx, len(AALPHABET) - 1)]
+    chars[np.arange(MAXLENGTH)[None, :] >= codeLengths(codes)[:, None]] = 0
+    return np.ascontiguousarray(chars).view('S%d' % MAXLENGTH).reshape(n)
+
+def longPeptideMask(peptides):
+    """Vectorized test for peptides longer than MAXLENGTH with all residues in AALPHABET
+    (those that PeptideIndex keeps in its table of long peptides)"""
+    arr = np.asarray(peptides, dtype=bytes)
+    n = arr.shape[0]
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    lengths = np.char.str_len(arr)
+    chars = arr.view(np.uint8).reshape((n, arr.dtype.itemsize))
+    inPeptide = np.arange(chars.shape[1])[None, :] < lengths[:, None]
+    return (lengths > MAXLENGTH) & ~((_LOOKUP[chars] == 255) & inPeptide).any(axis=1)
+
+def _mergeSorted(sortedKeys, sortedRows, pending, keys, rows):
+    """Merge pending and new (sorted, unique) keys into sorted arrays of keys and rows.
+    Returns the new sorted arrays."""
+    if len(pending) > 0:
+        pendingKeys = np.array(list(pending.keys()), dtype=keys.dtype if keys.dtype.kind == 'u' else bytes)
+        keys = np.concatenate((keys, pendingKeys))
+        rows = np.concatenate((rows, np.fromiter(pending.values(), dtype=np.int64, count=len(pending))))
+        sorti = np.argsort(keys)
+        keys, rows = keys[sorti], rows[sorti]
+    """Widen the table (fixed-width bytes) before inserting longer keys"""
+    sortedKeys = sortedKeys.astype(np.promote_types(sortedKeys.dtype, keys.dtype), copy=False)
+    pos = sortedKeys.searchsorted(keys)
+    return np.insert(sortedKeys, pos, keys), np.insert(sortedRows, pos, rows)
+
+def _stringHash(s):
+    """Stable 64-bit hash of a string (the same in every process, unlike hash())"""
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), 'little')
+
+def _splitmix64(x):
+    """splitmix64 finalizer: mixes the bits of a uint64 array"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def hashPairs(hlas, peptides, seed=0, codes=None):
+    """Deterministic, well-mixed uint64 hash of each paired (hla, peptide) and seed.
+    Peptides are hashed through their codes (with a string hash for those that can't
+    be encoded), so whole arrays of pairs are hashed with a few numpy operations.
+    codes can be passed if the peptides were already encoded."""
+    hashes = {h:_stringHash(h) for h in set(hlas)}
+    hlaHash = np.fromiter((hashes[h] for h in hlas), dtype=np.uint64, count=len(hlas))
+    if codes is None:
+        codes = encodePeptides(peptides)
+    codes = codes.copy()
+    for i in np.nonzero(codes == 0)[0]:
+        codes[i] = _stringHash(str(peptides[i]))
+    with np.errstate(over='ignore'):
+        x = _splitmix64(codes ^ np.uint64(int(seed) & 0xFFFFFFFFFFFFFFFF))
+        return _splitmix64(x ^ hlaHash)
+
+class PeptideIndex(object):
+    """Maps peptides to consecutive integer rows, keyed by their uint64 codes.
+
+    Encodable peptides are kept in a sorted uint64 array (with the row of each code),
+    so lookups and insertions of whole arrays of peptides are vectorized
+    (encode, np.searchsorted, merge) and each peptide costs 24 bytes instead
+    of a Python string plus a dict slot. Small insertions go to a dict that is merged
+    into the sorted arrays once it grows.
+
+    Longer peptides over AALPHABET (e.g. class II 15-mers) are kept the same way in a
+    sorted table of fixed-width bytes, with rowCodes holding 1 + their position in
+    longPeptides (below 2**60, so never a valid code). Peptides that can't be
+    encoded at all (e.g. containing X) fall back to a dict."""
+    def __init__(self):
+        self.sortedCodes = np.zeros(0, dtype=np.uint64)
+        self.sortedRows = np.zeros(0, dtype=np.int64)
+        self.pending = {}
+        self.rowCodes = np.zeros(1024, dtype=np.uint64)
+        self.longSorted = np.empty(0, dtype='S1')
+        self.longSortedRows = np.zeros(0, dtype=np.int64)
+        self.longPending = {}
+        self.longPeptides = np.empty(0, dtype='S1')
+        self.nLong = 0
+        self.other = {}
+        self.otherPeptides = {}
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        return (self.sortedCodes.nbytes + self.sortedRows.nbytes + self.rowCodes.nbytes +
+                self.longSorted.nbytes + self.longSortedRows.nbytes + self.longPeptides.nbytes)
+
+    def get(self, peptide):
+        """Row for one peptide or -1"""
+        code = encodePeptide(peptide)
+        if code == 0:
+            if self.nLong > 0 and len(peptide) > MAXLENGTH:
+                row = int(self._longLookup(np.asarray([peptide], dtype=bytes))[0])
+                if row >= 0:
+                    return row
+            return self.other.get(peptide, -1)
+        code = np.uint64(code)
+        pos = self.sortedCodes.searchsorted(code)
+        if pos < self.sortedCodes.shape[0] and self.sortedCodes[pos] == code:
+            return int(self.sortedRows[pos])
+        return self.pending.get(int(code), -1)
+
+    def lookup(self, peptides, codes=None):
+        """Array of rows for peptides (-1 if not in the index)"""
+        if codes is None:
+            codes = encodePeptides(peptides)
+        rows = np.full(codes.shape[0], -1, dtype=np.int64)
+        enc = np.nonzero(codes != 0)[0]
+        if self.sortedCodes.shape[0] > 0 and enc.shape[0] > 0:
+            pos = self.sortedCodes.searchsorted(codes[enc])
+            pos[pos >= self.sortedCodes.shape[0]] = 0
+            found = self.sortedCodes[pos] == codes[enc]
+            rows[enc[found]] = self.sortedRows[pos[found]]
+        if len(self.pending) > 0:
+            for i in enc[rows[enc] < 0]:
+                rows[i] = self.pending.get(int(codes[i]), -1)
+        zero = np.nonzero(codes == 0)[0]
+        if self.nLong > 0 and zero.shape[0] > 0:
+            rows[zero] = self._longLookup(np.asarray([peptides[i] for i in zero], dtype=bytes))
+        if len(self.other) > 0:
+            for i in zero[rows[zero] < 0]:
+                rows[i] = self.other.get(peptides[i], -1)
+        return rows
+
+    def _longLookup(self, query):
+        """Rows of query (bytes array) in the table of long peptides, -1 if absent"""
+        rows = np.full(query.shape[0], -1, dtype=np.int64)
+        if self.longSorted.shape[0] > 0:
+            pos = self.longSorted.searchsorted(query)
+            pos[pos >= self.longSorted.shape[0]] = 0
+            found = self.longSorted[pos] == query
+            rows[found] = self.longSortedRows[pos[found]]
+        if len(self.longPending) > 0:
+            for i in np.nonzero(rows < 0)[0]:
+                rows[i] = self.longPending.get(bytes(query[i]), -1)
+        return rows
+
+    def add(self, peptides):
+        """Add peptides (if new) and return the array of their rows"""
+        codes = encodePeptides(peptides)
+        rows = self.lookup(peptides, codes)
+        new = np.nonzero((rows < 0) & (codes != 0))[0]
+        if new.shape[0] > 0:
+            uCodes, newRows = self._newRows(codes[new], rows, new)
+            self._appendRows(uCodes)
+            if len(self.pending) + uCodes.shape[0] < max(1024, self.sortedCodes.shape[0] // 16):
+                self.pending.update(zip(uCodes.tolist(), newRows.tolist()))
+            else:
+                self._merge(uCodes, newRows)
+        zero = np.nonzero((rows < 0) & (codes == 0))[0]
+        if zero.shape[0] > 0:
+            query = np.asarray([peptides[i] for i in zero], dtype=bytes)
+            long = longPeptideMask(query)
+            if long.any():
+                self._addLong(query[long], rows, zero[long])
+            for i in zero[~long]:
+                p = peptides[i]
+                row = self.other.get(p, -1)
+                if row < 0:
+                    row = self.other[p] = self.n
+                    self.otherPeptides[row] = p
+                    self._appendRows(np.zeros(1, dtype=np.uint64))
+                rows[i] = row
+        return rows
+
+    def _newRows(self, keys, rows, ind):
+        """Number the unique new keys (at positions ind of rows) in order of first appearance,
+        assign their rows and return (unique keys, rows) in that order"""
+        uKeys, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        newRows = np.empty(uKeys.shape[0], dtype=np.int64)
+        newRows[order] = self.n + np.arange(uKeys.shape[0], dtype=np.int64)
+        rows[ind] = newRows[inv.ravel()]
+        return uKeys[order], newRows[order]
+
+    def _addLong(self, query, rows, ind):
+        uLong, newRows = self._newRows(query, rows, ind)
+        k = uLong.shape[0]
+        if self.nLong + k > self.longPeptides.shape[0] or uLong.dtype.itemsize > self.longPeptides.dtype.itemsize:
+            dtype = np.promote_types(self.longPeptides.dtype, uLong.dtype)
+            tmp = np.zeros(max(self.nLong + k, 2 * self.longPeptides.shape[0]), dtype=dtype)
+            tmp[:self.nLong] = self.longPeptides[:self.nLong]
+            self.longPeptides = tmp
+        self.longPeptides[self.nLong:self.nLong + k] = uLong
+        self._appendRows(np.arange(self.nLong + 1, self.nLong + k + 1, dtype=np.uint64))
+        self.nLong += k
+        if len(self.longPending) + k < max(1024, self.longSorted.shape[0] // 16):
+            self.longPending.update(zip(uLong.tolist(), newRows.tolist()))
+        else:
+            sorti = np.argsort(uLong)
+            self.longSorted, self.longSortedRows = _mergeSorted(self.longSorted, self.longSortedRows, self.longPending,
+                                                                uLong[sorti], newRows[sorti])
+            self.longPending = {}
+
+    def peptides(self, rows):
+        """Peptide strings for an array of rows"""
+        rows = np.asarray(rows, dtype=np.int64)
+        codes = self.rowCodes[rows]
+        out = decodePeptides(codes).astype(str).tolist()
+        if self.nLong > 0:
+            ind = np.nonzero((codes > 0) & (codes < _LONGLIMIT))[0]
+            for i, p in zip(ind, self.longPeptides[(codes[ind] - np.uint64(1)).astype(np.int64)].astype(str).tolist()):
+                out[i] = p
+        if len(self.otherPeptides) > 0:
+            for i in np.nonzero(codes == 0)[0]:
+                out[i] = self.otherPeptides[rows[i]]
+        return out
+
+    def _appendRows(self, codes):
+        n = self.n + codes.shape[0]
+        if n > self.rowCodes.shape[0]:
+            tmp = np.zeros(max(n, 2 * self.rowCodes.shape[0]), dtype=np.uint64)
+            tmp[:self.n] = self.rowCodes[:self.n]
+            self.rowCodes = tmp
+        self.rowCodes[self.n:n] = codes
+        self.n = n
+
+    def _merge(self, codes, rows):
+        """Merge pending and new codes into the sorted arrays"""
+        sorti = np.argsort(codes)
+        self.sortedCodes, self.sortedRows = _mergeSorted(self.sortedCodes, self.sortedRows, self.pending, codes[sorti], rows[sorti])
+        self.pending = {}
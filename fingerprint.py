@@ -0,0 +1,40 @@
+"""
+Fingerprints of the predictor that produced a batch of predictions.
+
+A fingerprint is a short hex digest of the prediction method, the tool version
+and the contents of its model files, so predictions made by different builds
+of a predictor (e.g. netMHCpan 2.8 vs 4.0, or retrained IEDB data files) get
+different fingerprints even when the method name is the same.
+See VersionedStore for tagging stored predictions with fingerprints."""
+
+import os
+import hashlib
+
+__all__ = ['predictorFingerprint',
+           'fileDigest']
+
+def fileDigest(path, blockSize=2**20):
+    """Hex digest of the contents of a file, or of all files below a directory
+    (with their relative paths), or 'missing' if path doesn't exist"""
+    if not os.path.exists(path):
+        return 'missing'
+    h = hashlib.blake2b(digest_size=16)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, fn) for root, dirs, fns in os.walk(path) for fn in fns)
+    else:
+        files = [path]
+    for fn in files:
+        h.update(os.path.relpath(fn, path).encode())
+        with open(fn, 'rb') as fh:
+            for block in iter(lambda: fh.read(blockSize), b''):
+                h.update(block)
+    return h.hexdigest()
+
+def predictorFingerprint(method, version='', modelFiles=()):
+    """Fingerprint (16 hex characters) of a predictor: method name, tool version
+    and the contents of its model files or directories (see fileDigest())"""
+    h = hashlib.blake2b(digest_size=8)
+    h.update(('%s\n%s\n' % (method, version)).encode())
+    for fn in modelFiles:
+        h.update(('%s:%s\n' % (os.path.basename(os.path.normpath(fn)), fileDigest(fn))).encode())
+    return h.hexdigest()
@@ -79,15 +79,13 @@ def rankEpitopes(ba, hlaList, peptide, nmer = [8, 9, 10, 11], peptideLength = No
 
     merList = getMers(peptide, nmer, peptideLength)
     kmers = np.empty((len(merList), len(hlaList)), dtype=object)
-    ic50 = np.ones((len(merList), len(hlaList))) * 15
     hla = np.empty((len(merList), len(hlaList)), dtype=object)
     for i, m in enumerate(merList):
         for j, h in enumerate(hlaList):
             kmers[i, j] = m
             hla[i, j] = h
-            tmp = ba[(h, m)]
-            if not np.isnan(tmp):
-                ic50[i, j] = tmp
+    ic50 = _lookupCross(ba, hlaList, merList).T
+    ic50[np.isnan(ic50)] = 15
     kmers = kmers.flatten()
     ic50 = ic50.flatten()
     hla = hla.flatten()
@@ -167,8 +165,15 @@ def rankMers(ba, hlaList, merList):
 
     ic50 = np.ones((len(merList))) * 15
     hla = np.empty(len(merList), dtype=object)
+    """Look up all short mers at once, longer ones are broken into kmers by getIC50"""
+    shorti = [i for i, m in enumerate(merList) if not '.' in m and len(m) <= 11]
+    if len(shorti) > 0 and len(hlaList) > 0:
+        ic50s = _lookupCross(ba, hlaList, [merList[i] for i in shorti])
+        mini = np.argmin(ic50s, axis=0)
+        ic50[shorti] = ic50s[mini, np.arange(len(shorti))]
+        hla[shorti] = [hlaList[j] for j in mini]
     for i, m in enumerate(merList):
-        if not '.' in m:
+        if not '.' in m and len(m) > 11:
             ic50[i], hla[i] = getIC50(ba, hlaList, m, returnHLA=True)
     sorti = ic50.argsort()
     ranks = np.empty(len(ic50), dtype=int)
@@ -204,7 +209,7 @@ def getIC50(ba, hlaList, mer, nmer=[8, 9, 10, 11], returnHLA=False):
     
     if len(mer) <= 11:
         """Minimum IC50 over the HLAs"""
-        ic50s = np.asarray([ba[(h, mer)] for h in hlaList])
+        ic50s = _lookupCross(ba, hlaList, [mer])[:, 0]
         hlas = hlaList
     else:
         """Minimum IC50 over all the mers and all the HLAs"""
@@ -218,6 +223,14 @@ def getIC50(ba, hlaList, mer, nmer=[8, 9, 10, 11], returnHLA=False):
     else:
         return ic50s[mini]
 
+def _lookupCross(ba, hlaList, merList):
+    """Return an array [len(hlaList), len(merList)] of log-IC50 from ba (nan if missing)
+    using one batched getMany() call if ba supports it, otherwise key by key."""
+    if hasattr(ba, 'getMany'):
+        return ba.getMany(hlaList, merList, cross=True)[0]
+    else:
+        return np.array([[ba[(h, m)] for m in merList] for h in hlaList], dtype=float).reshape((len(hlaList), len(merList)))
+
 def getMers(seq, nmer=[8, 9, 10, 11], seqLength=None):
     """Takes a AA sequence (string) and turns it into a list of 8, 9, 10, 11 mers
     
@@ -15,9 +15,9 @@ __all__ = ['Prediction']
 class Prediction():
     """Class containing methods for using any IEDB method to predict MHC I binding affinity."""
     
-    def __init__(self):
+    def __init__(self, version='20130222'):
         self.row_data = []
-        self.version = '20130222'
+        self.version = version
         
     #TODO: needs to change 
     def read_protein(self, fname):
@@ -0,0 +1,169 @@
+"""
+Append-only journal of prediction batches with compaction into a snapshot.
+
+Each batch of new predictions is appended to the journal as one record:
+    4 byte magic b'HPJ1', uint32 payload length, uint32 crc32 of the payload,
+    payload of 'hla,peptide,value' lines (utf-8)
+and flushed (and by default fsync'ed) before it is applied to the cache.
+Reading stops at the first truncated or corrupt record, so a crash while
+writing loses at most the batch that was being written.
+
+Compaction merges the journal into a base snapshot (see snapshot.py) without
+touching the live cache: the journal is first rotated to a '.compacting' segment
+(new batches keep going to a fresh journal), then the base snapshot plus the
+segment are written to a new snapshot that atomically replaces the old one."""
+
+import os
+import struct
+import zlib
+import shutil
+import threading
+import numpy as np
+
+from .store import ArrayStore
+from .snapshot import writeSnapshot, readSnapshot
+
+__all__ = ['PredictionJournal',
+           'compactJournal']
+
+MAGIC = b'HPJ1'
+RECORD = struct.Struct('<4sII')
+
+def _encodeBatch(hlas, peptides, values):
+    return ''.join(['%s,%s,%r\n' % (h, p, float(v)) for h, p, v in zip(hlas, peptides, values)]).encode()
+
+def _decodeBatch(payload):
+    hlas, peptides, values = [], [], []
+    for line in payload.decode().splitlines():
+        h, p, v = line.split(',')
+        hlas.append(h)
+        peptides.append(p)
+        values.append(float(v))
+    return hlas, peptides, np.array(values, dtype=float)
+
+def readBatches(fn):
+    """Generator over complete (hlas, peptides, values) batches in a journal file.
+    The second value of each item is the file offset just after the batch."""
+    if not os.path.exists(fn):
+        return
+    with open(fn, 'rb') as fh:
+        while True:
+            head = fh.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            magic, length, crc = RECORD.unpack(head)
+            if not magic == MAGIC:
+                return
+            payload = fh.read(length)
+            if len(payload) < length or not zlib.crc32(payload) == crc:
+                return
+            yield _decodeBatch(payload), fh.tell()
+
+class PredictionJournal(object):
+    """Append-only file of prediction batches.
+
+    Parameters
+    ----------
+    fn : str
+        Journal filename (created if it does not exist). A partial record
+        at the end of an existing journal (from a crash) is discarded.
+    sync : bool
+        If True, fsync after each batch so it survives a crash of the machine,
+        not just of the process."""
+    def __init__(self, fn, sync=True):
+        self.fn = fn
+        self.segmentFn = fn + '.compacting'
+        self.sync = sync
+        self.lock = threading.Lock()
+        self.compactLock = threading.Lock()
+        end = 0
+        for batch, end in readBatches(fn):
+            pass
+        self.fh = open(fn, 'ab')
+        self.fh.truncate(end)
+
+    def append(self, hlas, peptides, values):
+        """Write one batch of predictions as a single record"""
+        payload = _encodeBatch(hlas, peptides, values)
+        record = RECORD.pack(MAGIC, len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            self.fh.write(record)
+            self.fh.flush()
+            if self.sync:
+                os.fsync(self.fh.fileno())
+
+    def batches(self):
+        """Generator over all (hlas, peptides, values) batches not yet compacted, oldest first"""
+        for fn in [self.segmentFn, self.fn]:
+            for batch, end in readBatches(fn):
+                yield batch
+
+    def rotate(self):
+        """Move the journal to the compaction segment and start a new, empty journal.
+        If a segment is left over from an interrupted compaction the journal is appended to it.
+        Returns the segment filename (if moving the journal fails, it stays open for appends)."""
+        with self.lock:
+            self.fh.close()
+            try:
+                if os.path.exists(self.segmentFn):
+                    with open(self.segmentFn, 'ab') as segFh, open(self.fn, 'rb') as fh:
+                        shutil.copyfileobj(fh, segFh)
+                    os.remove(self.fn)
+                else:
+                    os.replace(self.fn, self.segmentFn)
+            finally:
+                self.fh = open(self.fn, 'ab')
+        return self.segmentFn
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
+
+def compactJournal(journal, snapshotFn, meta={}, background=False):
+    """Merge all journaled batches into the snapshot file snapshotFn.
+
+    The live cache is not read or modified, and batches appended during
+    compaction stay in the journal for the next compaction.
+
+    Parameters
+    ----------
+    journal : PredictionJournal
+    snapshotFn : str
+        Base snapshot (created if it does not exist)
+    meta : dict
+        Snapshot metadata, used if the snapshot does not exist yet.
+    background : bool
+        If True, compact in a background thread and return the (started) thread.
+
+    Returns
+    -------
+    thread : threading.Thread or None
+
+    Only one compaction runs at a time: journal.compactLock is held until the
+    compaction finishes (or released here if the journal cannot be rotated)."""
+    journal.compactLock.acquire()
+    try:
+        segmentFn = journal.rotate()
+    except BaseException:
+        journal.compactLock.release()
+        raise
+    def _compact():
+        try:
+            if os.path.exists(snapshotFn):
+                store, snapMeta = readSnapshot(snapshotFn, mmap=True)
+            else:
+                store, snapMeta = ArrayStore(), meta
+            for (hlas, peptides, values), end in readBatches(segmentFn):
+                store.setMany(hlas, peptides, values)
+            tmpFn = snapshotFn + '.tmp'
+            writeSnapshot(store, tmpFn, meta=snapMeta)
+            del store
+            os.replace(tmpFn, snapshotFn)
+            os.remove(segmentFn)
+        finally:
+            journal.compactLock.release()
+    if background:
+        thread = threading.Thread(target=_compact)
+        thread.start()
+        return thread
+    _compact()
@@ -0,0 +1,142 @@
+"""
+Streaming loader for prediction output files (baseFn.k.out).
+
+Files are parsed in chunks (with the multithreaded pyarrow CSV reader when
+pyarrow is installed, otherwise with pandas) and allele names are normalized
+with vectorized string operations, so each chunk can be inserted into the
+cache as soon as it is parsed and peak memory is bounded by the chunk size.
+Several files (e.g. the 8-11-mer files of one cache) can be parsed concurrently
+in a process pool with readPredictionFiles()."""
+
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+__all__ = ['readPredictionChunks',
+           'readPredictionFiles']
+
+"""For each file format: column names (None to use the header), rows to skip,
+and the columns holding the allele, peptide, prediction and binding core
+(old class II files hold the core in the prediction column, see _normalize())"""
+FORMATS = {'default':dict(names=['method', 'hla', 'peptide', 'core', 'ic50'], skiprows=1, hla='hla', value='ic50', core='core'),
+           'old':dict(names=['method', 'hla', 'peptide', 'ic50'], skiprows=0, hla='hla', value='ic50', core=None),
+           'new':dict(names=None, skiprows=0, hla='allele', value='pred', core=None),
+           'pairs':dict(names=['hla', 'peptide', 'pred'], skiprows=0, hla='hla', value='pred', core=None)}
+
+def _hasPyarrow():
+    try:
+        import pyarrow.csv
+        return True
+    except ImportError:
+        return False
+
+def _normalize(df, fmt, cores=False):
+    """Return (hlas, peptides, values) arrays from one parsed chunk,
+    plus an array of binding cores if cores"""
+    info = FORMATS[fmt]
+    hlas = df[info['hla']].astype(str)
+    if fmt == 'new':
+        """Alleles are written as HLA-A*02:01"""
+        hlas = hlas.str.slice(4, None).str.replace(':', '', regex=False)
+    if not fmt == 'pairs':
+        hlas = hlas.str.replace('*', '_', regex=False)
+    values = df[info['value']]
+    core = df[info['core']] if cores and not info['core'] is None else pd.Series(None, index=df.index, dtype=object)
+    if fmt == 'old' and not pd.api.types.is_numeric_dtype(values):
+        """Old class II files store the prediction as a "(value, 'core')" tuple"""
+        parts = values.str.extract(r"^\(\s*([^,]+),\s*'([^']*)'")
+        values, core = parts[0], parts[1]
+    out = (hlas.to_numpy(dtype=object), df['peptide'].to_numpy(dtype=object), values.to_numpy(dtype=float))
+    if cores:
+        out += (core.to_numpy(dtype=object),)
+    return out
+
+def _pandasChunks(fn, info, columns, chunkSize):
+    if info['names'] is None:
+        reader = pd.read_csv(fn, usecols=columns, chunksize=chunkSize)
+    else:
+        reader = pd.read_csv(fn, names=info['names'], usecols=columns, header=None,
+                             skiprows=info['skiprows'], chunksize=chunkSize)
+    for df in reader:
+        yield df
+
+def _pyarrowChunks(fn, info, columns, chunkSize):
+    import pyarrow.csv as pacsv
+    """block_size is in bytes: allow ~64 bytes per row"""
+    readOpts = pacsv.ReadOptions(use_threads=True,
+                                 block_size=max(chunkSize * 64, 2**16),
+                                 column_names=info['names'],
+                                 skip_rows=info['skiprows'])
+    convertOpts = pacsv.ConvertOptions(include_columns=columns,
+                                       strings_can_be_null=False)
+    reader = pacsv.open_csv(fn, read_options=readOpts, convert_options=convertOpts)
+    for batch in reader:
+        yield batch.to_pandas()
+
+def readPredictionChunks(fn, fmt='default', chunkSize=2**18, engine='auto', cores=False):
+    """Generator over (hlas, peptides, values) chunks of a prediction file,
+    with alleles normalized to the cache key format (e.g. A_0201).
+
+    Parameters
+    ----------
+    fn : str
+        Prediction file (e.g. baseFn.9.out)
+    fmt : str
+        'default' (method,hla,peptide,core,ic50 with a header row),
+        'old' (method,hla,peptide,ic50 without a header),
+        'new' (IEDB tools output with named columns peptide, allele and pred) or
+        'pairs' (hla,peptide,pred as written by dumpToFile(); alleles are not changed)
+    chunkSize : int
+        Approximate number of rows per chunk.
+    engine : str
+        'pyarrow', 'pandas' or 'auto' (pyarrow if it is installed)
+    cores : bool
+        Also yield the binding core of each prediction (from the core column of 'default'
+        files or the "(value, 'core')" predictions of old class II files, None otherwise)
+
+    Yields
+    ------
+    hlas, peptides : np.ndarray of str (object)
+    values : np.ndarray of float
+    cores : np.ndarray of str (object), only if cores"""
+    info = FORMATS[fmt]
+    columns = [info['hla'], 'peptide', info['value']]
+    if cores and not info['core'] is None:
+        columns.append(info['core'])
+    if engine == 'auto':
+        engine = 'pyarrow' if _hasPyarrow() else 'pandas'
+    if engine == 'pyarrow':
+        try:
+            import pyarrow.csv
+        except ImportError:
+            raise ImportError('engine=\'pyarrow\' requires pyarrow (pip install pyarrow), or use engine=\'pandas\'')
+        chunks = _pyarrowChunks(fn, info, columns, chunkSize)
+    elif engine == 'pandas':
+        chunks = _pandasChunks(fn, info, columns, chunkSize)
+    else:
+        raise ValueError('engine must be \'pyarrow\', \'pandas\' or \'auto\' (got %s)' % engine)
+    for df in chunks:
+        yield _normalize(df, fmt, cores)
+
+def _readFile(fn, fmt, chunkSize, cores):
+    """Parse a whole file in a worker process"""
+    return list(readPredictionChunks(fn, fmt=fmt, chunkSize=chunkSize, cores=cores))
+
+def readPredictionFiles(fileList, fmt='default', chunkSize=2**18, cpus=1, cores=False):
+    """Generator over (hlas, peptides, values) chunks of several prediction files,
+    or (hlas, peptides, values, cores) chunks if cores (see readPredictionChunks()).
+
+    With cpus > 1 the files are parsed concurrently in a pool of cpus processes and
+    the chunks of each file are yielded as soon as that file is done (files can
+    finish in any order). Each worker holds all chunks of its file until they are
+    sent back, so peak memory grows to roughly cpus parsed files."""
+    if cpus > 1 and len(fileList) > 1:
+        with Pool(processes=min(cpus, len(fileList))) as pool:
+            for chunks in pool.imap_unordered(partial(_readFile, fmt=fmt, chunkSize=chunkSize, cores=cores), fileList):
+                for chunk in chunks:
+                    yield chunk
+    else:
+        for fn in fileList:
+            for chunk in readPredictionChunks(fn, fmt=fmt, chunkSize=chunkSize, cores=cores):
+                yield chunk
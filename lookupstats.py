@@ -0,0 +1,125 @@
+from collections import Counter, OrderedDict
+import numpy as np
+import pandas as pd
+
+from .helpers import isvalidmer
+
+__all__ = ['LookupStats']
+
+KINDS = ['hits', 'misses', 'invalid', 'fallbacks']
+
+class LookupStats(object):
+    """Counters of cache lookups by allele and peptide length, and a bounded log of misses.
+
+    Each lookup is counted as one of:
+        hits : prediction found
+        misses : no prediction for a valid peptide (returned nan)
+        invalid : invalid peptide (returned nan)
+    and, in addition, hits that were only found after normalizing
+    the allele name (A*0201 -> A_0201) are counted as fallbacks.
+
+    Enable with hlaPredCache.trackLookups().
+
+    Parameters
+    ----------
+    maxMissLog : int
+        Maximum number of distinct (hla, peptide) misses kept in the log
+        (the least recently missed pairs are dropped first)."""
+    def __init__(self, maxMissLog=10**5):
+        self.maxMissLog = maxMissLog
+        self.counts = Counter()
+        self.missLog = OrderedDict()
+
+    def reset(self):
+        self.counts.clear()
+        self.missLog.clear()
+
+    def record(self, hla, peptide, kind, fallback=False):
+        """Count one lookup of kind 'hits', 'misses' or 'invalid'"""
+        L = len(peptide) if not peptide is None else 0
+        self.counts[(kind, hla, L)] += 1
+        if fallback:
+            self.counts[('fallbacks', hla, L)] += 1
+        if kind == 'misses':
+            self._logMisses([(hla, peptide)])
+
+    def recordMany(self, hlas, peptides, missing, fallback, cross=False):
+        """Count a batch of lookups
+
+        Parameters
+        ----------
+        hlas, peptides : list
+            Normalized alleles and peptides, paired or crossed (see cross)
+        missing : ndarray bool
+            True for pairs without a prediction, [len(hlas), len(peptides)] if cross
+        fallback : ndarray bool
+            True for each allele in hlas that needed normalizing"""
+        missing = np.asarray(missing, dtype=bool)
+        fallback = np.asarray(fallback, dtype=bool)
+        valid = {p:isvalidmer(p) for p in set(peptides)}
+        valid = np.fromiter((valid[p] for p in peptides), dtype=bool, count=len(peptides))
+        lengths = np.fromiter((len(p) if not p is None else 0 for p in peptides), dtype=np.int64, count=len(peptides))
+        if cross:
+            hi = np.repeat(np.arange(len(hlas)), len(peptides))
+            pj = np.tile(np.arange(len(peptides)), len(hlas))
+        else:
+            hi = np.arange(len(hlas))
+            pj = hi
+        missing = missing.ravel()
+        kinds = {'hits':~missing,
+                 'misses':missing & valid[pj],
+                 'invalid':~valid[pj],
+                 'fallbacks':~missing & fallback[hi]}
+        nL = lengths.max() + 1 if len(peptides) > 0 else 1
+        for kind, mask in kinds.items():
+            if mask.any():
+                """Count by (allele, length) with one bincount over combined codes"""
+                combined = np.bincount(hi[mask] * nL + lengths[pj[mask]], minlength=len(hlas) * nL)
+                for c in np.nonzero(combined)[0]:
+                    h, L = divmod(c, nL)
+                    self.counts[(kind, hlas[h], int(L))] += int(combined[c])
+        ind = np.nonzero(kinds['misses'])[0][-self.maxMissLog:]
+        self._logMisses([(hlas[hi[i]], peptides[pj[i]]) for i in ind])
+
+    def _logMisses(self, pairs):
+        for k in pairs:
+            if k in self.missLog:
+                self.missLog.move_to_end(k)
+            else:
+                self.missLog[k] = None
+        while len(self.missLog) > self.maxMissLog:
+            self.missLog.popitem(last=False)
+
+    def totals(self):
+        """Dict of the total count of each kind"""
+        out = {kind:0 for kind in KINDS}
+        for (kind, hla, L), n in self.counts.items():
+            out[kind] += n
+        return out
+
+    def summary(self):
+        """DataFrame of counts with one row per (hla, length) and a column per kind"""
+        rows = [dict(hla=hla, length=L, kind=kind, n=n) for (kind, hla, L), n in self.counts.items()]
+        if len(rows) == 0:
+            return pd.DataFrame(columns=KINDS, index=pd.MultiIndex.from_tuples([], names=['hla', 'length']))
+        df = pd.DataFrame(rows).pivot_table(index=['hla', 'length'], columns='kind', values='n', aggfunc='sum', fill_value=0)
+        return df.reindex(columns=KINDS, fill_value=0)
+
+    def missingPairs(self):
+        """Logged misses as paired lists (hlas, peptides), oldest first"""
+        return [k[0] for k in self.missLog], [k[1] for k in self.missLog]
+
+    def workList(self):
+        """Logged misses as {peptide length:(hlas, peptides)}: the alleles and peptides to pass to
+        addPredictions() (which only predicts the pairs that are still missing)"""
+        out = {}
+        for h, p in self.missLog:
+            hlas, peptides = out.setdefault(len(p), ({}, {}))
+            hlas[h] = None
+            peptides[p] = None
+        return {L:(list(h), list(p)) for L, (h, p) in out.items()}
+
+    def exportMissLog(self, fn):
+        """Write the logged misses to a csv file with columns hla,peptide"""
+        hlas, peptides = self.missingPairs()
+        pd.DataFrame(dict(hla=hlas, peptide=peptides)).to_csv(fn, index=False)
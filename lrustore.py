@@ -0,0 +1,161 @@
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ['LRUStore']
+
+"""Approximate memory used by one cached entry beyond the allele and peptide
+characters: key tuple, float, OrderedDict slot and linked-list node."""
+ENTRY_OVERHEAD = 200
+
+class LRUStore(object):
+    """Bounded in-memory tier in front of another (e.g. on-disk) store.
+
+    Recently used (hla, peptide) values, including misses, are kept in
+    least-recently-used order and evicted once the tier exceeds maxEntries or
+    (approximately) maxBytes. Alleles can be pinned so that their predictions are
+    never evicted (pinned entries don't count towards the limits).
+    Writes go through to the backing store.
+
+    Implements the same store interface as ArrayStore, so it can back an hlaStoreCache:
+        ba = hlaStoreCache(store=LRUStore(SqliteStore(fn, 'netmhcpan'), maxEntries=10**6))
+
+    Parameters
+    ----------
+    store : store
+        Backing store (e.g. SqliteStore)
+    maxEntries : int or None
+        Maximum number of (unpinned) entries held in memory.
+    maxBytes : int or None
+        Approximate maximum memory for (unpinned) entries.
+    pinned : list or None
+        Alleles whose predictions are never evicted.
+
+    Attributes
+    ----------
+    hits, misses, evictions : int
+        Counters for lookups answered from memory, lookups passed to
+        the backing store and entries evicted from memory."""
+    def __init__(self, store, maxEntries=None, maxBytes=None, pinned=None):
+        self.store = store
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.pinnedHLAs = set() if pinned is None else set(pinned)
+        self.lru = OrderedDict()
+        self.pinned = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    def stats(self):
+        """Return a dict of the tier counters and its current size"""
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    entries=len(self.lru),
+                    pinnedEntries=len(self.pinned),
+                    nbytes=self.nbytes)
+
+    def pin(self, hlas):
+        """Never evict predictions for these alleles (moves cached ones to the pinned tier)"""
+        self.pinnedHLAs.update(hlas)
+        for k in [k for k in self.lru if k[0] in self.pinnedHLAs]:
+            self.nbytes -= self._entryBytes(k)
+            self.pinned[k] = self.lru.pop(k)
+
+    def unpin(self, hlas):
+        """Allow predictions for these alleles to be evicted again"""
+        self.pinnedHLAs.difference_update(hlas)
+        for k in [k for k in self.pinned if not k[0] in self.pinnedHLAs]:
+            self._insert(k, self.pinned.pop(k))
+        self._evict()
+
+    def clear(self):
+        """Drop all cached entries (counters are kept)"""
+        self.lru.clear()
+        self.pinned.clear()
+        self.nbytes = 0
+
+    def _entryBytes(self, key):
+        return ENTRY_OVERHEAD + len(key[0]) + len(key[1])
+
+    def _lookup(self, key):
+        """Return the cached value for key or None (updates LRU order and counters)"""
+        try:
+            val = self.lru[key]
+            self.lru.move_to_end(key)
+        except KeyError:
+            val = self.pinned.get(key)
+            if val is None:
+                self.misses += 1
+                return None
+        self.hits += 1
+        return val
+
+    def _insert(self, key, val):
+        if key[0] in self.pinnedHLAs:
+            self.pinned[key] = val
+        else:
+            if not key in self.lru:
+                self.nbytes += self._entryBytes(key)
+            self.lru[key] = val
+            self.lru.move_to_end(key)
+
+    def _evict(self):
+        while len(self.lru) > 0 and ((not self.maxEntries is None and len(self.lru) > self.maxEntries) or
+                                     (not self.maxBytes is None and self.nbytes > self.maxBytes)):
+            key, val = self.lru.popitem(last=False)
+            self.nbytes -= self._entryBytes(key)
+            self.evictions += 1
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        key = (hla, peptide)
+        val = self._lookup(key)
+        if val is None:
+            val = self.store.get(hla, peptide)
+            self._insert(key, val)
+            self._evict()
+        return val
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs), fetching all misses
+        from the backing store in one batch"""
+        out = np.full(len(hlas), np.nan)
+        todo = []
+        for i, key in enumerate(zip(hlas, peptides)):
+            val = self._lookup(key)
+            if val is None:
+                todo.append(i)
+            else:
+                out[i] = val
+        if len(todo) > 0:
+            missHLAs = [hlas[i] for i in todo]
+            missPeptides = [peptides[i] for i in todo]
+            out[todo] = self.store.getMany(missHLAs, missPeptides)
+            for i, h, p in zip(todo, missHLAs, missPeptides):
+                self._insert((h, p), out[i])
+            self._evict()
+        return out
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        hlaPairs = [h for h in hlas for p in peptides]
+        pepPairs = [p for h in hlas for p in peptides]
+        return self.getMany(hlaPairs, pepPairs).reshape((len(hlas), len(peptides)))
+
+    def setMany(self, hlas, peptides, values):
+        """Write predictions through to the backing store, updating any cached values"""
+        hlas = list(hlas)
+        peptides = list(peptides)
+        self.store.setMany(hlas, peptides, values)
+        for key, val in zip(zip(hlas, peptides), values):
+            if key in self.lru or key in self.pinned:
+                self._insert(key, float(val))
+
+    def iterItems(self):
+        return self.store.iterItems()
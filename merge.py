@@ -0,0 +1,88 @@
+"""
+Merging caches at the index and array level (see hlaPredCache.merge()).
+
+Each source cache is read as a stream of coded batches: the predictions of a block of
+peptide rows as (hla names, hla codes, peptide names, peptide codes, values,
+fingerprint names, fingerprint codes), with the codes indexing the names. A batch is
+merged into the target by looking up the target cells of all its pairs at once,
+comparing the values and scattering the ones selected by the merge policy, so no
+dict of the source is ever built and peak memory is the target plus one batch."""
+
+import itertools
+import numpy as np
+import pandas as pd
+
+from .versionstore import VersionedStore
+
+__all__ = ['POLICIES',
+           'storeBatches',
+           'itemBatches',
+           'mergeMask',
+           'maxError']
+
+"""Merge policies (see hlaPredCache.merge())"""
+POLICIES = ('keep_existing', 'overwrite', 'min', 'error')
+
+def storeBatches(store, batchSize=2**16):
+    """Generator over the coded batches of all predictions in an ArrayStore or VersionedStore
+    (only the accepted ones, see VersionedStore.require()), batchSize peptide rows at a time.
+    Fingerprint names and codes (-1 for untagged) are None for an ArrayStore."""
+    versioned = isinstance(store, VersionedStore)
+    values = store.store if versioned else store
+    hlaNames = np.asarray(values.hlas, dtype=object)
+    acceptedIds = store._ids(store.accepted) if versioned and not store.accepted is None else None
+    for start in range(0, values.nPeptides, batchSize):
+        rows = np.arange(start, min(start + batchSize, values.nPeptides))
+        vals = values.decode(values.rowValues(rows))
+        ok = ~np.isnan(vals)
+        if versioned:
+            ids = store.tags.decode(store.tags.rowValues(rows))
+            if not acceptedIds is None:
+                ok &= np.isin(ids, acceptedIds)
+        r, c = np.nonzero(ok)
+        if r.shape[0] == 0:
+            continue
+        if versioned:
+            ids = ids[r, c]
+            fpNames, fpCodes = list(store.fingerprints), np.where(np.isnan(ids), -1, ids).astype(np.int64)
+        else:
+            fpNames, fpCodes = None, None
+        yield hlaNames, c, np.asarray(values.peptideAt(rows), dtype=object), r, vals[r, c], fpNames, fpCodes
+
+def itemBatches(items, batchSize=2**16):
+    """Generator over the coded batches of an iterator of ((hla, peptide), value) items
+    (e.g. the items of a dict-based hlaPredCache), batchSize items at a time"""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, batchSize))
+        if len(batch) == 0:
+            break
+        hlaCodes, hlaNames = pd.factorize(np.asarray([k[0] for k, v in batch], dtype=object))
+        pepCodes, pepNames = pd.factorize(np.asarray([k[1] for k, v in batch], dtype=object))
+        yield (np.asarray(hlaNames, dtype=object), hlaCodes, np.asarray(pepNames, dtype=object), pepCodes,
+               np.array([v for k, v in batch], dtype=float), None, None)
+
+def maxError(ba):
+    """Quantization error of the values in a cache (0 unless its store is quantized)"""
+    return getattr(getattr(ba, 'store', None), 'maxError', 0.)
+
+def mergeMask(existing, values, policy, tolerance=0.):
+    """Select the values of a batch to write over the existing values in the target.
+
+    Pairs present in both with values that differ by more than tolerance
+    (plus float32 rounding) are conflicts.
+
+    Returns
+    -------
+    write : ndarray bool
+        Values to write (for policy='error', the values that are new to the target)
+    conflict : ndarray bool"""
+    present = ~np.isnan(existing)
+    conflict = present & ~np.isclose(existing, values, rtol=1e-6, atol=tolerance)
+    if policy == 'overwrite':
+        write = conflict | ~present
+    elif policy == 'min':
+        write = ~present | (conflict & (values < existing))
+    else:
+        write = ~present
+    return write & ~np.isnan(values), conflict
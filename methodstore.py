@@ -0,0 +1,87 @@
+import numpy as np
+
+from .store import ArrayStore
+
+__all__ = ['MethodStore']
+
+class MethodStore(object):
+    """Predictions from several methods (e.g. netmhcpan, smm, ann) in one ArrayStore.
+
+    The ArrayStore columns are (method, hla) pairs, so all methods share one
+    peptide index (the large one) and each method only adds value columns.
+    A MethodStore is the view of one method: it implements the same store interface
+    as ArrayStore (so it can back an hlaStoreCache) with hla keys of that method.
+    Views for other methods over the same ArrayStore are made with forMethod().
+
+    Parameters
+    ----------
+    store : ArrayStore or None
+        Shared store with (method, hla) columns (a new ArrayStore if None)
+    method : str
+        Method of this view."""
+    def __init__(self, store=None, method=''):
+        self.store = ArrayStore() if store is None else store
+        self.method = method
+
+    def forMethod(self, method):
+        """View of another method, sharing the underlying ArrayStore"""
+        return MethodStore(self.store, method)
+
+    @property
+    def methods(self):
+        """Methods with at least one allele in the store"""
+        return list(dict.fromkeys([m for m, h in self.store.hlas]))
+
+    @property
+    def hlas(self):
+        return [h for m, h in self.store.hlas if m == self.method]
+
+    def __len__(self):
+        return self.store.countColumns(self.store.hlaIndices(self._keys(self.hlas)))
+
+    def _keys(self, hlas, method=None):
+        method = self.method if method is None else method
+        return [(method, h) for h in hlas]
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        return self.store.get((self.method, hla), peptide)
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs)"""
+        return self.store.getMany(self._keys(hlas), peptides)
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        return self.store.getCross(self._keys(hlas), peptides)
+
+    def getMethods(self, methods, hlas, peptides, cross=False):
+        """Predictions of several methods, looking up the peptides only once
+
+        Returns
+        -------
+        values : ndarray float
+            [len(methods), len(hlas), len(peptides)] if cross, otherwise [len(methods), len(hlas)]"""
+        rows = self.store.peptideIndices(peptides)
+        if cross:
+            out = np.full((len(methods), len(hlas), len(peptides)), np.nan)
+            for i, m in enumerate(methods):
+                cols = self.store.hlaIndices(self._keys(hlas, m))
+                vals = self.store.gather(np.tile(rows, len(cols)), np.repeat(cols, len(rows)))
+                out[i] = vals.reshape((len(hlas), len(peptides)))
+        else:
+            out = np.full((len(methods), len(hlas)), np.nan)
+            for i, m in enumerate(methods):
+                out[i] = self.store.gather(rows, self.store.hlaIndices(self._keys(hlas, m)))
+        return out
+
+    def setMany(self, hlas, peptides, values):
+        """Store predictions of this method for paired sequences of alleles, peptides and values"""
+        self.store.setMany(self._keys(hlas), list(peptides), values)
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all predictions of this method"""
+        for (key, peptide), v in self.store.iterItems():
+            if key[0] == self.method:
+                yield (key[1], peptide), v
@@ -0,0 +1,243 @@
+"""
+Parquet import and export of predictions (requires pyarrow).
+
+Each prediction is one row (hla, peptide, length, value), plus its fingerprint
+for a VersionedStore. Alleles, peptides and fingerprints are dictionary-encoded
+columns and values are float32.
+
+Rows are written in row groups that each hold one peptide length, a range of
+(sorted) alleles and a chunk of peptides, in allele-major order. Every peptide of a
+row group is then stored once in its dictionary and the allele column is a few runs,
+and the min/max statistics of each row group let readers skip the row groups of
+other alleles and lengths (predicate pushdown, see readParquetChunks()).
+
+Writing and reading go from store arrays to Arrow arrays a row group or batch at a
+time, so there is no Python loop over predictions and peak memory is bounded by
+the row group size. Metadata (e.g. name, predictionMethod) is kept in the schema."""
+
+import json
+import numpy as np
+
+from .store import ArrayStore
+from .versionstore import VersionedStore
+
+__all__ = ['writeParquet',
+           'readParquet',
+           'readParquetChunks']
+
+"""Key of the JSON metadata in the Arrow schema"""
+METAKEY = b'hlapredcache'
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet import/export requires pyarrow (pip install pyarrow)')
+    return pyarrow, pyarrow.parquet
+
+def _schema(pa, versioned, meta):
+    fields = [pa.field('hla', pa.dictionary(pa.int32(), pa.string())),
+              pa.field('peptide', pa.dictionary(pa.int32(), pa.string())),
+              pa.field('length', pa.int8()),
+              pa.field('value', pa.float32())]
+    if versioned:
+        fields.append(pa.field('fingerprint', pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(fields, metadata={METAKEY:json.dumps(dict(meta=meta)).encode()})
+
+def writeParquet(store, fn, meta={}, rowGroupSize=2**20, hlasPerGroup=8, compression='zstd'):
+    """Write the predictions in an ArrayStore (or VersionedStore) to a Parquet file.
+
+    Parameters
+    ----------
+    store : ArrayStore or VersionedStore
+    fn : str
+        Output filename.
+    meta : dict
+        JSON-serializable metadata stored in the schema (e.g. name, predictionMethod)
+    rowGroupSize : int
+        Approximate maximum number of rows per row group.
+    hlasPerGroup : int
+        Number of alleles per row group: each peptide is stored once for this many
+        alleles, but a reader that wants one allele reads the predictions of all of them
+        (use 1 for files that are mostly read allele by allele).
+    compression : str
+        Parquet compression codec."""
+    pa, pq = _pyarrow()
+    versioned = isinstance(store, VersionedStore)
+    hlas = list(store.hlas)
+    peptides = store.allPeptides()
+    lengths = np.char.str_len(peptides)
+    schema = _schema(pa, versioned, meta)
+    hlaOrder = np.argsort(np.array(hlas, dtype=str), kind='stable')
+    hlaDict = pa.array([hlas[c] for c in hlaOrder], type=pa.string())
+    if versioned:
+        fingerprintDict = pa.array(store.fingerprints, type=pa.string())
+    pepChunk = max(rowGroupSize // max(hlasPerGroup, 1), 1)
+    with pq.ParquetWriter(fn, schema, compression=compression) as writer:
+        for L in np.unique(lengths):
+            rowsL = np.nonzero(lengths == L)[0]
+            rowsL = rowsL[np.argsort(peptides[rowsL], kind='stable')]
+            for hstart in range(0, len(hlas), hlasPerGroup):
+                hi = np.arange(hstart, min(hstart + hlasPerGroup, len(hlas)))
+                cols = hlaOrder[hi]
+                for pstart in range(0, rowsL.shape[0], pepChunk):
+                    rows = rowsL[pstart:pstart + pepChunk]
+                    """Allele-major: all peptides of the first allele, then of the next"""
+                    pairRows, pairCols = np.tile(rows, len(cols)), np.repeat(cols, len(rows))
+                    vals = (store.store if versioned else store).gather(pairRows, pairCols)
+                    ok = np.nonzero(~np.isnan(vals))[0]
+                    if ok.shape[0] == 0:
+                        continue
+                    arrays = [pa.DictionaryArray.from_arrays(pa.array(np.repeat(hi, len(rows))[ok].astype(np.int32)), hlaDict),
+                              pa.DictionaryArray.from_arrays(pa.array(np.tile(np.arange(len(rows), dtype=np.int32), len(cols))[ok]),
+                                                             pa.array(peptides[rows]).cast(pa.string())),
+                              pa.array(np.full(ok.shape[0], L, dtype=np.int8)),
+                              pa.array(vals[ok].astype(np.float32))]
+                    if versioned:
+                        ids = store.tags.gather(pairRows[ok], pairCols[ok])
+                        untagged = np.isnan(ids)
+                        ids[untagged] = 0
+                        arrays.append(pa.DictionaryArray.from_arrays(pa.array(ids.astype(np.int32), mask=untagged), fingerprintDict))
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema), row_group_size=rowGroupSize)
+
+def _readMeta(pf):
+    metadata = pf.schema_arrow.metadata or {}
+    if not METAKEY in metadata:
+        return {}
+    return json.loads(metadata[METAKEY].decode())['meta']
+
+def _selectRowGroups(pf, hlas, lengths):
+    """Row groups whose min/max statistics overlap the requested alleles and lengths
+    (row groups without statistics are always read)"""
+    md = pf.metadata
+    names = pf.schema_arrow.names
+    filters = []
+    if not hlas is None:
+        filters.append((names.index('hla'), sorted(hlas)))
+    if not lengths is None:
+        filters.append((names.index('length'), sorted(lengths)))
+    groups = []
+    for g in range(md.num_row_groups):
+        keep = True
+        for col, wanted in filters:
+            stats = md.row_group(g).column(col).statistics
+            if not stats is None and stats.has_min_max:
+                """wanted is sorted, so bisect for the first value >= min"""
+                i = np.searchsorted(np.array(wanted, dtype=object), stats.min)
+                keep &= i < len(wanted) and wanted[i] <= stats.max
+        if keep:
+            groups.append(g)
+    return groups
+
+def _codedBatches(fn, hlas=None, lengths=None, batchSize=2**20):
+    """Generator over dictionary-coded batches of a Parquet file (see readParquetChunks()):
+    (hla names, hla codes, peptide names, peptide codes, values, fingerprint names, fingerprint codes)
+    with codes as int arrays into the names (fingerprint codes are -1 for untagged rows,
+    and both are None if the file has no fingerprints)"""
+    pa, pq = _pyarrow()
+    columns = ['hla', 'peptide', 'length', 'value']
+    versioned = 'fingerprint' in pq.read_schema(fn).names
+    if versioned:
+        columns.append('fingerprint')
+    pf = pq.ParquetFile(fn, read_dictionary=[c for c in columns if not c in ('length', 'value')])
+    groups = _selectRowGroups(pf, hlas, lengths)
+    if len(groups) == 0:
+        return
+    for batch in pf.iter_batches(batch_size=batchSize, row_groups=groups, columns=columns):
+        hla, peptide = batch.column(0), batch.column(1)
+        hlaNames = np.asarray(hla.dictionary.to_pylist(), dtype=object)
+        hlaCodes = hla.indices.to_numpy(zero_copy_only=False)
+        keep = np.ones(len(batch), dtype=bool)
+        if not hlas is None:
+            keep &= np.isin(hlaNames, list(hlas))[hlaCodes]
+        if not lengths is None:
+            keep &= np.isin(batch.column(2).to_numpy(zero_copy_only=False), list(lengths))
+        ind = np.nonzero(keep)[0]
+        if ind.shape[0] == 0:
+            continue
+        values = batch.column(3).to_numpy(zero_copy_only=False).astype(float)[ind]
+        """Keep just the dictionary entries used by the selected rows
+        (the allele dictionary of a row group can hold every allele in the file)"""
+        hlaCodes = hlaCodes[ind]
+        used = np.bincount(hlaCodes, minlength=hlaNames.shape[0]) > 0
+        hlaNames, hlaCodes = hlaNames[used], (np.cumsum(used) - 1)[hlaCodes]
+        pepCodes = peptide.indices.to_numpy(zero_copy_only=False)
+        if ind.shape[0] < len(batch):
+            uPep, pepCodes = np.unique(pepCodes[ind], return_inverse=True)
+            pepNames = peptide.dictionary.take(pa.array(uPep)).to_numpy(zero_copy_only=False)
+        else:
+            pepNames = peptide.dictionary.to_numpy(zero_copy_only=False)
+        if versioned:
+            fp = batch.column(4)
+            fpNames = fp.dictionary.to_pylist()
+            fpCodes = fp.indices.fill_null(-1).to_numpy(zero_copy_only=False)[ind]
+        else:
+            fpNames, fpCodes = None, None
+        yield hlaNames, hlaCodes.ravel(), pepNames, pepCodes.ravel(), values, fpNames, fpCodes
+
+def readParquetChunks(fn, hlas=None, lengths=None, batchSize=2**20, fingerprints=False):
+    """Generator over (hlas, peptides, values) chunks of a Parquet file written by writeParquet()
+    (same chunks as loader.readPredictionChunks()).
+
+    Parameters
+    ----------
+    fn : str
+        Parquet filename.
+    hlas : list or None
+        Only read predictions for these alleles (in the format A_0201).
+    lengths : list or None
+        Only read predictions for peptides of these lengths.
+    batchSize : int
+        Maximum number of rows per chunk.
+    fingerprints : bool
+        Also yield the fingerprint of each prediction (None if untagged or if the file has none)
+
+    Yields
+    ------
+    hlas, peptides : np.ndarray of str (object)
+    values : np.ndarray of float
+    fingerprints : np.ndarray of str (object), only if fingerprints"""
+    for hlaNames, hlaCodes, pepNames, pepCodes, values, fpNames, fpCodes in _codedBatches(fn, hlas, lengths, batchSize):
+        out = (hlaNames[hlaCodes], np.asarray(pepNames, dtype=object)[pepCodes], values)
+        if fingerprints:
+            if fpNames is None:
+                out += (np.full(values.shape[0], None, dtype=object),)
+            else:
+                out += (np.asarray(fpNames + [None], dtype=object)[fpCodes],)
+        yield out
+
+def readParquet(fn, store=None, hlas=None, lengths=None, batchSize=2**20):
+    """Read the predictions in a Parquet file written by writeParquet() into a store.
+
+    Alleles and peptides are added to the store once per batch (from the dictionaries of
+    the batch) and values are scattered by their codes, so reading costs a few numpy
+    operations per batch. See readParquetChunks() for hlas and lengths.
+
+    Parameters
+    ----------
+    store : ArrayStore, VersionedStore or None
+        Store to add the predictions to. If None, a new ArrayStore, or a VersionedStore
+        if the file has fingerprints. Fingerprints are only kept by a VersionedStore.
+
+    Returns
+    -------
+    store : ArrayStore or VersionedStore
+    meta : dict
+        Metadata that was passed to writeParquet()"""
+    pa, pq = _pyarrow()
+    pf = pq.ParquetFile(fn)
+    meta = _readMeta(pf)
+    if store is None:
+        store = VersionedStore() if 'fingerprint' in pf.schema_arrow.names else ArrayStore()
+    versioned = isinstance(store, VersionedStore)
+    for hlaNames, hlaCodes, pepNames, pepCodes, values, fpNames, fpCodes in _codedBatches(fn, hlas, lengths, batchSize):
+        cols = store.addHLAs(list(hlaNames))[hlaCodes]
+        rows = store.addPeptides(pepNames.tolist())[pepCodes]
+        if versioned and not fpNames is None:
+            for code in np.unique(fpCodes):
+                ind = np.nonzero(fpCodes == code)[0]
+                store.scatter(rows[ind], cols[ind], values[ind], fingerprint=fpNames[code] if code >= 0 else None)
+        else:
+            store.scatter(rows, cols, values)
+    return store, meta
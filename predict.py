@@ -5,10 +5,16 @@ from multiprocessing import Pool
 import parmap
 import logging
 import sys
+import os
+from functools import lru_cache
 
 from .iedb_src import predict_binding as iedb_predict
+from .iedb_src.setupinfo import SetupInfo
+from .fingerprint import predictorFingerprint
 
-__all__ = ['iedbPredict']
+__all__ = ['iedbPredict',
+           'iedbFingerprint',
+           'iedbVersion']
 
 def convertHLAToIEDB(h):
     """Takes format A*1234 or A_1234 and returns A*12:34"""
@@ -75,10 +81,44 @@ def iedbPredict(method, hlas, peptides, cpus=1, verbose=False):
     return resDf
 
 
+"""Training data directories of an IEDB install are named by their version"""
+IEDB_DATA_PREFIX = 'MHCI_mhcibinding'
+
+@lru_cache(maxsize=None)
+def iedbVersion(path=None):
+    """Version of the installed IEDB training data used by iedbPredict(): the newest
+    MHCI_mhcibinding<version> directory in the data directory path of the install
+    (SetupInfo().path_data_base if None), or the SetupInfo default if there is none"""
+    default = SetupInfo().version
+    if path is None:
+        path = SetupInfo().path_data_base
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return default
+    versions = sorted(n[len(IEDB_DATA_PREFIX):] for n in names
+                      if n.startswith(IEDB_DATA_PREFIX) and os.path.isdir(os.path.join(path, n)))
+    return versions[-1] if len(versions) > 0 else default
+
+@lru_cache(maxsize=None)
+def iedbFingerprint(method, version=None):
+    """Fingerprint of the IEDB build that iedbPredict() uses for method:
+    the training data version (iedbVersion() if None) and the contents of the method's
+    code and training data directories (see fingerprint.predictorFingerprint()).
+
+    Computed once per process, since hashing the model files reads them."""
+    if method == 'RAND':
+        return predictorFingerprint(method)
+    if version is None:
+        version = iedbVersion()
+    info = SetupInfo(version=version)
+    return predictorFingerprint(method, version, [os.path.join(info.path_method, method),
+                                                  os.path.join(info.path_data, method)])
+
 def _predictOneHLA(h, method, peptides, verbose):
     cols = ['method', 'hla', 'peptide', 'core', 'pred']
     try:
-        resDf = iedb_predict.Prediction().predict(method, convertHLAToIEDB(h), peptides)
+        resDf = iedb_predict.Prediction(version=iedbVersion()).predict(method, convertHLAToIEDB(h), peptides)
         resDf['hla'] = resDf.allele.map(convertHLABack)
         resDf['method'] = method
         resDf['core'] = resDf.peptide
@@ -0,0 +1,76 @@
+import threading
+from multiprocessing.connection import Client
+import numpy as np
+
+__all__ = ['RemoteStore']
+
+class RemoteStore(object):
+    """Store interface to the cache of a CacheServer process (see server.py).
+
+    Every call is one request over the connection, so batch lookups (getMany,
+    getCross) cost one round trip regardless of their size. The connection is
+    shared by the threads of the client (requests are serialized with a lock).
+
+    Implements the same store interface as ArrayStore, so it can back an hlaStoreCache
+    (see hlaCacheClient).
+
+    Parameters
+    ----------
+    address : str or tuple
+        Unix socket path or (host, port) of the server.
+    authkey : bytes
+        Key of the server (CacheServer.authkey, see multiprocessing.connection)"""
+    def __init__(self, address, authkey):
+        self.address = address
+        self.conn = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+
+    def _call(self, op, *args):
+        with self.lock:
+            self.conn.send((op, args))
+            status, result = self.conn.recv()
+        if status == 'error':
+            raise result
+        return result
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __len__(self):
+        return self._call('len')
+
+    @property
+    def hlas(self):
+        return self._call('hlas')
+
+    def info(self):
+        """Dict with the name and predictionMethod of the server's cache"""
+        return self._call('info')
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        return float(self._call('getMany', [hla], [peptide], False)[0])
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs)"""
+        return self._call('getMany', list(hlas), list(peptides), False)
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        return self._call('getMany', list(hlas), list(peptides), True).reshape((len(hlas), len(peptides)))
+
+    def setMany(self, hlas, peptides, values):
+        """Store predictions for paired sequences of alleles, peptides and values"""
+        self._call('setMany', list(hlas), list(peptides), np.asarray(values, dtype=float))
+
+    def predict(self, method, batches):
+        """Have the server predict the missing pairs in batches ((hlas, peptides) rectangles,
+        see hlaPredCache.planPredictions()). Returns the number of pairs that were predicted."""
+        return self._call('predict', method, batches)
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all predictions
+        (transfers the whole cache in one response)"""
+        return iter(self._call('items'))
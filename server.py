@@ -0,0 +1,174 @@
+"""
+Local cache server: one process owns a cache and serves batched lookups,
+updates and prediction requests to the other processes on the same node.
+
+Requests travel over a Unix socket (or a localhost TCP port) with
+multiprocessing.connection, one request and one response per batch.
+Clients use hlaCacheClient, which implements the hlaPredCache interface.
+
+Requests are pickled, so a client that can connect could run code as the server's
+owner: every connection has to authenticate with the server's authkey (HMAC
+challenge, see multiprocessing.connection) before any request is read. Without an
+authkey the server generates a random one (server.authkey) for its clients, and
+its Unix socket is only accessible to its owner.
+
+Predictions requested by clients (addPredictions, ensure, backfill) run in the server.
+While one prediction run is in progress, the requests that arrive are queued and then
+merged into the next run, so pairs requested by several clients are predicted once."""
+
+import os
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+from .helpers import isvalidmer
+from .cache import _planBatches
+
+__all__ = ['CacheServer']
+
+class CacheServer(object):
+    """Serve the cache ba to clients at address (each client connection gets a thread).
+
+    ba should support concurrent lookups and updates (e.g. an hlaConcurrentCache), since
+    lookups run in parallel in the client threads. Updates and prediction runs are serialized.
+
+        server = CacheServer(hlaConcurrentCache(baseFn), '/tmp/hlacache.sock').start()
+        ...
+        ba = hlaCacheClient('/tmp/hlacache.sock', server.authkey)  # in other processes
+
+    Parameters
+    ----------
+    ba : hlaPredCache
+    address : str or tuple
+        Unix socket path or (host, port), e.g. ('localhost', 6000)
+    authkey : bytes or None
+        Key that clients must present (see multiprocessing.connection). If None a random
+        key is generated (see self.authkey), which must be passed to the clients
+        (e.g. in a file or environment variable only readable by their owner).
+        A TCP address requires an explicit authkey, since any process on the host can connect.
+    cpus : int
+        Number of processes used by each prediction run."""
+    def __init__(self, ba, address, authkey=None, cpus=1):
+        if authkey is None:
+            if isinstance(address, tuple):
+                raise ValueError('CacheServer on a TCP address requires an authkey')
+            authkey = os.urandom(32)
+        self.ba = ba
+        self.cpus = cpus
+        self.authkey = authkey
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            """Unix socket: only the owner can connect"""
+            os.chmod(self.address, 0o600)
+        self.closed = False
+        self.serving = False
+        self.writeLock = threading.Lock()
+        self.predictLock = threading.Lock()
+        self.pendingLock = threading.Lock()
+        self.pending = []
+        self.ops = {'len':lambda: len(self.ba),
+                    'hlas':self._hlas,
+                    'info':lambda: dict(name=self.ba.name, predictionMethod=self.ba.predictionMethod),
+                    'getMany':self.ba._lookupMany,
+                    'setMany':self._setMany,
+                    'predict':self._predict,
+                    'items':lambda: list(self.ba.items())}
+
+    def start(self):
+        """Serve in a background (daemon) thread and return self"""
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def serve(self):
+        """Accept clients until close() is called"""
+        self.serving = True
+        while True:
+            """Only stop after an accept(), which close() wakes up with a connection"""
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                """Raised when the listener is closed, or by a client that fails authentication"""
+                if not self.serving:
+                    break
+                continue
+            if self.closed:
+                conn.close()
+                break
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        """Stop accepting clients (connected clients are still served)"""
+        self.closed = True
+        if self.serving:
+            """Closing the listener doesn't interrupt a blocked accept(), so connect to wake it up"""
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except OSError:
+                pass
+        self.listener.close()
+        self.serving = False
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, args = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    response = ('ok', self.ops[op](*args))
+                except Exception as err:
+                    response = ('error', err)
+                conn.send(response)
+
+    def _hlas(self):
+        if hasattr(self.ba, 'store'):
+            return list(self.ba.store.hlas)
+        return list(dict.fromkeys([h for h, p in self.ba.keys()]))
+
+    def _setMany(self, hlas, peptides, values):
+        with self.writeLock:
+            self.ba._update(hlas, peptides, values)
+
+    def _predict(self, method, batches):
+        """Queue a request and wait until it has been predicted, in this thread or in
+        the thread of another request that took it from the queue"""
+        request = dict(method=method, batches=batches, done=threading.Event(), result=0)
+        with self.pendingLock:
+            self.pending.append(request)
+        with self.predictLock:
+            with self.pendingLock:
+                todo, self.pending = self.pending, []
+            for m in dict.fromkeys([r['method'] for r in todo]):
+                group = [r for r in todo if r['method'] == m]
+                try:
+                    self._predictGroup(m, group)
+                except Exception as err:
+                    for r in group:
+                        r['result'] = err
+            for r in todo:
+                r['done'].set()
+        request['done'].wait()
+        if isinstance(request['result'], Exception):
+            raise request['result']
+        return request['result']
+
+    def _predictGroup(self, method, group):
+        """Predict the union of the requested pairs that are still missing in one plan"""
+        hlas = list(dict.fromkeys([h for r in group for bh, bp in r['batches'] for h in bh]))
+        peptides = list(dict.fromkeys([p for r in group for bh, bp in r['batches'] for p in bp if isvalidmer(p)]))
+        hlaIndex = {h:i for i, h in enumerate(hlas)}
+        pepIndex = {p:j for j, p in enumerate(peptides)}
+        masks = []
+        for r in group:
+            mask = np.zeros((len(hlas), len(peptides)), dtype=bool)
+            for bh, bp in r['batches']:
+                mask[np.ix_([hlaIndex[h] for h in bh], [pepIndex[p] for p in bp if p in pepIndex])] = True
+            masks.append(mask)
+        missing = np.logical_or.reduce(masks) & np.isnan(self.ba._lookupMany(hlas, peptides, cross=True).reshape((len(hlas), len(peptides))))
+        with self.writeLock:
+            self.ba._runPlan(method, _planBatches(hlas, peptides, missing), cpus=self.cpus)
+        for r, mask in zip(group, masks):
+            r['result'] = int((mask & missing).sum())
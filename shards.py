@@ -0,0 +1,205 @@
+"""
+Per-allele sharded cache layout.
+
+A shard directory holds one snapshot file (see snapshot.py) per HLA allele
+and a manifest.json listing the alleles, their shard files and prediction counts.
+A ShardedStore only reads the shards of the alleles that are actually queried
+(or explicitly preloaded), so startup time and memory scale with the number of
+alleles in use rather than with the size of the whole cache."""
+
+import os
+import re
+import json
+import numpy as np
+
+from .store import ArrayStore
+from .snapshot import writeSnapshot, readSnapshot
+
+__all__ = ['ShardedStore',
+           'writeShards']
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+def _shardFilename(hla):
+    return '%s.snap' % re.sub(r'[^\w.-]', '_', hla)
+
+def _readManifest(path):
+    with open(os.path.join(path, MANIFEST), 'r') as fh:
+        manifest = json.load(fh)
+    if manifest.get('version', 0) > VERSION:
+        raise ValueError('Shard manifest in %s has version %d (this code reads up to %d)' % (path, manifest['version'], VERSION))
+    return manifest
+
+def _writeManifest(path, shards, meta):
+    manifest = dict(version=VERSION, meta=meta, shards=shards)
+    tmpFn = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmpFn, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    """Replace atomically so readers never see a partial manifest"""
+    os.replace(tmpFn, os.path.join(path, MANIFEST))
+
+def _alleleStore(store, col, peptides):
+    """Single-allele ArrayStore with the non-missing predictions from column col of store.
+    peptides is the bytes array of all peptides in store row order."""
+    vals = store.gather(np.arange(store.nPeptides), np.full(store.nPeptides, col))
+    keep = np.nonzero(~np.isnan(vals))[0]
+    sorti = np.argsort(peptides[keep], kind='stable')
+    out = ArrayStore(quantize=store.quantized, valueRange=store.valueRange)
+    out.addHLAs([store.hlas[col]])
+    out.freeze(peptides[keep][sorti], out.encode(vals[keep][sorti]).reshape((keep.shape[0], 1)), count=keep.shape[0])
+    return out
+
+def writeShards(store, path, meta={}):
+    """Write each allele of an ArrayStore to its own snapshot file in directory path,
+    plus a manifest. Existing shards for other alleles in path are kept.
+
+    Parameters
+    ----------
+    store : ArrayStore
+    path : str
+        Output directory (created if needed)
+    meta : dict
+        JSON-serializable metadata stored in the manifest"""
+    if not all([isinstance(h, str) for h in store.hlas]):
+        raise ValueError('Shards hold the alleles of one prediction method (see MethodStore.forMethod())')
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        shards = _readManifest(path)['shards']
+    else:
+        shards = {}
+    peptides = store.allPeptides()
+    for col, h in enumerate(store.hlas):
+        fn = _shardFilename(h)
+        shard = _alleleStore(store, col, peptides)
+        writeSnapshot(shard, os.path.join(path, fn), meta=dict(hla=h))
+        shards[h] = dict(file=fn, count=len(shard))
+    _writeManifest(path, shards, meta)
+
+class ShardedStore(object):
+    """Store backed by a directory of per-allele snapshot shards (see writeShards()).
+
+    Shards are memory-mapped on first access to one of their alleles, or
+    explicitly with preload(). New predictions are kept in memory
+    (for new alleles in new in-memory shards) until save() is called.
+
+    Implements the same store interface as ArrayStore, so it can back an hlaStoreCache.
+
+    Parameters
+    ----------
+    path : str
+        Shard directory (created on save() if it does not exist)
+    mmap : bool
+        Memory-map shards instead of reading them into memory.
+    quantize : bool
+        Store values of new alleles as uint16 codes (see ArrayStore).
+        Shards read from disk keep the representation they were written with."""
+    def __init__(self, path, mmap=True, quantize=False):
+        self.path = path
+        self.mmap = mmap
+        self.quantize = quantize
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            manifest = _readManifest(path)
+            self.manifest = manifest['shards']
+            self.meta = manifest['meta']
+        else:
+            self.manifest = {}
+            self.meta = {}
+        self.shards = {}
+        self.dirty = set()
+
+    @property
+    def hlas(self):
+        return sorted(set(self.manifest.keys()) | set(self.shards.keys()))
+
+    def __len__(self):
+        n = np.sum([len(s) for s in self.shards.values()])
+        n += np.sum([v['count'] for h, v in self.manifest.items() if not h in self.shards])
+        return int(n)
+
+    def preload(self, hlas):
+        """Load the shards for these alleles now, instead of on first lookup"""
+        for h in hlas:
+            self._shard(h)
+
+    def loaded(self):
+        """Alleles whose shards are currently loaded"""
+        return sorted(self.shards.keys())
+
+    def _shard(self, hla, create=False):
+        """Return the ArrayStore for hla (loading it if needed) or None if there are no predictions for hla"""
+        try:
+            return self.shards[hla]
+        except KeyError:
+            if hla in self.manifest:
+                store, meta = readSnapshot(os.path.join(self.path, self.manifest[hla]['file']), mmap=self.mmap)
+                self.shards[hla] = store
+                return store
+            elif create:
+                self.shards[hla] = ArrayStore(quantize=self.quantize)
+                return self.shards[hla]
+            return None
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        shard = self._shard(hla)
+        if shard is None:
+            return np.nan
+        return shard.get(hla, peptide)
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs)"""
+        out = np.full(len(hlas), np.nan)
+        for h, ind in self._byHLA(hlas):
+            shard = self._shard(h)
+            if not shard is None:
+                out[ind] = shard.getMany([h] * len(ind), [peptides[i] for i in ind])
+        return out
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        out = np.full((len(hlas), len(peptides)), np.nan)
+        for h, ind in self._byHLA(hlas):
+            shard = self._shard(h)
+            if not shard is None:
+                out[ind, :] = shard.getCross([h], peptides)
+        return out
+
+    def setMany(self, hlas, peptides, values):
+        """Store predictions in the (in-memory) shards of their alleles. Use save() to write them to disk."""
+        values = np.asarray(values, dtype=float)
+        for h, ind in self._byHLA(hlas):
+            self._shard(h, create=True).setMany([h] * len(ind), [peptides[i] for i in ind], values[ind])
+            self.dirty.add(h)
+
+    def save(self):
+        """Write modified shards and the manifest to disk"""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for h in sorted(self.dirty):
+            fn = _shardFilename(h)
+            shard = self.shards[h]
+            tmpFn = os.path.join(self.path, fn + '.tmp')
+            writeSnapshot(shard, tmpFn, meta=dict(hla=h))
+            os.replace(tmpFn, os.path.join(self.path, fn))
+            self.manifest[h] = dict(file=fn, count=len(shard))
+            """Next access maps the new file"""
+            del self.shards[h]
+        self.dirty = set()
+        _writeManifest(self.path, self.manifest, self.meta)
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all stored predictions (loads every shard)"""
+        for h in self.hlas:
+            for item in self._shard(h).iterItems():
+                yield item
+
+    def _byHLA(self, hlas):
+        """Generator over (hla, array of positions in hlas)"""
+        groups = {}
+        for i, h in enumerate(hlas):
+            groups.setdefault(h, []).append(i)
+        for h, ind in groups.items():
+            yield h, np.array(ind, dtype=np.int64)
@@ -0,0 +1,122 @@
+"""
+Publishing an ArrayStore to shared memory for multiprocessing workers.
+
+publishStore() copies a store, in the snapshot layout (see snapshot.py), into one
+multiprocessing.shared_memory block. Other processes attach to the block by name with
+attachStore() and look predictions up in numpy views of it: nothing is copied or
+unpickled, and since the values are not Python objects, reading them never writes
+to a refcount, so the pages stay shared and a pool of workers uses about one
+copy of the cache in total.
+
+An attached ArrayStore is pickled as the name of its block, so a cache backed by one
+can be passed to pool workers (e.g. with parmap or Pool.map) at the cost of a few
+bytes per task. Each process attaches to a block once and reuses that store, until
+detachStore() is called or a newer block of the same publisher is attached (e.g. when
+a cache is published again after an update)."""
+
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+
+from .snapshot import snapshotChunks, parseHeader, storeFromArrays
+
+__all__ = ['publishStore',
+           'attachStore',
+           'detachStore']
+
+"""Stores attached in this process, by block name"""
+_attached = {}
+
+def publishStore(store, name=None, meta={}, publisher=None):
+    """Copy an ArrayStore into a new shared memory block.
+
+    Parameters
+    ----------
+    store : ArrayStore
+    name : str or None
+        Name of the block (a random name if None)
+    meta : dict
+        JSON-serializable metadata returned by attachStore()
+    publisher : str or None
+        Identifies the source of the block (stored as meta['publisher']): attaching to
+        the block detaches the blocks of the same publisher attached earlier in that process.
+
+    Returns
+    -------
+    shm : multiprocessing.shared_memory.SharedMemory
+        The block (workers attach with shm.name). The publishing process owns it
+        and should call shm.close() and shm.unlink() when the workers are done."""
+    if not publisher is None:
+        meta = dict(meta, publisher=publisher)
+    size, chunks = snapshotChunks(store, meta=meta)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(size, 1))
+    for offset, data in chunks:
+        shm.buf[offset:offset + len(data)] = data
+    return shm
+
+def _open(name):
+    try:
+        """Python >= 3.13: don't let this process's resource tracker unlink the block when it exits"""
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def attachStore(name):
+    """Attach to a store published by publishStore() (in this or another process).
+
+    The peptide table, values (and cores) of the returned store are read-only views of
+    the shared block, so the store should be treated as read-only.
+    The block stays mapped as long as the store exists (see detachStore()).
+
+    Note that before Python 3.13 a process that attaches registers the block with its
+    resource tracker, so a process that was not started from the publishing process
+    (which shares its tracker) will unlink the block when it exits.
+
+    Returns
+    -------
+    store : ArrayStore (CoreStore if the published store had binding cores,
+            VersionedStore if it had fingerprints)
+    meta : dict
+        Metadata passed to publishStore()"""
+    if name in _attached:
+        store = _attached[name]
+        return store, store.sharedMeta
+    shm = _open(name)
+    header = parseHeader(shm.buf, name)
+
+    def _getArray(arrayName):
+        info = header['arrays'][arrayName]
+        arr = np.ndarray(tuple(info['shape']), dtype=np.dtype(info['dtype']), buffer=shm.buf, offset=info['offset'])
+        arr.flags.writeable = False
+        return arr
+    store = storeFromArrays(header, _getArray)
+    store.sharedMemory = shm
+    store.sharedMeta = header['meta']
+    publisher = header['meta'].get('publisher')
+    if not publisher is None:
+        for old in [n for n, s in _attached.items() if s.sharedMeta.get('publisher') == publisher]:
+            detachStore(old)
+    _attached[name] = store
+    return store, header['meta']
+
+def detachStore(name):
+    """Forget the store attached to the block name in this process and close the block.
+
+    If the store (or a cache on it) is still referenced the block is not closed,
+    since numpy views of it don't prevent unmapping: it is closed (by SharedMemory.__del__)
+    once the last reference is dropped.
+
+    Returns True if a store was attached to the block."""
+    store = _attached.pop(name, None)
+    if store is None:
+        return False
+    shm = store.sharedMemory
+    ref = weakref.ref(store)
+    del store
+    if ref() is None:
+        shm.close()
+    return True
+
+def attachedStore(name):
+    """Store attached to the block name (used to unpickle attached stores)"""
+    return attachStore(name)[0]
@@ -0,0 +1,62 @@
+import numpy as np
+
+__all__ = ['SliceStore']
+
+class SliceStore(object):
+    """Read-only view of another store restricted to a set of alleles and peptides.
+
+    Nothing is copied: lookups inside the slice are passed to the underlying
+    store (so later updates to it are visible) and pairs outside the slice return nan.
+
+    Implements the same store interface as ArrayStore, so it can back an hlaStoreCache
+    (see hlaStoreCache.slice(..., view=True)).
+
+    Parameters
+    ----------
+    store : store
+        Underlying store (e.g. ArrayStore)
+    hlas : list
+        Alleles in the slice (in the store's key format, e.g. A_0201)
+    peptides : list
+        Peptides in the slice"""
+    def __init__(self, store, hlas, peptides):
+        self.store = store
+        self.hlas = list(dict.fromkeys(hlas))
+        self.peptides = list(dict.fromkeys(peptides))
+        self.hlaSet = set(self.hlas)
+        self.pepSet = set(self.peptides)
+
+    def __len__(self):
+        return int((~np.isnan(self.store.getCross(self.hlas, self.peptides))).sum())
+
+    def _inside(self, keys, keySet):
+        return np.fromiter((k in keySet for k in keys), dtype=bool, count=len(keys))
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        if hla in self.hlaSet and peptide in self.pepSet:
+            return self.store.get(hla, peptide)
+        return np.nan
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs and pairs outside the slice)"""
+        out = self.store.getMany(hlas, peptides)
+        out[~(self._inside(hlas, self.hlaSet) & self._inside(peptides, self.pepSet))] = np.nan
+        return out
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        out = self.store.getCross(hlas, peptides)
+        out[~self._inside(hlas, self.hlaSet), :] = np.nan
+        out[:, ~self._inside(peptides, self.pepSet)] = np.nan
+        return out
+
+    def setMany(self, hlas, peptides, values):
+        raise TypeError('SliceStore is a read-only view (use slice(..., view=False) for a copy)')
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all predictions in the slice"""
+        vals = self.store.getCross(self.hlas, self.peptides)
+        for i, j in zip(*np.nonzero(~np.isnan(vals))):
+            yield (self.hlas[i], self.peptides[j]), float(vals[i, j])
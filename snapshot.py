@@ -0,0 +1,196 @@
+"""
+Versioned binary snapshot format for ArrayStore predictions.
+
+Layout (all integers little-endian):
+    bytes 0-7      magic b'HLAPCSNP'
+    bytes 8-11     uint32 format version (1, or 2 for quantized values)
+    bytes 12-19    uint64 length of the JSON header
+    JSON header    hlas, count, user metadata and the dtype/shape/offset of each array
+    arrays         each starting on a 64 byte boundary:
+                    peptides : fixed-width bytes, sorted (so lookups can use np.searchsorted)
+                    values : float32 [nPeptides, nHLA] with rows in the same order as peptides
+                             (uint16 codes for a quantized ArrayStore, with the header
+                             holding the valueRange needed to decode them)
+                    cores : int8 [nPeptides, nHLA] binding core offsets, only for a CoreStore
+                            (the header holds the coreLength)
+                    tags : uint16 [nPeptides, nHLA] fingerprint ids, only for a VersionedStore
+                           (the header holds the table of fingerprints)
+
+Because the peptide table is sorted and the values are a plain C-ordered
+matrix, both can be memory-mapped and used without parsing or copying.
+The same layout is used to publish a store to shared memory (see sharedstore.py)."""
+
+import json
+import struct
+import numpy as np
+
+from .store import ArrayStore
+from .corestore import CoreStore
+from .versionstore import VersionedStore
+
+__all__ = ['writeSnapshot',
+           'readSnapshot',
+           'snapshotChunks',
+           'parseHeader',
+           'storeFromArrays']
+
+MAGIC = b'HLAPCSNP'
+VERSION = 2
+ALIGN = 64
+PREFIX = struct.Struct('<8sIQ')
+
+def _align(n):
+    return ((n + ALIGN - 1) // ALIGN) * ALIGN
+
+def snapshotChunks(store, meta={}, chunkSize=2**16):
+    """Lay out an ArrayStore (or a VersionedStore) in the snapshot format.
+
+    Returns
+    -------
+    size : int
+        Total size of the snapshot in bytes.
+    chunks : generator
+        (offset, bytes) pieces of the snapshot (prefix and header first), to be written
+        at those offsets of a file or buffer of size bytes (e.g. shared memory)"""
+    peptides = store.allPeptides()
+    if peptides.shape[0] == 0:
+        peptides = peptides.astype('S1')
+    nHLA = len(store.hlas)
+    valueDtype = np.dtype(store.dtype).newbyteorder('<')
+
+    """Unquantized snapshots are still written as version 1 so older code can read them"""
+    header = dict(version=2 if store.quantized else 1,
+                  hlas=list(store.hlas),
+                  count=len(store.store if isinstance(store, VersionedStore) else store),
+                  meta=meta,
+                  arrays={})
+    if store.quantized:
+        header['valueRange'] = list(store.valueRange)
+    """Header length determines the array offsets, so compute offsets for a header with placeholder offsets first"""
+    arrays = [('peptides', peptides.dtype, (peptides.shape[0],)),
+              ('values', valueDtype, (peptides.shape[0], nHLA))]
+    versioned = isinstance(store, VersionedStore)
+    base = store.store if versioned else store
+    if isinstance(base, CoreStore):
+        header['coreLength'] = base.coreLength
+        arrays.append(('cores', np.dtype(np.int8), (peptides.shape[0], nHLA)))
+    if versioned:
+        header['fingerprints'] = list(store.fingerprints)
+        header['fingerprint'] = store.fingerprint
+        arrays.append(('tags', np.dtype('<u2'), (peptides.shape[0], nHLA)))
+    for name, dtype, shape in arrays:
+        header['arrays'][name] = dict(dtype=dtype.str, shape=list(shape), offset=0)
+    headerLen = len(json.dumps(header).encode()) + 32 * len(arrays)
+    offset = _align(PREFIX.size + headerLen)
+    for name, dtype, shape in arrays:
+        header['arrays'][name]['offset'] = offset
+        offset = _align(offset + dtype.itemsize * int(np.prod(shape)))
+    headerBytes = json.dumps(header).encode()
+    headerBytes += b' ' * (headerLen - len(headerBytes))
+
+    def _chunks():
+        yield 0, PREFIX.pack(MAGIC, header['version'], headerLen) + headerBytes
+        sorti = np.argsort(peptides, kind='stable')
+        yield header['arrays']['peptides']['offset'], peptides[sorti].tobytes()
+        rowArrays = [('values', lambda rows: store.rowValues(rows).astype(valueDtype))]
+        if 'cores' in header['arrays']:
+            rowArrays.append(('cores', base.rowOffsets))
+        if 'tags' in header['arrays']:
+            rowArrays.append(('tags', lambda rows: store.tags.rowValues(rows).astype('<u2')))
+        for name, rowFunc in rowArrays:
+            pos = header['arrays'][name]['offset']
+            for starti in range(0, sorti.shape[0], chunkSize):
+                data = rowFunc(sorti[starti:starti + chunkSize]).tobytes()
+                yield pos, data
+                pos += len(data)
+    return offset, _chunks()
+
+def writeSnapshot(store, fn, meta={}, chunkSize=2**16):
+    """Write an ArrayStore to a snapshot file.
+
+    Parameters
+    ----------
+    store : ArrayStore
+    fn : str
+        Output filename.
+    meta : dict
+        JSON-serializable metadata stored in the header (e.g. name, predictionMethod)
+    chunkSize : int
+        Number of peptide rows gathered and written at a time."""
+    size, chunks = snapshotChunks(store, meta=meta, chunkSize=chunkSize)
+    with open(fn, 'wb') as fh:
+        for offset, data in chunks:
+            fh.seek(offset)
+            fh.write(data)
+        fh.truncate(size)
+
+def parseHeader(data, source='buffer'):
+    """Parse the snapshot header at the start of data (bytes or a buffer such as shared memory)"""
+    magic, version, headerLen = PREFIX.unpack(bytes(data[:PREFIX.size]))
+    if not magic == MAGIC:
+        raise ValueError('%s is not an HLAPredCache snapshot' % source)
+    if version > VERSION:
+        raise ValueError('Snapshot %s has format version %d (this code reads up to %d)' % (source, version, VERSION))
+    return json.loads(bytes(data[PREFIX.size:PREFIX.size + headerLen]).decode())
+
+def _readHeader(fn):
+    with open(fn, 'rb') as fh:
+        prefix = fh.read(PREFIX.size)
+        magic, version, headerLen = PREFIX.unpack(prefix)
+        if not magic == MAGIC:
+            headerLen = 0
+        return parseHeader(prefix + fh.read(headerLen), fn)
+
+def _readArray(fn, info, mmap, mode='r'):
+    dtype = np.dtype(info['dtype'])
+    shape = tuple(info['shape'])
+    count = int(np.prod(shape))
+    if count == 0:
+        return np.empty(shape, dtype=dtype)
+    if mmap:
+        return np.memmap(fn, dtype=dtype, mode=mode, offset=info['offset'], shape=shape)
+    else:
+        return np.fromfile(fn, dtype=dtype, count=count, offset=info['offset']).reshape(shape)
+
+def storeFromArrays(header, getArray):
+    """Build a frozen ArrayStore (CoreStore, or VersionedStore if the snapshot has fingerprints)
+    from a snapshot header, with getArray(name) returning each array
+    (e.g. memory-mapped or in shared memory)"""
+    quantize = dict(quantize=True, valueRange=header['valueRange']) if 'valueRange' in header else {}
+    if 'cores' in header['arrays']:
+        store = CoreStore(coreLength=header['coreLength'], **quantize)
+    else:
+        store = ArrayStore(**quantize)
+    """Keys of a multi-method store are (method, hla) pairs, stored as JSON lists"""
+    store.addHLAs([tuple(h) if isinstance(h, list) else h for h in header['hlas']])
+    if 'cores' in header['arrays']:
+        store.freeze(getArray('peptides'), getArray('values'), count=header['count'], cores=getArray('cores'))
+    else:
+        store.freeze(getArray('peptides'), getArray('values'), count=header['count'])
+    if 'tags' in header['arrays']:
+        store = VersionedStore(store, fingerprint=header['fingerprint'])
+        store.freezeTags(getArray('tags'), header['fingerprints'])
+    return store
+
+def readSnapshot(fn, mmap=True):
+    """Read a snapshot file written by writeSnapshot()
+
+    Parameters
+    ----------
+    fn : str
+        Snapshot filename.
+    mmap : bool
+        If True, memory-map the peptide table and values so that loading
+        is nearly instantaneous and pages are read from disk on first access.
+        Values are mapped copy-on-write: the store can be updated but the file is not changed.
+
+    Returns
+    -------
+    store : ArrayStore (CoreStore if the snapshot has binding cores,
+            VersionedStore if it has fingerprints)
+    meta : dict
+        Metadata that was passed to writeSnapshot()"""
+    header = _readHeader(fn)
+    arrays = header['arrays']
+    store = storeFromArrays(header, lambda name: _readArray(fn, arrays[name], mmap, mode='r' if name == 'peptides' else 'c'))
+    return store, header['meta']
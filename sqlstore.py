@@ -0,0 +1,111 @@
+import sqlite3
+import numpy as np
+
+__all__ = ['SqliteStore']
+
+class SqliteStore(object):
+    """Persistent storage for HLA:peptide predictions in an indexed SQLite file.
+
+    Predictions are stored as rows of (method, hla, peptide, value) with a
+    primary key on (method, hla, peptide). Nothing is loaded into memory up front:
+    lookups are batched into a few SELECT ... IN (...) queries and inserts are
+    written in a single transaction per call, so memory use depends only on
+    the size of each request, not on the size of the database.
+
+    Implements the same store interface as ArrayStore (get, getMany, getCross,
+    setMany, iterItems, len) so it can back an hlaStoreCache.
+
+    Parameters
+    ----------
+    fn : str
+        SQLite filename (created if it does not exist)
+    method : str
+        Prediction method used for all lookups and inserts through this store.
+    batchSize : int
+        Maximum number of values bound in each IN (...) clause
+        (SQLite limits the number of variables in a statement)."""
+    def __init__(self, fn, method='', batchSize=400):
+        self.fn = fn
+        self.method = method
+        self.batchSize = batchSize
+        self.con = sqlite3.connect(fn, check_same_thread=False)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                                method TEXT NOT NULL,
+                                hla TEXT NOT NULL,
+                                peptide TEXT NOT NULL,
+                                value REAL NOT NULL,
+                                PRIMARY KEY (method, hla, peptide)) WITHOUT ROWID""")
+        self.con.commit()
+
+    def __len__(self):
+        return self.con.execute('SELECT COUNT(*) FROM predictions WHERE method = ?', (self.method,)).fetchone()[0]
+
+    def __getstate__(self):
+        """Connections can't be pickled, reconnect to the same file instead"""
+        state = self.__dict__.copy()
+        del state['con']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.con = sqlite3.connect(self.fn, check_same_thread=False)
+
+    def close(self):
+        self.con.close()
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        row = self.con.execute('SELECT value FROM predictions WHERE method = ? AND hla = ? AND peptide = ?',
+                               (self.method, hla, peptide)).fetchone()
+        return np.nan if row is None else row[0]
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs)"""
+        out = np.full(len(hlas), np.nan)
+        byHLA = {}
+        for i, (h, p) in enumerate(zip(hlas, peptides)):
+            byHLA.setdefault(h, {}).setdefault(p, []).append(i)
+        for h, pepInds in byHLA.items():
+            for (hh, p), v in self._query([h], list(pepInds.keys())):
+                out[pepInds[p]] = v
+        return out
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        out = np.full((len(hlas), len(peptides)), np.nan)
+        hlaInds = {}
+        for i, h in enumerate(hlas):
+            hlaInds.setdefault(h, []).append(i)
+        pepInds = {}
+        for j, p in enumerate(peptides):
+            pepInds.setdefault(p, []).append(j)
+        for (h, p), v in self._query(list(hlaInds.keys()), list(pepInds.keys())):
+            out[np.ix_(hlaInds[h], pepInds[p])] = v
+        return out
+
+    def _query(self, hlas, peptides):
+        """Generator over ((hla, peptide), value) for stored pairs in the cross product of hlas and peptides"""
+        n = max(1, self.batchSize // 4)
+        for hi in range(0, len(hlas), n):
+            hlaBatch = hlas[hi:hi + n]
+            m = self.batchSize - len(hlaBatch)
+            for pi in range(0, len(peptides), m):
+                pepBatch = peptides[pi:pi + m]
+                sql = 'SELECT hla, peptide, value FROM predictions WHERE method = ? AND hla IN (%s) AND peptide IN (%s)'
+                sql = sql % (','.join('?' * len(hlaBatch)), ','.join('?' * len(pepBatch)))
+                for h, p, v in self.con.execute(sql, [self.method] + hlaBatch + pepBatch):
+                    yield (h, p), v
+
+    def setMany(self, hlas, peptides, values):
+        """Store predictions for paired sequences of alleles, peptides and values
+        in one transaction. Existing values are overwritten (like dict.update), nan values are skipped."""
+        rows = ((self.method, h, p, float(v)) for h, p, v in zip(hlas, peptides, values) if not np.isnan(v))
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)', rows)
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all stored predictions"""
+        cur = self.con.execute('SELECT hla, peptide, value FROM predictions WHERE method = ?', (self.method,))
+        for h, p, v in cur:
+            yield (h, p), v
@@ -0,0 +1,320 @@
+import numpy as np
+
+from .encoding import PeptideIndex
+
+__all__ = ['ArrayStore']
+
+"""uint16 code marking a missing value in a quantized ArrayStore"""
+QMISSING = np.iinfo(np.uint16).max
+
+class ArrayStore(object):
+    """Compact storage for HLA:peptide predictions as an allele x peptide matrix.
+
+    Alleles and peptides are each mapped to an integer index and the
+    log-IC50 values live in float32 blocks of blockSize peptide rows
+    (one column per allele). Missing predictions are stored as nan
+    (or a reserved code when quantized, see below).
+    Growing the store appends new blocks instead of reallocating the
+    whole matrix, so peak memory during loading stays close to the final size.
+
+    At ~4 bytes per (hla, peptide) cell plus the shared index entries this is
+    more than an order of magnitude smaller than a dict of tuple keys and float objects.
+
+    Peptides are indexed in two tiers: a sorted, read-only table of bytes
+    (frozenPeptides, rows 0 to nFrozen - 1, e.g. memory-mapped from a snapshot)
+    that is searched with np.searchsorted, and a PeptideIndex of uint64 peptide codes
+    (see encoding.py) for peptides added since.
+
+    With quantize=True values are stored as uint16 fixed-point codes
+    over valueRange instead of float32 (2 bytes per cell, in memory and in snapshots).
+    Values are decoded to float on every lookup, with a maximum absolute
+    error of maxError = (hi - lo) / (2 * 65534), i.e. 1.2e-4 for the default
+    range of 0 to 16 (log-IC50 of 1 nM to 8.9e6 nM). Storing a value outside the range
+    raises ValueError (nothing of that batch is stored).
+
+    Parameters
+    ----------
+    blockSize : int
+        Number of peptide rows per block.
+    hlaCapacity : int
+        Initial number of allele columns allocated in each block.
+    quantize : bool
+        Store values as uint16 codes instead of float32.
+    valueRange : tuple
+        (lo, hi) range of the quantized values."""
+    def __init__(self, blockSize=2**12, hlaCapacity=8, quantize=False, valueRange=(0., 16.)):
+        self.blockSize = blockSize
+        self.hlaCapacity = hlaCapacity
+        self.quantized = quantize
+        self.valueRange = tuple(float(v) for v in valueRange)
+        if quantize:
+            self.dtype = np.uint16
+            self.missing = QMISSING
+            self.step = (self.valueRange[1] - self.valueRange[0]) / (QMISSING - 1)
+        else:
+            self.dtype = np.float32
+            self.missing = np.nan
+            self.step = 0.
+        self.hlaIndex = {}
+        self.hlas = []
+        self.frozenPeptides = np.empty(0, dtype='S1')
+        self.pepIndex = PeptideIndex()
+        self.blocks = []
+        self._count = 0
+
+    def __len__(self):
+        """Number of (hla, peptide) pairs with a prediction"""
+        return self._count
+
+    def __reduce_ex__(self, protocol):
+        """A store attached to shared memory is pickled as the name of its block (see sharedstore.py)"""
+        shm = getattr(self, 'sharedMemory', None)
+        if shm is None:
+            return object.__reduce_ex__(self, protocol)
+        from .sharedstore import attachedStore
+        return attachedStore, (shm.name,)
+
+    @property
+    def nFrozen(self):
+        return self.frozenPeptides.shape[0]
+
+    @property
+    def nPeptides(self):
+        return self.nFrozen + len(self.pepIndex)
+
+    @property
+    def shape(self):
+        return (self.nPeptides, len(self.hlas))
+
+    @property
+    def maxError(self):
+        """Maximum absolute error of quantized values (0 for float32 storage)"""
+        return self.step / 2
+
+    def encode(self, values):
+        """Convert float values (nan for missing) to the stored representation
+        (raises ValueError for values outside valueRange if quantized)"""
+        values = np.asarray(values, dtype=float)
+        if not self.quantized:
+            return values.astype(self.dtype)
+        lo, hi = self.valueRange
+        outside = (values < lo - self.maxError) | (values > hi + self.maxError)
+        if outside.any():
+            raise ValueError('%d values outside the quantized valueRange (%g, %g) of the store, e.g. %g'
+                             % (outside.sum(), lo, hi, values[outside][0]))
+        """Clipping only absorbs rounding at the ends of the range"""
+        codes = np.clip(np.rint((values - self.valueRange[0]) / self.step), 0, QMISSING - 1)
+        codes[np.isnan(values)] = QMISSING
+        return codes.astype(self.dtype)
+
+    def decode(self, stored):
+        """Convert stored values to float64 (nan for missing)"""
+        if not self.quantized:
+            return np.asarray(stored, dtype=float)
+        out = self.valueRange[0] + np.asarray(stored, dtype=float) * self.step
+        out[np.asarray(stored) == QMISSING] = np.nan
+        return out
+
+    def isMissing(self, stored):
+        """Boolean mask of missing cells in an array of stored values"""
+        if self.quantized:
+            return stored == QMISSING
+        return np.isnan(stored)
+
+    @property
+    def nbytes(self):
+        """Bytes used by the value blocks (excludes the index dicts)"""
+        return int(np.sum([b.nbytes for b in self.blocks]))
+
+    def addHLAs(self, hlas):
+        """Add alleles to the index (if new) and return their column indices"""
+        cols = np.empty(len(hlas), dtype=np.int64)
+        for i, h in enumerate(hlas):
+            try:
+                cols[i] = self.hlaIndex[h]
+            except KeyError:
+                cols[i] = self.hlaIndex[h] = len(self.hlas)
+                self.hlas.append(h)
+        self._reserveColumns(len(self.hlas))
+        return cols
+
+    def addPeptides(self, peptides):
+        """Add peptides to the index (if new) and return their row indices"""
+        if self.nFrozen == 0:
+            rows = self.pepIndex.add(peptides)
+        else:
+            rows = self._frozenIndices(np.asarray(peptides, dtype=bytes))
+            todo = np.nonzero(rows < 0)[0]
+            if len(todo) > 0:
+                rows[todo] = self.pepIndex.add([peptides[i] for i in todo]) + self.nFrozen
+        self._reserveRows(self.nPeptides)
+        return rows
+
+    def hlaIndices(self, hlas):
+        """Column index of each allele (-1 if not in the store)"""
+        get = self.hlaIndex.get
+        return np.fromiter((get(h, -1) for h in hlas), dtype=np.int64, count=len(hlas))
+
+    def peptideIndices(self, peptides):
+        """Row index of each peptide (-1 if not in the store)"""
+        rows = self.pepIndex.lookup(peptides)
+        rows[rows >= 0] += self.nFrozen
+        if self.nFrozen > 0 and len(peptides) > 0:
+            todo = np.nonzero(rows < 0)[0]
+            if len(todo) > 0:
+                rows[todo] = self._frozenIndices(np.asarray([peptides[i] for i in todo], dtype=bytes))
+        return rows
+
+    def _frozenIndices(self, query):
+        """Row indices of query (bytes array) in the sorted frozenPeptides table, -1 if absent"""
+        pos = np.searchsorted(self.frozenPeptides, query)
+        pos[pos >= self.nFrozen] = 0
+        return np.where(self.frozenPeptides[pos] == query, pos, -1)
+
+    def peptideAt(self, rows):
+        """Peptide strings for an array of row indices"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.nFrozen == 0:
+            return self.pepIndex.peptides(rows)
+        out = self.frozenPeptides[np.minimum(rows, self.nFrozen - 1)].astype(str).tolist()
+        added = np.nonzero(rows >= self.nFrozen)[0]
+        for i, p in zip(added, self.pepIndex.peptides(rows[added] - self.nFrozen)):
+            out[i] = p
+        return out
+
+    def allPeptides(self):
+        """Bytes array of all peptides in row order"""
+        added = np.asarray(self.pepIndex.peptides(np.arange(len(self.pepIndex))), dtype=bytes)
+        return np.concatenate((self.frozenPeptides.astype(bytes), added))
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        c = self.hlaIndex.get(hla, -1)
+        if c < 0:
+            return np.nan
+        r = self.pepIndex.get(peptide)
+        if r >= 0:
+            r += self.nFrozen
+        elif self.nFrozen > 0:
+            r = self._frozenIndices(np.asarray([peptide], dtype=bytes))[0]
+        if r < 0:
+            return np.nan
+        return float(self.decode(self.blocks[r // self.blockSize][r % self.blockSize, c:c + 1])[0])
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs)"""
+        return self.gather(self.peptideIndices(peptides), self.hlaIndices(hlas))
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        rows = self.peptideIndices(peptides)
+        cols = self.hlaIndices(hlas)
+        vals = self.gather(np.tile(rows, len(cols)), np.repeat(cols, len(rows)))
+        return vals.reshape((len(cols), len(rows)))
+
+    def gather(self, rows, cols):
+        """Return values for paired row/column indices (nan where either index is -1)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        out = np.full(rows.shape[0], np.nan)
+        ok = np.nonzero((rows >= 0) & (cols >= 0))[0]
+        for b, ind in self._byBlock(rows[ok], ok):
+            out[ind] = self.decode(self.blocks[b][rows[ind] - b * self.blockSize, cols[ind]])
+        return out
+
+    def rowValues(self, rows):
+        """Return a [len(rows), nHLA] matrix with all alleles for the given peptide rows
+        (in the stored representation, see decode())"""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((rows.shape[0], len(self.hlas)), dtype=self.dtype)
+        for b, ind in self._byBlock(rows, np.arange(rows.shape[0])):
+            out[ind, :] = self.blocks[b][rows[ind] - b * self.blockSize, :len(self.hlas)]
+        return out
+
+    def setMany(self, hlas, peptides, values):
+        """Store predictions for paired sequences of alleles, peptides and values.
+        Existing values are overwritten (like dict.update)"""
+        cols = self.addHLAs(hlas)
+        rows = self.addPeptides(peptides)
+        self.scatter(rows, cols, values)
+
+    def scatter(self, rows, cols, values):
+        """Assign values at paired row/column indices, which must already exist"""
+        values = self.encode(values)
+        ind = np.arange(rows.shape[0])
+        for b, bind in self._byBlock(rows, ind):
+            r = rows[bind] - b * self.blockSize
+            c = cols[bind]
+            block = self.blocks[b]
+            """Count each cell once, even if it is assigned more than once"""
+            cells = np.unique(r * block.shape[1] + c)
+            ur, uc = np.divmod(cells, block.shape[1])
+            self._count += int(self.isMissing(block[ur, uc]).sum())
+            block[r, c] = values[bind]
+            self._count -= int(self.isMissing(block[ur, uc]).sum())
+
+    def countColumns(self, cols):
+        """Number of stored predictions in the given allele columns"""
+        cols = np.asarray(cols, dtype=np.int64)
+        cols = cols[cols >= 0]
+        n = 0
+        for b, block in enumerate(self.blocks):
+            nRows = min(block.shape[0], self.nPeptides - b * self.blockSize)
+            n += int((~self.isMissing(block[:nRows, cols])).sum())
+        return n
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all stored predictions"""
+        for b, block in enumerate(self.blocks):
+            nRows = min(block.shape[0], self.nPeptides - b * self.blockSize)
+            r, c = np.nonzero(~self.isMissing(block[:nRows, :len(self.hlas)]))
+            vals = self.decode(block[r, c])
+            peps = self.peptideAt(r + b * self.blockSize)
+            for p, ci, v in zip(peps, c, vals):
+                yield (self.hlas[ci], p), float(v)
+
+    def freeze(self, peptides, values, count=None):
+        """Replace the contents of an empty store with a sorted peptide table and
+        a [nPeptides, nHLA] value matrix (e.g. np.memmap arrays from a snapshot)
+        in the stored representation (see encode()).
+        Blocks are views into values, so nothing is copied until it is modified."""
+        if self.nPeptides > 0:
+            raise ValueError('Can only freeze an empty ArrayStore')
+        self.frozenPeptides = peptides
+        self.hlaCapacity = max(values.shape[1], 1)
+        self.blocks = [values[i:i + self.blockSize] for i in range(0, values.shape[0], self.blockSize)]
+        if count is None:
+            count = int((~self.isMissing(values)).sum())
+        self._count = count
+
+    def _byBlock(self, rows, ind):
+        """Group positions ind (parallel to rows) by the block holding each row"""
+        if rows.shape[0] == 0:
+            return
+        bi = rows // self.blockSize
+        sorti = np.argsort(bi, kind='stable')
+        ub, starts = np.unique(bi[sorti], return_index=True)
+        for b, group in zip(ub, np.split(ind[sorti], starts[1:])):
+            yield b, group
+
+    def _reserveColumns(self, nCols):
+        while self.hlaCapacity < nCols:
+            self.hlaCapacity *= 2
+        for i, b in enumerate(self.blocks):
+            if b.shape[1] < nCols:
+                tmp = np.full((b.shape[0], self.hlaCapacity), self.missing, dtype=self.dtype)
+                tmp[:, :b.shape[1]] = b
+                self.blocks[i] = tmp
+
+    def _reserveRows(self, nRows):
+        if nRows <= np.sum([b.shape[0] for b in self.blocks]):
+            return
+        if len(self.blocks) > 0 and self.blocks[-1].shape[0] < self.blockSize:
+            """Last block can be short (e.g. a view of a snapshot), replace it with a full one"""
+            b = self.blocks[-1]
+            tmp = np.full((self.blockSize, b.shape[1]), self.missing, dtype=self.dtype)
+            tmp[:b.shape[0]] = b
+            self.blocks[-1] = tmp
+        while len(self.blocks) * self.blockSize < nRows:
+            self.blocks.append(np.full((self.blockSize, self.hlaCapacity), self.missing, dtype=self.dtype))
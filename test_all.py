@@ -1,8 +1,30 @@
 import unittest
+import os
+import io
+import contextlib
+import tempfile
+import threading
+import pickle
+from multiprocessing import Pool
+from multiprocessing import AuthenticationError
 import numpy as np
 
-from .cache import hlaPredCache, RandCache
+from .cache import hlaPredCache, hlaStoreCache, hlaConcurrentCache, hlaCacheClient, RandCache, loadSnapshot, loadShards, loadParquet, attachShared, detachShared
 from .predict import iedbPredict
+from .sqlstore import SqliteStore
+from .lrustore import LRUStore
+from .store import ArrayStore
+from .methodstore import MethodStore
+from .corestore import CoreStore, coreOffsets
+from .versionstore import VersionedStore
+from . import sharedstore
+from . import parquetio
+from .snapshot import writeSnapshot
+from .fingerprint import predictorFingerprint
+from .predict import iedbFingerprint, iedbVersion
+from .server import CacheServer
+from .loader import readPredictionChunks, readPredictionFiles, _hasPyarrow
+from .encoding import encodePeptide, encodePeptides, decodePeptides, codeLengths, PeptideIndex
 from .helpers import *
 
 class TestHelpers(unittest.TestCase):
@@ -55,6 +77,981 @@ class TestCache(unittest.TestCase):
         """This peptide is a known A*02 binder"""
         self.assertTrue(ba[('A*0201', 'SLYNTVATL')] < np.exp(6))
         self.assertEqual(nAdded, 3 * len(mers))
+    def test_plan(self):
+        ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        hlas = ['A*2601', 'A*3201', 'B*9901']
+        mers = ['MGPGQVLFR', 'GSSSQVSRN', 'SLYNTVATL', 'SLYNTVATLY', 'AGPGXVLFR']
+        batches, nInvocations, nPairs = ba.planPredictions(hlas, mers)
+        missing = {(h, m) for h in hlas for m in mers if isvalidmer(m) and np.isnan(ba[(h, m)])}
+        planned = [(h, m) for bh, bm in batches for h in bh for m in bm]
+        self.assertEqual(len(planned), len(set(planned)))
+        self.assertEqual(set(planned), missing)
+        self.assertEqual(nPairs, len(missing))
+        """B*9901 needs both 9-mers and a 10-mer, the others only the new 9-mer and the 10-mer"""
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(nInvocations, 3 + 3)
+    def test_add_rand(self):
+        ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        before = ba[('A*2601', 'MGPGQVLFR')]
+        batches, nInvocations, nPairs = ba.planPredictions(['A*2601', 'B*9901'], ['MGPGQVLFR', 'SLYNTVATL'])
+        nAdded = ba.addPredictions('RAND', ['A*2601', 'B*9901'], ['MGPGQVLFR', 'SLYNTVATL'])
+        self.assertEqual(nAdded, nPairs)
+        self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], before)
+        self.assertEqual(ba.planPredictions(['A*2601', 'B*9901'], ['MGPGQVLFR', 'SLYNTVATL'])[2], 0)
+
+class TestEncoding(unittest.TestCase):
+    def test_roundtrip(self):
+        mers = ['MGPGQVLFR', 'A', 'SLYNTVATLYCV', 'ASRKLGDRG', 'YYYYYYYY']
+        codes = encodePeptides(mers)
+        self.assertEqual(list(codes), [encodePeptide(m) for m in mers])
+        self.assertEqual(decodePeptides(codes).astype(str).tolist(), mers)
+        self.assertEqual(list(codeLengths(codes)), [len(m) for m in mers])
+    def test_invalid(self):
+        mers = ['MGPGXVLFR', 'SLYNTVATLYCVA', '', 'MGPG-VLFR']
+        self.assertEqual(list(encodePeptides(mers)), [0] * len(mers))
+        self.assertEqual([encodePeptide(m) for m in mers], [0] * len(mers))
+    def test_order(self):
+        mers = ['MGPGQVLFR', 'ASRKLGDRG', 'SLYNTVAT', 'YLK', 'ASRKLGDRGA']
+        sortedMers = [mers[i] for i in np.argsort(encodePeptides(mers))]
+        self.assertEqual(sortedMers, sorted(mers, key = lambda m: (len(m), [AALPHABET.index(aa) for aa in m])))
+    def test_index(self):
+        ind = PeptideIndex()
+        rows = ind.add(['MGPGQVLFR', 'ASRKLGDRG', 'MGPGXVLFR', 'MGPGQVLFR'])
+        self.assertEqual(list(rows), [0, 1, 2, 0])
+        mers = ['P%sLYNTVATL' % aa for aa in AALPHABET] * 100
+        rows = ind.add([m[:i] for m in mers[:20] for i in range(1, 11)] + ['SLYNTVATLYCVAT'])
+        self.assertEqual(len(ind), 3 + 1 + 20 * 9 + 1)
+        self.assertEqual(ind.get('ASRKLGDRG'), 1)
+        self.assertEqual(ind.get('SLYNTVATLYCVAT'), len(ind) - 1)
+        self.assertEqual(ind.get('SLYNTVATL'), -1)
+        self.assertEqual(list(ind.lookup(['MGPGXVLFR', 'SLYNTVATL', 'PALYNTVAT'])), [2, -1, ind.get('PALYNTVAT')])
+        self.assertEqual(ind.peptides(rows[-3:]), ['PYLYNTVAT', 'PYLYNTVATL', 'SLYNTVATLYCVAT'])
+        """Enough new peptides to merge the pending dict into the sorted arrays"""
+        big = ['%s%sLYNTVA%s' % (a, b, c) for a in AALPHABET for b in AALPHABET for c in AALPHABET[:5]]
+        rows = ind.add(big)
+        self.assertEqual(len(ind.pending), 0)
+        self.assertEqual(list(ind.lookup(big)), list(rows))
+        self.assertEqual(ind.get('MGPGQVLFR'), 0)
+
+class TestLoader(unittest.TestCase):
+    def test_chunks(self):
+        ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        chunked = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False, chunkSize = 100)
+        self.assertEqual(dict(chunked), dict(ba))
+        chunks = list(readPredictionChunks('data/test.9.out', chunkSize = 100, engine = 'pandas'))
+        self.assertEqual(sum([len(h) for h, p, v in chunks]), len(ba))
+        self.assertTrue(all(['*' not in h for h in chunks[0][0]]))
+    def test_parallel(self):
+        ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        chunks = list(readPredictionFiles(['data/test.9.out'] * 3, chunkSize = 100, cpus = 2))
+        self.assertEqual(sum([len(h) for h, p, v in chunks]), 3 * len(ba))
+        parallel = hlaStoreCache(baseFn = 'data/test', kmers = [9, 9], warn = False, cpus = 2)
+        self.assertEqual(len(parallel), len(ba))
+        self.assertAlmostEqual(parallel[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+    def test_pairs(self):
+        ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, 'dump.csv')
+            ba.dumpToFile(fn)
+            ba2 = hlaPredCache(warn = False)
+            self.assertEqual(ba2.addFromFile(fn), len(ba))
+        self.assertAlmostEqual(ba2[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+    def test_engine(self):
+        with self.assertRaises(ValueError):
+            list(readPredictionChunks('data/test.9.out', engine = 'spark'))
+
+class TestStoreCache(unittest.TestCase):
+    def setUp(self):
+        self.ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False, oldFile = False)
+    def test_get(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, oldFile = False)
+        self.assertEqual(len(ba), len(self.ba))
+        self.assertAlmostEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+        self.assertAlmostEqual(ba[('A_0201', 'ASRKLGDRG')], 10.7537776369, places = 5)
+        self.assertTrue(np.isnan(ba[('A*2601', 'AGPGQVLFR')]))
+        self.assertTrue(np.isnan(ba[('A*2601', 'AGPGXVLFR')]))
+        self.assertTrue(('A*2601', 'MGPGQVLFR') in ba)
+        self.assertFalse(('A*2601', 'AGPGQVLFR') in ba)
+    def test_items(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, oldFile = False)
+        for k, v in self.ba.items():
+            self.assertAlmostEqual(ba[k], v, places = 5)
+        self.assertEqual(set(ba.keys()), set(self.ba.keys()))
+    def test_update(self):
+        ba = hlaStoreCache(warn = False)
+        ba.addPredictionValues(['A*0201', 'A*0201', 'B*0702'], ['SLYNTVATL', 'MGARASVLS', 'SLYNTVATL'], [5., 9., 7.])
+        ba[('A*0201', 'SLYNTVATL')] = 4.
+        self.assertEqual(len(ba), 3)
+        self.assertEqual(ba[('A*0201', 'SLYNTVATL')], 4.)
+        self.assertEqual(ba[('B_0702', 'SLYNTVATL')], 7.)
+    def test_slice(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, oldFile = False)
+        ba_slice = ba.slice(hlas = ['A*2601', 'A*3201', 'A*0201'], peptides = ['MGPGQVLFR', 'GSSSQVSRN', 'ASRKLGDRG'])
+        self.assertEqual(len(ba_slice), 9)
+        self.assertAlmostEqual(ba_slice[('A*0201', 'ASRKLGDRG')], 10.7537776369, places = 5)
+        self.assertTrue(np.isnan(ba_slice[('A*0203', 'ASRKLGDRG')]))
+    def test_slice_warn(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = True)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ba_slice = ba.slice(hlas = ['A*2601', 'B*9901'], peptides = ['MGPGQVLFR', 'AGPGQVLFR', 'SLYNTVATL'])
+        self.assertEqual(out.getvalue().strip().split('\n'), ['5 of 6 HLA predictions not found, returning nan'])
+        self.assertEqual(len(ba_slice), 1)
+    def test_slice_view(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)
+        view = ba.slice(hlas = ['A*2601', 'A*0201'], peptides = ['MGPGQVLFR', 'ASRKLGDRG', 'SLYNTVATL'], view = True)
+        self.assertEqual(len(view), 4)
+        self.assertAlmostEqual(view[('A*0201', 'ASRKLGDRG')], 10.7537776369, places = 5)
+        self.assertTrue(np.isnan(view[('A*0203', 'ASRKLGDRG')]))
+        self.assertTrue(np.isnan(view.getMany(['A*0203'], ['ASRKLGDRG'])[0][0]))
+        ba.addPredictionValues(['A*0201', 'A*0203'], ['SLYNTVATL', 'SLYNTVATL'], [5., 6.])
+        self.assertEqual(view[('A*0201', 'SLYNTVATL')], 5.)
+        self.assertEqual(set(view.items()), set(ba.slice(hlas = ['A*2601', 'A*0201'], peptides = ['MGPGQVLFR', 'ASRKLGDRG', 'SLYNTVATL']).items()))
+        with self.assertRaises(TypeError):
+            view[('A*0201', 'SLYNTVATL')] = 4.
+    def test_rank(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, oldFile = False)
+        hlas = ['A*2601', 'A*3201', 'A*0201']
+        mers = ['MGPGQVLFR', 'GSSSQVSRN', 'ASRKLGDRG']
+        res = rankMers(ba, hlas, mers)
+        expected = rankMers(self.ba, hlas, mers)
+        self.assertTrue(np.all(res[0] == expected[0]))
+        self.assertTrue(np.allclose(res[2], expected[2]))
+
+class TestGetMany(unittest.TestCase):
+    def setUp(self):
+        self.hlas = ['A*2601', 'A*3201', 'A*0201', 'B*9999']
+        self.mers = ['MGPGQVLFR', 'GSSSQVSRN', 'ASRKLGDRG', 'AGPGQVLFR', 'AGPGXVLFR']
+    def _check(self, ba):
+        ic50, missing = ba.getMany(self.hlas, self.mers, cross = True)
+        self.assertEqual(ic50.shape, (len(self.hlas), len(self.mers)))
+        for i, h in enumerate(self.hlas):
+            for j, m in enumerate(self.mers):
+                expected = ba[(h, m)]
+                self.assertEqual(missing[i, j], np.isnan(expected))
+                if not missing[i, j]:
+                    self.assertAlmostEqual(ic50[i, j], expected, places = 5)
+        self.assertEqual(missing.sum(), 3 * 2 + len(self.mers))
+
+        ic50, missing = ba.getMany(['A*2601', 'A_0201', 'B*9999'], ['MGPGQVLFR', 'ASRKLGDRG', 'ASRKLGDRG'])
+        self.assertEqual(list(missing), [False, False, True])
+        self.assertAlmostEqual(ic50[0], 10.3372161729, places = 5)
+        self.assertAlmostEqual(ic50[1], 10.7537776369, places = 5)
+    def test_dict(self):
+        self._check(hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False))
+    def test_store(self):
+        self._check(hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False))
+    def test_paired_length(self):
+        ba = hlaPredCache(warn = False)
+        with self.assertRaises(ValueError):
+            ba.getMany(['A*0201'], ['MGPGQVLFR', 'ASRKLGDRG'])
+    def test_rank(self):
+        ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        hlas = ['A*2601', 'A*3201', 'A*0201']
+        peptide = 'MGPGQVLFRXGSSSQVSRN'
+        expected = np.array([[ba[(h, m)] for h in hlas] for m in getMers(peptide, [9])])
+        expected[np.isnan(expected)] = 15
+        ranks, sorti, kmers, ic50, hla = rankEpitopes(ba, hlas, peptide, nmer = [9])
+        self.assertTrue(np.allclose(ic50, expected.flatten()))
+        self.assertEqual(kmers[0], 'MGPGQVLFR')
+        self.assertEqual(hla[1], 'A*3201')
+        self.assertEqual(getIC50(ba, hlas, 'MGPGQVLFR', returnHLA = True)[1], 'A*3201')
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.hlas = ['A*2601', 'B*9901']
+        self.peptide = 'MGPGQVLFRXGSSSQVSRN'
+    def test_deferred(self):
+        for ba in [hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False), hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)]:
+            n = len(ba)
+            ba.deferMisses()
+            rankEpitopes(ba, self.hlas, self.peptide, nmer = [9, 10])
+            ba[('A*2601', 'SLYNTVATL')]
+            """Every B*9901 mer, the A*2601 10-mers (9-mers are in the cache) and SLYNTVATL"""
+            mers = [m for m in getMers(self.peptide, [9, 10]) if isvalidmer(m)]
+            nExpected = len(mers) + len([m for m in mers if len(m) == 10]) + 1
+            self.assertEqual(len(ba.missQueue), nExpected)
+            self.assertEqual(ba.backfill(method = 'RAND'), nExpected)
+            self.assertEqual(len(ba.missQueue), 0)
+            self.assertEqual(len(ba), n + nExpected)
+            ranks, sorti, kmers, ic50, hla = rankEpitopes(ba, self.hlas, self.peptide, nmer = [9, 10])
+            valid = np.array([isvalidmer(m) for m in kmers])
+            self.assertFalse(np.any(ic50[valid] == 15))
+            self.assertEqual(len(ba.missQueue), 0)
+            self.assertEqual(ba.backfill(method = 'RAND'), 0)
+        """Nothing to backfill: a cache without a predictionMethod needs no method"""
+        for ba in [hlaPredCache(warn = False), hlaStoreCache(warn = False)]:
+            self.assertEqual(ba.backfill(), 0)
+            ba.deferMisses()
+            self.assertEqual(ba.backfill(), 0)
+    def test_ensure(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)
+        mers = getMers(self.peptide, [9])
+        with self.assertRaises(ValueError):
+            hlaPredCache(warn = False).ensure(self.hlas, mers)
+        nAdded = ba.ensure(self.hlas, mers, method = 'RAND')
+        """Only B*9901 is missing predictions"""
+        self.assertEqual(nAdded, len([m for m in mers if isvalidmer(m)]))
+        self.assertFalse(ba.getMany(self.hlas, [m for m in mers if isvalidmer(m)], cross = True)[1].any())
+
+class TestLookupStats(unittest.TestCase):
+    def _check(self, ba):
+        stats = ba.trackLookups(maxMissLog = 3)
+        ba[('A*2601', 'MGPGQVLFR')]
+        ba[('A_2601', 'MGPGQVLFR')]
+        ba[('A_2601', 'MGPGXVLFR')]
+        ba[('B*9901', 'MGPGQVLFR')]
+        ba.getMany(['A*0201', 'B_9901'], ['ASRKLGDRG', 'SLYNTVATL', 'SLYNTVATLY'], cross = True)
+        self.assertEqual(stats.totals(), dict(hits = 3, misses = 6, invalid = 1, fallbacks = 2))
+        """Permuted lookups are not counted"""
+        ba.permutePeptides(seed = 1)
+        ba.getRand(('A*2601', 'MGPGQVLFR'))
+        ba.useRand = True
+        ba[('A_2601', 'MGPGQVLFR')]
+        ba.getMany(['A*2601'], ['MGPGQVLFR', 'ASRKLGDRG'], cross = True)
+        ba.useRand = False
+        self.assertEqual(stats.totals(), dict(hits = 3, misses = 6, invalid = 1, fallbacks = 2))
+        summary = stats.summary()
+        self.assertEqual(summary.loc[('B_9901', 9), 'misses'], 3)
+        self.assertEqual(summary.loc[('A_0201', 10), 'misses'], 1)
+        self.assertEqual(summary.loc[('A_2601', 9), 'fallbacks'], 1)
+        """Only the 3 most recent distinct misses are kept"""
+        hlas, peptides = stats.missingPairs()
+        self.assertEqual(list(zip(hlas, peptides)), [('B_9901', 'ASRKLGDRG'), ('B_9901', 'SLYNTVATL'), ('B_9901', 'SLYNTVATLY')])
+        self.assertEqual(stats.workList(), {9:(['B_9901'], ['ASRKLGDRG', 'SLYNTVATL']), 10:(['B_9901'], ['SLYNTVATLY'])})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, 'misses.csv')
+            stats.exportMissLog(fn)
+            self.assertEqual(open(fn).read().split(), ['hla,peptide', 'B_9901,ASRKLGDRG', 'B_9901,SLYNTVATL', 'B_9901,SLYNTVATLY'])
+        stats.reset()
+        self.assertEqual(stats.totals()['hits'], 0)
+    def test_dict(self):
+        self._check(hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False))
+    def test_store(self):
+        self._check(hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False))
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, 'test.snap')
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_roundtrip(self):
+        self.ba.addPredictionValues(['A*0201'], ['SLYNTVATL'], [5.])
+        self.ba.saveSnapshot(self.fn)
+        for mmap in [True, False]:
+            ba = loadSnapshot(self.fn, mmap = mmap, warn = False)
+            self.assertEqual(str(ba), str(self.ba))
+            self.assertEqual(len(ba), len(self.ba))
+            self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], self.ba[('A*2601', 'MGPGQVLFR')])
+            self.assertEqual(ba[('A*0201', 'SLYNTVATL')], 5.)
+            self.assertTrue(np.isnan(ba[('A*2601', 'AGPGQVLFR')]))
+            self.assertEqual(set(ba.items()), set(self.ba.items()))
+    def test_update_after_load(self):
+        self.ba.saveSnapshot(self.fn)
+        ba = loadSnapshot(self.fn, warn = False)
+        ba.addPredictionValues(['A*2601', 'B*9901', 'A*2601'], ['MGPGQVLFR', 'MGPGQVLFR', 'SLYNTVATL'], [1., 2., 3.])
+        self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], 1.)
+        self.assertEqual(ba[('B*9901', 'MGPGQVLFR')], 2.)
+        self.assertEqual(ba[('A*2601', 'SLYNTVATL')], 3.)
+        self.assertEqual(len(ba), len(self.ba) + 2)
+        """The file is mapped copy-on-write and is not modified"""
+        self.assertEqual(loadSnapshot(self.fn, warn = False)[('A*2601', 'MGPGQVLFR')], self.ba[('A*2601', 'MGPGQVLFR')])
+    def test_dict_cache(self):
+        ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        ba.saveSnapshot(self.fn)
+        snap = loadSnapshot(self.fn, warn = False)
+        self.assertEqual(len(snap), len(ba))
+        self.assertAlmostEqual(snap[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+    def test_quantized(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, store = ArrayStore(quantize = True))
+        maxError = ba.store.maxError
+        self.assertTrue(maxError < 2e-4)
+        self.assertEqual(len(ba), len(self.ba))
+        self.assertEqual(ba.store.nbytes * 2, self.ba.store.nbytes)
+        self.assertTrue(abs(ba[('A*2601', 'MGPGQVLFR')] - 10.3372161729) <= maxError)
+        self.assertTrue(np.isnan(ba[('A*2601', 'AGPGQVLFR')]))
+        """Values outside the range are rejected instead of clipped (the whole batch)"""
+        with self.assertRaises(ValueError):
+            ba.addPredictionValues(['A*2601', 'B*9901'], ['MGPGQVLFR', 'MGPGQVLFR'], [5., 20.])
+        self.assertTrue(abs(ba[('A*2601', 'MGPGQVLFR')] - 10.3372161729) <= maxError)
+        self.assertEqual(len(ba), len(self.ba))
+        ba.addPredictionValues(['B*9901'], ['MGPGQVLFR'], [16.])
+        self.assertEqual(ba[('B*9901', 'MGPGQVLFR')], 16.)
+        self.ba.saveSnapshot(self.fn, quantize = True)
+        snap = loadSnapshot(self.fn, warn = False)
+        self.assertTrue(snap.store.quantized)
+        self.assertEqual(snap.store.nbytes, 2 * len(self.ba.store.hlas) * self.ba.store.nPeptides)
+        self.assertEqual(len(snap), len(self.ba))
+        for k, v in self.ba.items():
+            self.assertTrue(abs(snap[k] - v) <= maxError)
+        with self.assertRaises(ValueError):
+            snap.addPredictionValues(['B*9901'], ['MGPGQVLFR'], [20.])
+        self.assertTrue(np.isnan(snap[('B*9901', 'MGPGQVLFR')]))
+
+class TestMethodStore(unittest.TestCase):
+    def setUp(self):
+        self.ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, store = MethodStore(method = 'netmhcpan'))
+        self.smm = self.ba.forMethod('smm')
+        self.smm.addPredictionValues(['A*2601', 'B*9901'], ['MGPGQVLFR', 'MGPGQVLFR'], [1., 2.])
+    def test_methods(self):
+        ba, smm = self.ba, self.smm
+        self.assertEqual(ba.predictionMethod, 'netmhcpan')
+        self.assertEqual(ba.methods, ['netmhcpan', 'smm'])
+        self.assertEqual(len(smm), 2)
+        self.assertEqual(len(ba), 234)
+        self.assertAlmostEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+        self.assertEqual(smm[('A*2601', 'MGPGQVLFR')], 1.)
+        self.assertTrue(np.isnan(ba[('B*9901', 'MGPGQVLFR')]))
+        self.assertTrue(np.isnan(smm[('A*2601', 'ASRKLGDRG')]))
+        """One shared peptide index"""
+        self.assertIs(ba.store.store, smm.store.store)
+        self.assertEqual(ba.store.store.nPeptides, 9)
+        self.assertEqual(set(smm.keys()), {('A_2601', 'MGPGQVLFR'), ('B_9901', 'MGPGQVLFR')})
+        ic50 = ba.getMethods(['A*2601', 'B*9901'], ['MGPGQVLFR', 'ASRKLGDRG'], cross = True)
+        self.assertEqual(ic50.shape, (2, 2, 2))
+        self.assertEqual(ic50[1, 1, 0], 2.)
+        self.assertTrue(np.isnan(ic50[0, 1, 0]))
+        self.assertTrue(np.allclose(ba.getMethods(['A*2601'], ['MGPGQVLFR'])[:, 0], [ba[('A*2601', 'MGPGQVLFR')], 1.]))
+    def test_add(self):
+        nAdded = self.ba.addPredictions('RAND', ['A*2601'], ['MGPGQVLFR', 'ASRKLGDRG'])
+        self.assertEqual(nAdded, 2)
+        self.assertEqual(self.ba.methods, ['netmhcpan', 'smm', 'RAND'])
+        self.assertEqual(len(self.ba), 234)
+        self.assertEqual(len(self.ba.forMethod('RAND')), 2)
+    def test_journal(self):
+        """The journal only holds predictions of this cache's method"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.ba.openJournal(os.path.join(tmpdir, 'journal'))
+            with self.assertRaises(ValueError):
+                self.ba.addPredictions('RAND', ['A*2601'], ['MGPGQVLFR', 'ASRKLGDRG'])
+            with self.assertRaises(ValueError):
+                self.ba.loadMethod('smm', 'data/test', kmers = [9])
+            self.assertEqual(self.ba.methods, ['netmhcpan', 'smm'])
+            self.ba.closeJournal()
+    def test_baseFn_method(self):
+        """Without a method the store takes the method from the baseFn suffix"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            baseFn = os.path.join(tmpdir, 'test.netmhcpan')
+            with open('data/test.9.out') as src, open(baseFn + '.9.out', 'w') as dst:
+                dst.write(src.read())
+            ba = hlaStoreCache(baseFn = baseFn, kmers = [9], warn = False, store = MethodStore())
+        self.assertEqual(ba.methods, ['netmhcpan'])
+        self.assertEqual(ba.predictionMethod, 'netmhcpan')
+        self.assertEqual(len(ba), 234)
+        keys = list(ba.keys())
+        self.assertEqual(ba.addPredictions('netmhcpan', [k[0] for k in keys], [k[1] for k in keys]), 0)
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, 'methods.snap')
+            self.smm.saveSnapshot(fn)
+            snap = loadSnapshot(fn, warn = False)
+            self.assertEqual(snap.predictionMethod, 'smm')
+            self.assertEqual(snap.methods, ['netmhcpan', 'smm'])
+            self.assertEqual(snap[('B*9901', 'MGPGQVLFR')], 2.)
+            self.assertEqual(snap.forMethod('netmhcpan')[('A*2601', 'MGPGQVLFR')], self.ba[('A*2601', 'MGPGQVLFR')])
+            self.smm.saveShards(os.path.join(tmpdir, 'shards'))
+            self.assertEqual(len(loadShards(os.path.join(tmpdir, 'shards'), warn = False)), 2)
+
+class TestClassII(unittest.TestCase):
+    def setUp(self):
+        with open('data/sette.drb', 'r') as fh:
+            self.hlas = [h.strip() for h in fh if h.strip()][:4]
+        self.mers = ['PKYVKQNTLKLATGM', 'GELIGILNAAKVPAD', 'AAAAAAAAAAAAAAA']
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.baseFn = os.path.join(self.tmpdir.name, 'drb.netmhciipan')
+        with open(self.baseFn + '.15.out', 'w') as fh:
+            for i, h in enumerate(self.hlas):
+                for j, m in enumerate(self.mers[:2]):
+                    fh.write('netmhciipan,%s,%s,"(%1.4f, \'%s\')"\n' % (h, m, i + j / 10., m[j + 2:j + 11]))
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_offsets(self):
+        offsets = coreOffsets(self.mers + ['SLYNTVATL', 'SLYNTVAT'], ['YVKQNTLKL', 'GELIGILNA', None, 'SLYNTVATL', 'SLYN-TVAT'])
+        self.assertEqual(list(offsets), [2, 0, -1, 0, -1])
+    def test_load(self):
+        ba = hlaStoreCache(baseFn = self.baseFn, kmers = [15], oldFile = True, warn = False, store = CoreStore())
+        old = hlaPredCache(baseFn = self.baseFn, kmers = [15], oldFile = True, warn = False)
+        self.assertEqual(len(ba), 8)
+        self.assertEqual(set(ba.keys()), set(old.keys()))
+        self.assertTrue(np.allclose([ba[k] for k in old.keys()], list(old.values())))
+        """15-mers are in the table of long peptides, not in the dict fallback"""
+        self.assertEqual(ba.store.pepIndex.nLong, 2)
+        self.assertEqual(len(ba.store.pepIndex.other), 0)
+        val, core = ba.getWithCore((self.hlas[1], 'GELIGILNAAKVPAD'))
+        self.assertAlmostEqual(val, 1.1, places = 5)
+        self.assertEqual(core, 'IGILNAAKV')
+        ic50, cores = ba.getManyWithCore([self.hlas[0], self.hlas[2], self.hlas[3]], self.mers)
+        self.assertEqual(list(cores), ['YVKQNTLKL', 'IGILNAAKV', None])
+        self.assertTrue(np.isnan(ic50[2]))
+        """Setting a value without a core clears the core"""
+        ba.addPredictionValues([self.hlas[0]], ['PKYVKQNTLKLATGM'], [3.])
+        self.assertEqual(ba.getWithCore((self.hlas[0], 'PKYVKQNTLKLATGM')), (3., None))
+        with self.assertRaises(ValueError):
+            hlaStoreCache(warn = False).getWithCore((self.hlas[0], self.mers[0]))
+    def test_snapshot(self):
+        ba = hlaStoreCache(baseFn = self.baseFn, kmers = [15], oldFile = True, warn = False, store = CoreStore(quantize = True))
+        fn = os.path.join(self.tmpdir.name, 'drb.snap')
+        ba.saveSnapshot(fn)
+        snap = loadSnapshot(fn, warn = False)
+        self.assertIsInstance(snap.store, CoreStore)
+        self.assertEqual(snap.getWithCore((self.hlas[3], 'PKYVKQNTLKLATGM')), ba.getWithCore((self.hlas[3], 'PKYVKQNTLKLATGM')))
+        sliced = snap.slice(self.hlas[:2], self.mers[1:])
+        self.assertEqual(sliced.getWithCore((self.hlas[1], 'GELIGILNAAKVPAD'))[1], 'IGILNAAKV')
+    @unittest.skipUnless(_hasPyarrow(), 'requires pyarrow')
+    def test_parquet(self):
+        """Predictions read from Parquet (which has no cores) clear the cores they overwrite"""
+        ba = hlaStoreCache(baseFn = self.baseFn, kmers = [15], oldFile = True, warn = False, store = CoreStore())
+        fn = os.path.join(self.tmpdir.name, 'drb.parquet')
+        other = hlaPredCache(warn = False)
+        other.addPredictionValues([self.hlas[1], self.hlas[0]], ['GELIGILNAAKVPAD', 'AAAAAAAAAAAAAAA'], [99., 5.])
+        other.saveParquet(fn)
+        self.assertEqual(ba.addFromParquet(fn), 1)
+        self.assertEqual(ba.getWithCore((self.hlas[1], 'GELIGILNAAKVPAD')), (99., None))
+        self.assertEqual(ba.getWithCore((self.hlas[0], 'PKYVKQNTLKLATGM'))[1], 'YVKQNTLKL')
+
+class TestConcurrentCache(unittest.TestCase):
+    def test_basic(self):
+        ba = hlaConcurrentCache(baseFn = 'data/test', kmers = [9], warn = False, chunkSize = 50)
+        self.assertEqual(len(ba), 234)
+        self.assertLess(len(ba.store.segments), 5)
+        self.assertAlmostEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+        ba.addPredictionValues(['A*2601', 'B*9901'], ['MGPGQVLFR', 'MGPGQVLFR'], [1., 2.])
+        self.assertEqual(len(ba), 235)
+        self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], 1.)
+        self.assertEqual(len(dict(ba.items())), 235)
+    def test_stress(self):
+        ba = hlaConcurrentCache(warn = False)
+        gag = 'MGARASVLSGGELDRWEKIRLRPGGKKKYKLKHIVWASRELERFAVNPGLLETSEGCRQILGQLQPSLQTGSEELRSLYNTVATLYCVHQRIEIKDTKEALDKIEEEQ'
+        mers = getMers(gag, nmer = [9])
+        hlas = ['A*%04d' % i for i in range(16)]
+        """Values are exact in float32 so lost or torn updates show up as mismatches"""
+        expected = {(h, m):i + j / 4. for i, h in enumerate(hlas) for j, m in enumerate(mers)}
+        pairH, pairP = [k[0] for k in expected], [k[1] for k in expected]
+        pairV = np.array([expected[k] for k in expected])
+        nWriters, errors, done = 4, [], threading.Event()
+        def _write(w):
+            for i in range(w, len(hlas), nWriters):
+                for j in range(0, len(mers), 10):
+                    batch = mers[j:j + 10]
+                    ba.addPredictionValues([hlas[i]] * len(batch), batch, [expected[(hlas[i], m)] for m in batch])
+        def _read():
+            nSeen = 0
+            while not done.is_set():
+                ic50, missing = ba.getMany(pairH, pairP)
+                if not np.all(ic50[~missing] == pairV[~missing]):
+                    errors.append('wrong value')
+                if (~missing).sum() < nSeen:
+                    errors.append('lost update')
+                nSeen = (~missing).sum()
+        writers = [threading.Thread(target = _write, args = (w,)) for w in range(nWriters)]
+        readers = [threading.Thread(target = _read) for r in range(4)]
+        for t in readers + writers:
+            t.start()
+        for t in writers:
+            t.join()
+        done.set()
+        for t in readers:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(ba), len(expected))
+        ic50, missing = ba.getMany(pairH, pairP)
+        self.assertFalse(missing.any())
+        self.assertTrue(np.all(ic50 == pairV))
+
+def _sharedLookup(ba, key):
+    """Runs in a pool worker: ba is unpickled by attaching to the shared block"""
+    return ba[key], ba.store.sharedMemory.name
+
+class TestSharedMemory(unittest.TestCase):
+    def setUp(self):
+        self.ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        self.shm = self.ba.shareMemory()
+    def tearDown(self):
+        self.shm.close()
+        self.shm.unlink()
+    def test_attach(self):
+        shared = attachShared(self.shm.name, warn = False)
+        self.assertEqual(len(shared), len(self.ba))
+        self.assertEqual(shared.name, 'data/test')
+        self.assertAlmostEqual(shared[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+        self.assertTrue(np.isnan(shared[('A*0201', 'SLYNTVATL')]))
+        self.assertFalse(shared.store.blocks[0].flags.writeable)
+        """Pickled as the block name, not the predictions"""
+        self.assertLess(len(pickle.dumps(shared)), 1000)
+    def test_readonly(self):
+        shared = attachShared(self.shm.name, warn = False)
+        """Both existing and new pairs are rejected, before any prediction is run"""
+        for h, p in [('A*2601', 'MGPGQVLFR'), ('B*9901', 'MGPGQVLFR')]:
+            with self.assertRaises(TypeError):
+                shared.addPredictionValues([h], [p], [1.])
+        with self.assertRaises(TypeError):
+            shared[('B*9901', 'MGPGQVLFR')] = 1.
+        with self.assertRaises(TypeError):
+            shared.ensure(['B*9901'], ['MGPGQVLFR'], method = 'RAND')
+        with self.assertRaises(TypeError):
+            shared.merge([self.ba])
+        self.assertTrue(np.isnan(shared[('B*9901', 'MGPGQVLFR')]))
+        """A slice is a writable copy"""
+        copy = shared.slice(['A*2601'], ['MGPGQVLFR'])
+        copy.addPredictionValues(['B*9901'], ['MGPGQVLFR'], [1.])
+        self.assertEqual(copy[('B*9901', 'MGPGQVLFR')], 1.)
+    def test_pool(self):
+        shared = attachShared(self.shm.name, warn = False)
+        keys = list(self.ba.keys())[:20]
+        with Pool(processes = 2) as pool:
+            results = pool.starmap(_sharedLookup, [(shared, k) for k in keys])
+        self.assertTrue(np.allclose([v for v, name in results], [self.ba[k] for k in keys]))
+        self.assertEqual({name for v, name in results}, {self.shm.name})
+    def test_detach(self):
+        shm = attachShared(self.shm.name, warn = False).store.sharedMemory
+        self.assertIn(self.shm.name, sharedstore._attached)
+        self.assertTrue(detachShared(self.shm.name))
+        self.assertNotIn(self.shm.name, sharedstore._attached)
+        self.assertIsNone(shm.buf)
+        self.assertFalse(detachShared(self.shm.name))
+        """A block published again by the same cache replaces the older one"""
+        shared = attachShared(self.shm.name, warn = False)
+        newer = self.ba.shareMemory()
+        try:
+            self.assertEqual(len(attachShared(newer.name, warn = False)), len(self.ba))
+            self.assertNotIn(self.shm.name, sharedstore._attached)
+            """The older block stays mapped while a cache uses it"""
+            self.assertAlmostEqual(shared[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+            detachShared(newer.name)
+        finally:
+            newer.close()
+            newer.unlink()
+
+class TestCacheServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ba = hlaConcurrentCache(baseFn = 'data/test', kmers = [9], warn = False)
+        self.server = CacheServer(self.ba, os.path.join(self.tmpdir.name, 'cache.sock')).start()
+        self.client = hlaCacheClient(self.server.address, self.server.authkey, warn = False)
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        self.tmpdir.cleanup()
+    def test_lookup(self):
+        client = self.client
+        self.assertEqual(len(client), 234)
+        self.assertEqual(client.predictionMethod, self.ba.predictionMethod)
+        self.assertEqual(client[('A*2601', 'MGPGQVLFR')], self.ba[('A*2601', 'MGPGQVLFR')])
+        self.assertTrue(np.isnan(client[('A*0201', 'SLYNTVATL')]))
+        hlas, mers = ['A*2601', 'A*0201'], ['MGPGQVLFR', 'SLYNTVATL', 'ASRKLGDRG']
+        ic50, missing = client.getMany(hlas, mers, cross = True)
+        self.assertTrue(np.array_equal(ic50, self.ba.getMany(hlas, mers, cross = True)[0], equal_nan = True))
+        """helpers work unchanged against the client"""
+        gag = 'MGARASVLSGGELDRWEKIRLRPGGKKKYKLKHIVWASRELERFAVNPGLLETSEGCRQILGQLQPSLQTGSEELRSLYNTVATLYCVHQRIEIKDTKEALDKIEEEQ'
+        local, remote = rankKmers(self.ba, hlas, gag, nmer = [9]), rankKmers(client, hlas, gag, nmer = [9])
+        for i in [0, 1, 2, 4]:
+            self.assertEqual(list(local[i]), list(remote[i]))
+        self.assertTrue(np.array_equal(local[3], remote[3], equal_nan = True))
+    def test_auth(self):
+        self.assertEqual(os.stat(self.server.address).st_mode & 0o777, 0o600)
+        with self.assertRaises(AuthenticationError):
+            hlaCacheClient(self.server.address, b'wrong key', warn = False)
+        with self.assertRaises(ValueError):
+            CacheServer(self.ba, ('localhost', 0))
+    def test_update(self):
+        self.client.addPredictionValues(['B*9901'], ['MGPGQVLFR'], [2.])
+        self.assertEqual(self.ba[('B*9901', 'MGPGQVLFR')], 2.)
+        self.assertEqual(len(self.client), 235)
+        with self.assertRaises(KeyError):
+            self.client.store._call('nosuchop')
+    def test_predict(self):
+        """Two clients ensure overlapping pairs at the same time: each pair is predicted once"""
+        other = hlaCacheClient(self.server.address, self.server.authkey, warn = False)
+        hlas, mers = ['A*2601', 'B*9901'], ['MGPGQVLFR', 'SLYNTVATL', 'GSSSQVSRN']
+        nMissing = int(self.ba.getMany(hlas, mers, cross = True)[1].sum())
+        counts = []
+        threads = [threading.Thread(target = lambda c: counts.append(c.ensure(hlas, mers, method = 'RAND')), args = (c,)) for c in (self.client, other)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        other.close()
+        self.assertEqual(sum(counts), nMissing)
+        self.assertFalse(self.client.getMany(hlas, mers, cross = True)[1].any())
+        self.assertEqual(len(self.ba), 234 + nMissing)
+
+class TestFingerprints(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, store = VersionedStore(fingerprint = 'file'))
+        self.hlas, self.mers = ['A*2601', 'B*9901'], ['MGPGQVLFR', 'SLYNTVATL', 'GSSSQVSRN']
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_fingerprint(self):
+        fn = os.path.join(self.tmpdir.name, 'model.dat')
+        with open(fn, 'w') as fh:
+            fh.write('weights 1')
+        fp = predictorFingerprint('ann', '20130222', [fn])
+        self.assertEqual(fp, predictorFingerprint('ann', '20130222', [fn]))
+        self.assertNotEqual(fp, predictorFingerprint('ann', '20130223', [fn]))
+        self.assertNotEqual(fp, predictorFingerprint('smm', '20130222', [fn]))
+        with open(fn, 'w') as fh:
+            fh.write('weights 2')
+        self.assertNotEqual(fp, predictorFingerprint('ann', '20130222', [fn]))
+        self.assertEqual(iedbFingerprint('RAND'), predictorFingerprint('RAND'))
+        self.assertNotEqual(iedbFingerprint('ann', '20130222'), iedbFingerprint('ann', '20200101'))
+    def test_version(self):
+        """The version is that of the newest training data directory of the install"""
+        dataPath = os.path.join(self.tmpdir.name, 'data')
+        self.assertEqual(iedbVersion(dataPath), '20130222')
+        for v in ['20130222', '20200101']:
+            os.makedirs(os.path.join(dataPath, 'MHCI_mhcibinding' + v))
+        with open(os.path.join(dataPath, 'MHCI_mhcibinding20990101'), 'w') as fh:
+            fh.write('not a directory')
+        iedbVersion.cache_clear()
+        self.assertEqual(iedbVersion(dataPath), '20200101')
+    def test_require(self):
+        ba = self.ba
+        self.assertEqual(ba.store.fingerprintCounts(), {'file':234})
+        nMissing = int(ba.getMany(self.hlas, self.mers, cross = True)[1].sum())
+        self.assertEqual(ba.ensure(self.hlas, self.mers, method = 'RAND'), nMissing)
+        rand = iedbFingerprint('RAND')
+        self.assertEqual(ba.store.fingerprintCounts(), {'file':234, rand:nMissing})
+        self.assertEqual(list(ba.store.getFingerprints(['A_2601', 'B_9901', 'A_0201'], ['MGPGQVLFR', 'SLYNTVATL', 'SLYNTVATL'])), ['file', rand, None])
+        """Predictions of other builds look missing and only those are re-predicted"""
+        ba.requireFingerprints([rand])
+        ic50, missing = ba.getMany(self.hlas, self.mers, cross = True)
+        self.assertEqual(int((~missing).sum()), nMissing)
+        self.assertEqual(ba.planPredictions(self.hlas, self.mers)[2], 6 - nMissing)
+        self.assertEqual(len(dict(ba.items())), nMissing)
+        self.assertEqual(len(ba), nMissing)
+        ba.ensure(self.hlas, self.mers, method = 'RAND')
+        self.assertFalse(ba.getMany(self.hlas, self.mers, cross = True)[1].any())
+        """The count is kept up to date by writes (repeated cells count once)"""
+        self.assertEqual(len(ba), 6)
+        ba.store.setMany(['A_2601', 'A_2601', 'B_9901'], ['MGPGQVLFR', 'MGPGQVLFR', 'AAAAAAAAA'], [1., 2., 3.], fingerprint = 'other')
+        ba.store.setMany(['B_9901', 'B_9901'], ['AAAAAAAAA', 'AAAAAAAAC'], [3., 4.], fingerprint = rand)
+        self.assertEqual(len(ba), 7)
+        ba.store.nAccepted = None
+        self.assertEqual(len(ba), 7)
+        ba.requireFingerprints(None)
+        self.assertEqual(len(ba), 234 + nMissing + 2)
+        self.assertEqual(ba.store.fingerprintCounts(), {'file':234 - (6 - nMissing), rand:7, 'other':1})
+    def test_invalidate(self):
+        ba = self.ba
+        ba.store.setMany(['A_2601'], ['SLYNTVATL'], [1.], fingerprint = 'new')
+        self.assertEqual(ba.invalidate(['file']), 234)
+        self.assertEqual(len(ba), 1)
+        self.assertEqual(ba.invalidate(keep = ['new']), 0)
+        self.assertEqual(ba.invalidate(keep = ['newer', None]), 1)
+        self.assertEqual(len(ba), 0)
+        with self.assertRaises(ValueError):
+            hlaStoreCache(warn = False).invalidate(['file'])
+    def test_snapshot(self):
+        ba = self.ba
+        ba.store.setMany(['A_2601'], ['SLYNTVATL'], [1.], fingerprint = 'new')
+        fn = os.path.join(self.tmpdir.name, 'test.snap')
+        ba.saveSnapshot(fn)
+        snap = loadSnapshot(fn, warn = False)
+        self.assertIsInstance(snap.store, VersionedStore)
+        self.assertEqual(snap.store.fingerprintCounts(), {'file':234, 'new':1})
+        snap.requireFingerprints(['new'])
+        self.assertEqual(len(snap), 1)
+        """A snapshot of the store holds (and counts) every prediction"""
+        copyFn = os.path.join(self.tmpdir.name, 'copy.snap')
+        writeSnapshot(snap.store, copyFn)
+        self.assertEqual(len(loadSnapshot(copyFn, warn = False)), 235)
+        self.assertEqual(snap[('A*2601', 'SLYNTVATL')], 1.)
+        self.assertTrue(np.isnan(snap[('A*2601', 'MGPGQVLFR')]))
+        """New predictions after loading keep their own tags"""
+        snap.store.setMany(['A_9999'], ['MGPGQVLFR'], [2.], fingerprint = 'newer')
+        self.assertEqual(snap.store.fingerprintCounts(), {'file':234, 'new':1, 'newer':1})
+
+@unittest.skipUnless(_hasPyarrow(), 'requires pyarrow')
+class TestParquet(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, 'test.parquet')
+        self.ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        self.ba.addPredictionValues(['A*2601', 'B*9901'], ['SLYNTVATLAA', 'SLYNTVATLAA'], [1., 2.])
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_roundtrip(self):
+        self.ba.saveParquet(self.fn, rowGroupSize = 64, hlasPerGroup = 2)
+        pq = loadParquet(self.fn, warn = False)
+        self.assertEqual(len(pq), len(self.ba))
+        self.assertEqual((pq.name, pq.predictionMethod), (self.ba.name, self.ba.predictionMethod))
+        keys = list(self.ba.keys())
+        self.assertTrue(np.allclose(pq.getMany([k[0] for k in keys], [k[1] for k in keys])[0], [self.ba[k] for k in keys]))
+        """Dict cache: added pair by pair"""
+        ba = hlaPredCache(warn = False)
+        self.assertEqual(ba.addFromParquet(self.fn), len(self.ba))
+        self.assertAlmostEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+    def test_filter(self):
+        self.ba.saveParquet(self.fn, rowGroupSize = 64, hlasPerGroup = 1)
+        pq = loadParquet(self.fn, hlas = ['A*2601'], lengths = [9], warn = False)
+        self.assertEqual(pq.store.hlas, ['A_2601'])
+        self.assertEqual(len(pq), 9)
+        self.assertTrue(np.isnan(pq[('A*2601', 'SLYNTVATLAA')]))
+        ba = hlaStoreCache(warn = False)
+        self.assertEqual(ba.addFromParquet(self.fn, lengths = [11]), 2)
+        self.assertEqual(ba[('B*9901', 'SLYNTVATLAA')], 2.)
+    def test_row_groups(self):
+        """Filters skip the row groups of other alleles and lengths by their statistics
+        (one allele per row group, so exactly the row groups that hold the requested ones)"""
+        import pyarrow.parquet
+        self.ba.saveParquet(self.fn, rowGroupSize = 64, hlasPerGroup = 1)
+        pf = pyarrow.parquet.ParquetFile(self.fn)
+        contents = [pf.read_row_group(g, columns = ['hla', 'length']).to_pydict() for g in range(pf.metadata.num_row_groups)]
+        groups = parquetio._selectRowGroups(pf, ['A_2601'], None)
+        self.assertEqual(groups, [g for g, c in enumerate(contents) if 'A_2601' in c['hla']])
+        self.assertEqual(len(groups), 2)
+        groups = parquetio._selectRowGroups(pf, None, [11])
+        self.assertEqual(groups, [g for g, c in enumerate(contents) if 11 in c['length']])
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(parquetio._selectRowGroups(pf, ['A_2601'], [11]), [g for g, c in enumerate(contents) if c['hla'][0] == 'A_2601' and c['length'][0] == 11])
+        self.assertEqual(parquetio._selectRowGroups(pf, None, None), list(range(len(contents))))
+        self.assertGreater(len(contents), 4)
+    def test_fingerprints(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, store = VersionedStore(fingerprint = 'file'))
+        ba.store.setMany(['A_2601'], ['SLYNTVATL'], [1.], fingerprint = 'new')
+        ba.saveParquet(self.fn)
+        pq = loadParquet(self.fn, warn = False)
+        self.assertIsInstance(pq.store, VersionedStore)
+        self.assertEqual(pq.store.fingerprintCounts(), {'file':234, 'new':1})
+        """Through the journal-aware path, which tags each batch"""
+        out = hlaStoreCache(warn = False, store = VersionedStore())
+        out.openJournal(os.path.join(self.tmpdir.name, 'journal'))
+        self.assertEqual(out.addFromParquet(self.fn), 235)
+        out.closeJournal()
+        self.assertEqual(out.store.fingerprintCounts(), {'file':234, 'new':1})
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        self.a = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)
+        self.b = hlaPredCache(warn = False)
+        """One conflicting pair (lower than in a), one equal pair and one new pair"""
+        self.b.addPredictionValues(['A*2601', 'A*0101', 'B*9901'], ['MGPGQVLFR', 'ASRKLGDRG', 'MGPGQVLFR'],
+                                   [1., self.a[('A*0101', 'ASRKLGDRG')], 2.])
+    def test_policies(self):
+        original = self.a[('A*2601', 'MGPGQVLFR')]
+        for policy, expected in [('keep_existing', original), ('overwrite', 1.), ('min', 1.)]:
+            out = hlaStoreCache(warn = False)
+            self.assertEqual(out.merge([self.a, self.b], policy = policy), (235, 1))
+            self.assertEqual(len(out), 235)
+            self.assertAlmostEqual(out[('A*2601', 'MGPGQVLFR')], expected, places = 5)
+            self.assertEqual(out[('B*9901', 'MGPGQVLFR')], 2.)
+        """min keeps the lower value whichever cache comes first"""
+        out = hlaStoreCache(warn = False)
+        out.merge([self.b, self.a], policy = 'min')
+        self.assertEqual(out[('A*2601', 'MGPGQVLFR')], 1.)
+        with self.assertRaises(ValueError):
+            out.merge([self.a], policy = 'last')
+    def test_error(self):
+        out = hlaStoreCache(warn = False)
+        with self.assertRaises(ValueError):
+            out.merge([self.a, self.b], policy = 'error')
+        self.assertEqual(len(out), 0)
+        """Equal values (up to quantization) are not conflicts"""
+        q = hlaStoreCache(warn = False, store = ArrayStore(quantize = True))
+        q.merge([self.a])
+        self.assertEqual(out.merge([self.a, q], policy = 'error'), (234, 0))
+    def test_asterisk(self):
+        """Sources keyed with A*2601 (e.g. slices or plain dicts) merge into the A_2601 column"""
+        src = self.a.slice(['A*2601'], ['MGPGQVLFR', 'SLYNTVATL'])
+        dictSrc = hlaPredCache(warn = False)
+        dict.update(dictSrc, {('A*2601', 'MGPGQVLFR'):1., ('A*2601', 'SLYNTVATL'):3.})
+        for target in [hlaStoreCache(warn = False), hlaPredCache(warn = False)]:
+            self.assertEqual(target.merge([src]), (1, 0))
+            self.assertEqual(target.merge([dictSrc], policy = 'overwrite'), (1, 1))
+            self.assertEqual(target[('A*2601', 'MGPGQVLFR')], 1.)
+            self.assertEqual(target[('A*2601', 'SLYNTVATL')], 3.)
+        out = hlaStoreCache(warn = False)
+        out.merge([self.a])
+        with self.assertRaises(ValueError):
+            out.merge([dictSrc], policy = 'error')
+        self.assertAlmostEqual(out[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+    def test_targets(self):
+        """Dict-based cache and journaled cache use the pair-by-pair path"""
+        d = hlaPredCache(warn = False)
+        self.assertEqual(d.merge([self.a, self.b], policy = 'overwrite', batchSize = 7), (235, 1))
+        self.assertEqual(d[('A*2601', 'MGPGQVLFR')], 1.)
+        self.assertEqual(len(d), 235)
+        v = hlaStoreCache(warn = False, store = VersionedStore())
+        src = hlaStoreCache(warn = False, store = VersionedStore(fingerprint = 'x'))
+        src.merge([self.a])
+        self.assertEqual(v.merge([src, self.b]), (235, 1))
+        self.assertEqual(v.store.fingerprintCounts(), {'x':234, None:1})
+
+class TestSqliteStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, 'test.sqlite')
+        self.ref = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_persist(self):
+        store = SqliteStore(self.fn, method = 'netmhcpan')
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, store = store)
+        self.assertEqual(len(ba), len(self.ref))
+        store.close()
+
+        ba = hlaStoreCache(warn = False, store = SqliteStore(self.fn, method = 'netmhcpan'))
+        self.assertEqual(len(ba), len(self.ref))
+        self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729)
+        self.assertTrue(np.isnan(ba[('A*2601', 'AGPGQVLFR')]))
+        hlas = ['A*2601', 'A*3201', 'B*9999']
+        mers = ['MGPGQVLFR', 'GSSSQVSRN', 'AGPGQVLFR']
+        ic50, missing = ba.getMany(hlas, mers, cross = True)
+        expected, expectedMissing = self.ref.getMany(hlas, mers, cross = True)
+        self.assertTrue(np.all(missing == expectedMissing))
+        self.assertTrue(np.allclose(ic50[~missing], expected[~missing]))
+        ic50, missing = ba.getMany(['A*2601', 'A*3201', 'A*2601'], ['MGPGQVLFR', 'MGPGQVLFR', 'MGPGQVLFR'])
+        self.assertEqual(ic50[0], ic50[2])
+        self.assertFalse(missing.any())
+
+        """Other methods in the same file are kept separate"""
+        self.assertEqual(len(SqliteStore(self.fn, method = 'smm')), 0)
+    def test_add(self):
+        ba = hlaStoreCache(warn = False, store = SqliteStore(self.fn, method = 'RAND'))
+        mers = ['MGPGQVLFR', 'GSSSQVSRN', 'ASRKLGDRG', 'MGPGQVLF']
+        ba.addPredictions('RAND', ['A*2601', 'A*0201'], mers)
+        self.assertEqual(len(ba), 8)
+        ba.addPredictions('RAND', ['A*2601', 'A*0201', 'B*0702'], mers)
+        self.assertEqual(len(ba), 12)
+        self.assertFalse(ba.getMany(['B*0702'], mers, cross = True)[1].any())
+
+class TestLRUStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, 'test.sqlite')
+        hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False, store = SqliteStore(self.fn))
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_counters(self):
+        store = LRUStore(SqliteStore(self.fn), maxEntries = 4)
+        ba = hlaStoreCache(warn = False, store = store)
+        self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729)
+        self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729)
+        self.assertEqual((store.hits, store.misses), (1, 1))
+        ba.getMany(['A*2601', 'A*3201', 'A*0201'], ['MGPGQVLFR', 'GSSSQVSRN', 'ASRKLGDRG'], cross = True)
+        self.assertEqual((store.hits, store.misses), (2, 9))
+        self.assertEqual(store.stats()['entries'], 4)
+        self.assertEqual(store.evictions, 5)
+        """Misses are cached too"""
+        self.assertTrue(np.isnan(ba[('A*0201', 'ASRKLGDRX')]))
+        self.assertTrue(np.isnan(ba[('A*0201', 'ASRKLGDRX')]))
+        self.assertEqual(store.hits, 3)
+    def test_write_through(self):
+        store = LRUStore(SqliteStore(self.fn), maxBytes = 10**4, pinned = ['A_2601'])
+        ba = hlaStoreCache(warn = False, store = store)
+        mers = ['MGPGQVLFR', 'GSSSQVSRN', 'ASRKLGDRG']
+        ba.getMany(['A*2601', 'A*3201', 'A*0201'], mers, cross = True)
+        self.assertEqual(store.stats()['pinnedEntries'], 3)
+        ba.addPredictionValues(['A*2601', 'A*0201'], ['MGPGQVLFR', 'AAAAAAAAA'], [1., 2.])
+        self.assertEqual(ba[('A*2601', 'MGPGQVLFR')], 1.)
+        self.assertEqual(SqliteStore(self.fn).get('A_0201', 'AAAAAAAAA'), 2.)
+        store.unpin(['A_2601'])
+        self.assertEqual(store.stats()['pinnedEntries'], 0)
+        self.assertTrue(store.nbytes <= 10**4)
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.ba = hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'shards')
+        self.ba.saveShards(self.path)
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_lazy(self):
+        ba = loadShards(self.path, warn = False)
+        self.assertEqual(len(ba), len(self.ba))
+        self.assertEqual(ba.store.loaded(), [])
+        self.assertAlmostEqual(ba[('A*2601', 'MGPGQVLFR')], 10.3372161729, places = 5)
+        self.assertEqual(ba.store.loaded(), ['A_2601'])
+        ba.preload(['A*0201', 'B*9999'])
+        self.assertEqual(ba.store.loaded(), ['A_0201', 'A_2601'])
+        ic50, missing = ba.getMany(['A*2601', 'A*3201', 'B*9999'], ['MGPGQVLFR', 'AGPGQVLFR'], cross = True)
+        self.assertEqual(missing.sum(), 4)
+        self.assertEqual(set(ba.items()), set(hlaStoreCache(baseFn = 'data/test', kmers = [9]).items()))
+    def test_save(self):
+        ba = loadShards(self.path, warn = False)
+        ba.addPredictionValues(['A*2601', 'B*9901'], ['AGPGQVLFR', 'AGPGQVLFR'], [1., 2.])
+        ba.store.save()
+        ba = loadShards(self.path, warn = False)
+        self.assertEqual(len(ba), len(self.ba) + 2)
+        self.assertEqual(ba[('A*2601', 'AGPGQVLFR')], 1.)
+        self.assertEqual(ba[('B*9901', 'AGPGQVLFR')], 2.)
+        self.assertEqual(ba.store.loaded(), ['A_2601', 'B_9901'])
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.journalFn = os.path.join(self.tmpdir.name, 'test.journal')
+        self.snapFn = os.path.join(self.tmpdir.name, 'test.snap')
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    def test_replay(self):
+        ba = hlaPredCache(warn = False)
+        ba.openJournal(self.journalFn)
+        ba.addPredictionValues(['A*0201', 'A*0201'], ['SLYNTVATL', 'MGARASVLS'], [5., 9.])
+        ba.addPredictionValues(['B*0702'], ['SLYNTVATL'], [7.])
+        ba.closeJournal()
+        """Simulate a crash while writing the last batch"""
+        with open(self.journalFn, 'ab') as fh:
+            fh.write(b'HPJ1\x10\x00')
+        ba = hlaStoreCache(warn = False)
+        self.assertEqual(ba.openJournal(self.journalFn), 3)
+        self.assertEqual(ba[('A*0201', 'MGARASVLS')], 9.)
+        self.assertEqual(ba[('B*0702', 'SLYNTVATL')], 7.)
+        """The partial record was discarded, new batches are still readable"""
+        ba.addPredictionValues(['B*0702'], ['MGARASVLS'], [3.])
+        ba.closeJournal()
+        ba = hlaPredCache(warn = False)
+        self.assertEqual(ba.openJournal(self.journalFn), 4)
+    def test_compact(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)
+        ba.saveSnapshot(self.snapFn)
+        ba = loadSnapshot(self.snapFn, warn = False)
+        ba.openJournal(self.journalFn, sync = False)
+        ba.addPredictionValues(['A*0201'], ['SLYNTVATL'], [5.])
+        ba.compact(self.snapFn)
+        ba.addPredictionValues(['A*0201'], ['MGARASVLS'], [9.])
+        thread = ba.compact(self.snapFn, background = True)
+        ba.addPredictionValues(['B*0702'], ['SLYNTVATL'], [7.])
+        thread.join()
+        ba.closeJournal()
+        restored = loadSnapshot(self.snapFn, warn = False)
+        self.assertEqual(restored[('A*0201', 'SLYNTVATL')], 5.)
+        self.assertEqual(restored[('A*0201', 'MGARASVLS')], 9.)
+        self.assertEqual(restored.openJournal(self.journalFn), 1)
+        self.assertEqual(restored[('B*0702', 'SLYNTVATL')], 7.)
+        self.assertEqual(len(restored), len(ba))
+    def test_setitem(self):
+        for cls in [hlaPredCache, hlaStoreCache]:
+            ba = cls(warn = False)
+            ba.openJournal(self.journalFn)
+            ba[('A*0201', 'SLYNTVATL')] = 5.
+            ba.update({('B*0702', 'SLYNTVATL'):7., ('B*0702', 'MGARASVLS'):3.})
+            ba.closeJournal()
+            restored = cls(warn = False)
+            self.assertEqual(restored.openJournal(self.journalFn), 3)
+            self.assertEqual(restored[('A*0201', 'SLYNTVATL')], 5.)
+            self.assertEqual(restored[('B*0702', 'MGARASVLS')], 3.)
+            os.remove(self.journalFn)
+    def test_compact_error(self):
+        ba = hlaStoreCache(warn = False)
+        ba.openJournal(self.journalFn)
+        ba.addPredictionValues(['A*0201'], ['SLYNTVATL'], [5.])
+        """The journal can't be moved to the segment"""
+        segmentFn = ba.journal.segmentFn
+        os.mkdir(segmentFn)
+        with self.assertRaises(OSError):
+            ba.compact(self.snapFn)
+        """The failed rotation released the compaction lock and the journal still takes appends"""
+        self.assertTrue(ba.journal.compactLock.acquire(timeout = 1))
+        ba.journal.compactLock.release()
+        ba.addPredictionValues(['B*0702'], ['SLYNTVATL'], [7.])
+        ba.closeJournal()
+        os.rmdir(segmentFn)
+        self.assertEqual(hlaPredCache(warn = False).openJournal(self.journalFn), 2)
 
 class TestIEDBWrap(unittest.TestCase):
     def setUp(self):
@@ -104,6 +1101,50 @@ class TestIEDBWrap(unittest.TestCase):
 class TestIEDBSrc(unittest.TestCase):
     pass
 
+class TestPermutationNull(unittest.TestCase):
+    def setUp(self):
+        self.hlas = ['A*2601', 'A_0201', 'A*0203']
+        self.mers = ['MGPGQVLFR', 'GSSSQVSRN', 'ASRKLGDRG']
+    def test_getrand(self):
+        for ba in [hlaPredCache(baseFn = 'data/test', kmers = [9], warn = False), hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)]:
+            ba.permutePeptides(seed = 110)
+            for h in self.hlas:
+                for m in self.mers:
+                    hla = h.replace('*', '_')
+                    permuted = ba.uPep[ba.transMat[ba.uPep.index(m), ba.uHLA.index(hla)]]
+                    self.assertEqual(ba.getRand((h, m)), ba[(hla, permuted)])
+            ba.useRand = True
+            ic50, missing = ba.getMany(self.hlas, self.mers, cross = True)
+            ba.useRand = False
+            expected = np.array([[ba.getRand((h, m)) for m in self.mers] for h in self.hlas])
+            self.assertTrue(np.allclose(ic50, expected))
+    def test_nulls(self):
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = False)
+        nulls = ba.permutationNulls(self.hlas, self.mers + ['MGPGQVLFR'], B = 50, seed = 1)
+        self.assertEqual(nulls.shape, (50, len(self.hlas), len(self.mers) + 1))
+        self.assertTrue(np.all(nulls == ba.permutationNulls(self.hlas, self.mers + ['MGPGQVLFR'], B = 50, seed = 1)))
+        """Repeated query peptides get the same permuted peptide, distinct ones get distinct peptides"""
+        self.assertTrue(np.all(nulls[:, :, 0] == nulls[:, :, -1]))
+        cachePeptides = list({k[1] for k in ba.keys()})
+        for i, h in enumerate(self.hlas):
+            alleleValues = set(ba.getMany([h], cachePeptides, cross = True)[0].ravel())
+            self.assertTrue(set(nulls[:, i, :].ravel()) <= alleleValues)
+            self.assertTrue(all([len(set(row)) == len(self.mers) for row in nulls[:, i, :3]]))
+        """Peptides added after the first draw are in the null"""
+        ba.addPredictionValues(['A*2601'], ['SLYNTVATL'], [-50.])
+        nulls = ba.permutationNulls(['A*2601'], self.mers, B = 200, seed = 1)
+        self.assertIn(-50., nulls.ravel())
+    def test_cross_warn(self):
+        """Missing permuted predictions are summarized for the crossed alleles and peptides"""
+        ba = hlaStoreCache(baseFn = 'data/test', kmers = [9], warn = True)
+        ba.permutePeptides(seed = 110)
+        ba.useRand = True
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            ic50, missing = ba.getMany(self.hlas + ['B*9999'], self.mers, cross = True)
+        self.assertEqual(ic50.shape, (len(self.hlas) + 1, len(self.mers)))
+        self.assertTrue(missing[-1].all())
+        self.assertIn('not found', out.getvalue())
+
 class TestRandomCache(unittest.TestCase):
     def test_init(self):
         ba = RandCache()
@@ -114,6 +1155,26 @@ class TestRandomCache(unittest.TestCase):
         x = ba[('A*2601', 'MGPGQVLFR')]
         self.assertEqual(x, ba[('A*2601', 'MGPGQVLFR')])
         self.assertEqual(len(ba), 1)
+    def test_getmany(self):
+        ba = RandCache()
+        ic50, missing = ba.getMany(['A*2601', 'A_0201'], ['MGPGQVLFR', 'MGPGXVLFR', 'ASRKLGDRG'], cross = True)
+        self.assertEqual(len(ba), 4)
+        self.assertEqual(list(missing[:, 1]), [True, True])
+        self.assertEqual(ic50[0, 0], ba[('A*2601', 'MGPGQVLFR')])
+    def test_stateless(self):
+        ba = RandCache(seed = 5)
+        x = ba[('A*2601', 'MGPGQVLFR')]
+        self.assertEqual(len(ba), 0)
+        self.assertEqual(x, RandCache(seed = 5)[('A_2601', 'MGPGQVLFR')])
+        self.assertNotEqual(x, RandCache(seed = 6)[('A*2601', 'MGPGQVLFR')])
+        self.assertTrue(np.isnan(ba[('A*2601', 'MGPGXVLFR')]))
+        mers = getMers('MGPGQVLFRSLYNTVATLYCVHQRIEIKDTKEALDKIEEEQNKSKKKAQQAAADTGHSNQVSQNYPIVQNIQGQMVHQAISPRTLNAWVKVVEEKAFSPEVIPMFSALSEGATPQDLNTMLNTVGGHQAAMQMLKETINEEAAEWDRVHPVHAGPIAPGQMREPRGSDIAGTTSTLQEQIGWMTNNPPIPVGEIYKRWIILGLNKIVRMYSPTSILDIRQGPKEPFRDYVDRFYKTLRAEQASQEVKNWMTETLLVQNANPDCKTILKALGPAATLEEMMTACQGVGGPGHKARVL', [9, 10])
+        ic50, missing = ba.getMany(['A*2601', 'B*0702'], mers, cross = True)
+        self.assertFalse(missing.any())
+        self.assertEqual(ic50[1, 3], ba[('B_0702', mers[3])])
+        self.assertTrue(np.all(ic50 <= 11) and np.all(ic50 > 0))
+        self.assertTrue(abs(np.mean(11 - ic50) - 1.5) < 0.2)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,260 @@
+import numpy as np
+
+from .store import ArrayStore, QMISSING
+
+__all__ = ['VersionedStore']
+
+class VersionedStore(object):
+    """ArrayStore whose predictions are tagged with the fingerprint of the predictor
+    build that produced them (see fingerprint.py and predict.iedbFingerprint()).
+
+    Each batch of predictions (setMany) is stored with a fingerprint. Fingerprints are
+    registered in a small table and each (hla, peptide) cell holds the uint16 id of its
+    fingerprint in a tag matrix with the same rows and columns as the values, so tagging
+    costs 2 bytes per cell and a lookup gathers the values and tags with the same indices.
+
+    With require() lookups only return predictions made by one of the accepted
+    (compatible) fingerprints and treat the others as missing, so e.g.
+    hlaPredCache.planPredictions() re-predicts just the stale pairs.
+    invalidate() deletes the predictions of stale fingerprints.
+
+    Implements the same store interface as ArrayStore, so it can back an hlaStoreCache.
+
+    Parameters
+    ----------
+    store : ArrayStore or None
+        Store with the values (a new ArrayStore if None). Predictions already
+        in the store are untagged.
+    fingerprint : str or None
+        Fingerprint of batches stored without one (e.g. loaded from prediction files).
+        Untagged predictions never satisfy require()."""
+    def __init__(self, store=None, fingerprint=None):
+        if store is None:
+            store = ArrayStore()
+        self.store = store
+        self.fingerprint = fingerprint
+        self.fingerprints = []
+        self.fingerprintIndex = {}
+        self.accepted = None
+        """Number of accepted predictions (None until counted, see __len__)"""
+        self.nAccepted = None
+        """Quantized over (0, QMISSING - 1) the codes are exactly the fingerprint ids"""
+        self.tags = ArrayStore(blockSize=store.blockSize, quantize=True, valueRange=(0., QMISSING - 1))
+        self.tags.addHLAs(store.hlas)
+        if store.nFrozen > 0:
+            self.tags.freeze(store.frozenPeptides, np.full((store.nFrozen, len(store.hlas)), QMISSING, dtype=np.uint16), count=0)
+        self.tags.addPeptides(store.pepIndex.peptides(np.arange(len(store.pepIndex))))
+
+    def __len__(self):
+        """Number of predictions (only the accepted ones, see require()).
+        The accepted ones are counted once per require() and then kept up to date by scatter()"""
+        if self.accepted is None:
+            return len(self.store)
+        if self.nAccepted is None:
+            acceptedIds = self._ids(self.accepted)
+            self.nAccepted = int(np.sum([np.isin(ids[~np.isnan(vals)], acceptedIds).sum() for rows, vals, ids in self._byRows()]))
+        return self.nAccepted
+
+    def _countAccepted(self, rows, cols):
+        """Number of distinct cells among paired row/column indices with an accepted prediction"""
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        if rows.shape[0] == 0:
+            return 0
+        cells = np.unique(np.stack((rows, cols), axis=1), axis=0)
+        return int((~np.isnan(self.gather(cells[:, 0], cells[:, 1]))).sum())
+
+    def __reduce_ex__(self, protocol):
+        """A store attached to shared memory is pickled as the name of its block (see sharedstore.py)"""
+        shm = getattr(self, 'sharedMemory', None)
+        if shm is None:
+            return object.__reduce_ex__(self, protocol)
+        from .sharedstore import attachedStore
+        return attachedStore, (shm.name,)
+
+    @property
+    def hlas(self):
+        return self.store.hlas
+
+    @property
+    def quantized(self):
+        return self.store.quantized
+
+    @property
+    def nbytes(self):
+        return self.store.nbytes + self.tags.nbytes
+
+    @property
+    def maxError(self):
+        return self.store.maxError
+
+    def hlaIndices(self, hlas):
+        """Column index of each allele (-1 if not in the store)"""
+        return self.store.hlaIndices(hlas)
+
+    def peptideIndices(self, peptides):
+        """Row index of each peptide (-1 if not in the store)"""
+        return self.store.peptideIndices(peptides)
+
+    def fingerprintId(self, fingerprint):
+        """Id of a fingerprint in the table (registered if new)"""
+        try:
+            return self.fingerprintIndex[fingerprint]
+        except KeyError:
+            if len(self.fingerprints) >= QMISSING:
+                raise ValueError('VersionedStore holds at most %d fingerprints' % QMISSING)
+            self.fingerprintIndex[fingerprint] = len(self.fingerprints)
+            self.fingerprints.append(fingerprint)
+            return self.fingerprintIndex[fingerprint]
+
+    def freezeTags(self, tags, fingerprints):
+        """Set the tags of a frozen store (e.g. from a snapshot) to a [nPeptides, nHLA] uint16
+        matrix of ids in the table fingerprints (QMISSING for untagged cells)"""
+        if not self.store.nPeptides == self.store.nFrozen:
+            raise ValueError('Can only freeze the tags of a frozen store')
+        self.fingerprints = []
+        self.fingerprintIndex = {}
+        for f in fingerprints:
+            self.fingerprintId(f)
+        self.tags = ArrayStore(blockSize=self.store.blockSize, quantize=True, valueRange=(0., QMISSING - 1))
+        self.tags.addHLAs(self.store.hlas)
+        self.tags.freeze(self.store.frozenPeptides, tags)
+        self.nAccepted = None
+
+    def require(self, fingerprints=None):
+        """Only return predictions tagged with one of these fingerprints
+        (fingerprints=None accepts all predictions again)"""
+        self.accepted = None if fingerprints is None else set(fingerprints)
+        self.nAccepted = None
+
+    def _ids(self, fingerprints):
+        return np.array([self.fingerprintIndex[f] for f in fingerprints if f in self.fingerprintIndex], dtype=float)
+
+    def gather(self, rows, cols):
+        """Return values for paired row/column indices (nan where either index is -1
+        or the prediction is not accepted, see require())"""
+        vals = self.store.gather(rows, cols)
+        if not self.accepted is None:
+            vals[~np.isin(self.tags.gather(rows, cols), self._ids(self.accepted))] = np.nan
+        return vals
+
+    def get(self, hla, peptide):
+        """Return a single prediction or nan"""
+        return float(self.getMany([hla], [peptide])[0])
+
+    def getMany(self, hlas, peptides):
+        """Return predictions for paired sequences of alleles and peptides
+        as a float64 array (nan for missing pairs)"""
+        return self.gather(self.store.peptideIndices(peptides), self.store.hlaIndices(hlas))
+
+    def getCross(self, hlas, peptides):
+        """Return a [len(hlas), len(peptides)] matrix of predictions (nan for missing pairs)"""
+        rows = self.store.peptideIndices(peptides)
+        cols = self.store.hlaIndices(hlas)
+        return self.gather(np.tile(rows, len(cols)), np.repeat(cols, len(rows))).reshape((len(cols), len(rows)))
+
+    def getFingerprints(self, hlas, peptides):
+        """Fingerprint of each prediction for paired sequences of alleles and peptides
+        (None for missing or untagged pairs)"""
+        rows = self.store.peptideIndices(peptides)
+        cols = self.store.hlaIndices(hlas)
+        ids = self.tags.gather(rows, cols)
+        ids[np.isnan(self.store.gather(rows, cols))] = np.nan
+        return np.array([None if np.isnan(i) else self.fingerprints[int(i)] for i in ids], dtype=object)
+
+    def addHLAs(self, hlas):
+        """Add alleles to the index (if new) and return their column indices"""
+        """Alleles and peptides are added to both stores in the same order, so their indices match"""
+        self.tags.addHLAs(hlas)
+        return self.store.addHLAs(hlas)
+
+    def addPeptides(self, peptides):
+        """Add peptides to the index (if new) and return their row indices"""
+        self.tags.addPeptides(peptides)
+        return self.store.addPeptides(peptides)
+
+    def setMany(self, hlas, peptides, values, fingerprint=None):
+        """Store predictions for paired sequences of alleles, peptides and values as one batch
+        tagged with fingerprint (self.fingerprint if None). Existing values are overwritten"""
+        hlas, peptides = list(hlas), list(peptides)
+        cols = self.addHLAs(hlas)
+        rows = self.addPeptides(peptides)
+        self.scatter(rows, cols, values, fingerprint=fingerprint)
+
+    def scatter(self, rows, cols, values, fingerprint=None):
+        """Assign values tagged with fingerprint (self.fingerprint if None)
+        at paired row/column indices, which must already exist"""
+        values = np.asarray(values, dtype=float)
+        if fingerprint is None:
+            fingerprint = self.fingerprint
+        counting = not self.accepted is None and not self.nAccepted is None
+        if counting:
+            nBefore = self._countAccepted(rows, cols)
+        self.store.scatter(rows, cols, values)
+        ids = np.full(values.shape[0], np.nan if fingerprint is None else float(self.fingerprintId(fingerprint)))
+        ids[np.isnan(values)] = np.nan
+        self.tags.scatter(rows, cols, ids)
+        if counting:
+            self.nAccepted += self._countAccepted(rows, cols) - nBefore
+
+    def _byRows(self):
+        """Generator over (rows, values, ids) for blocks of peptide rows,
+        with values and ids as [len(rows), nHLA] float matrices (nan for missing)"""
+        for start in range(0, self.store.nPeptides, self.store.blockSize):
+            rows = np.arange(start, min(start + self.store.blockSize, self.store.nPeptides))
+            yield rows, self.store.decode(self.store.rowValues(rows)), self.tags.decode(self.tags.rowValues(rows))
+
+    def fingerprintCounts(self):
+        """Dict with the number of predictions of each fingerprint (None for untagged ones)"""
+        counts = np.zeros(len(self.fingerprints) + 1, dtype=np.int64)
+        for rows, vals, ids in self._byRows():
+            ids = ids[~np.isnan(vals)]
+            ids[np.isnan(ids)] = len(self.fingerprints)
+            counts += np.bincount(ids.astype(np.int64), minlength=counts.shape[0])
+        return {f:int(n) for f, n in zip(self.fingerprints + [None], counts) if n > 0}
+
+    def invalidate(self, fingerprints=None, keep=None):
+        """Delete the predictions tagged with any of fingerprints, or with none of
+        the fingerprints in keep (None for untagged predictions in either list).
+
+        Returns the number of predictions that were deleted."""
+        if (fingerprints is None) == (keep is None):
+            raise ValueError('Pass exactly one of fingerprints or keep')
+        fingerprints = fingerprints if keep is None else keep
+        ids = self._ids(fingerprints)
+        untagged = None in fingerprints
+        nDeleted = 0
+        for rows, vals, tagIds in self._byRows():
+            match = np.isin(tagIds, ids) | (np.isnan(tagIds) & untagged)
+            stale = ~np.isnan(vals) & (match if keep is None else ~match)
+            r, c = np.nonzero(stale)
+            self.store.scatter(rows[r], c, np.full(r.shape[0], np.nan))
+            self.tags.scatter(rows[r], c, np.full(r.shape[0], np.nan))
+            nDeleted += r.shape[0]
+        self.nAccepted = None
+        return nDeleted
+
+    def iterItems(self):
+        """Generator over ((hla, peptide), value) for all predictions (accepted ones, see require())"""
+        acceptedIds = None if self.accepted is None else self._ids(self.accepted)
+        for rows, vals, ids in self._byRows():
+            ok = ~np.isnan(vals)
+            if not acceptedIds is None:
+                ok &= np.isin(ids, acceptedIds)
+            r, c = np.nonzero(ok)
+            for p, ci, v in zip(self.store.peptideAt(rows[r]), c, vals[r, c]):
+                yield (self.store.hlas[ci], p), float(v)
+
+    """Used to write snapshots (see snapshot.py)"""
+    @property
+    def dtype(self):
+        return self.store.dtype
+
+    @property
+    def valueRange(self):
+        return self.store.valueRange
+
+    def allPeptides(self):
+        return self.store.allPeptides()
+
+    def rowValues(self, rows):
+        return self.store.rowValues(rows)